@@ -0,0 +1,489 @@
+"""
+Benchmarks for loading and preprocessing meshes in the data pipeline.
+
+Run a benchmark from the repository root (with the package installed through `pip install -e .`) with:
+
+    python benchmarks/benchmark_data.py <benchmark_name> [--mesh-files meshes/*.obj]
+"""
+import argparse
+import glob
+import os
+import pickle
+import shutil
+import tempfile
+import time
+import zipfile
+from typing import Any, Callable, Dict, List, Tuple
+
+import numpy as np
+import torch
+
+from PIL import Image
+from torch.utils.data import DataLoader
+
+from polygen.modules.data_modules import (
+    CollateMethod,
+    ImageDataset,
+    MeshShardDataset,
+    PolygenDataModule,
+    ShapenetDataset,
+)
+from polygen.modules.image_encoder import PolygenResnet
+from polygen.utils.data_utils import (
+    center_vertices,
+    normalize_vertices_scale,
+    quantize_process_mesh,
+    random_shift,
+    random_shift_batch,
+    read_obj,
+    read_obj_fast,
+)
+from polygen.utils.batch_sampler import TokenBudgetBatchSampler
+from polygen.utils.feature_store import extract_features
+from polygen.utils.image_store import main as build_image_store_main
+from polygen.utils.mesh_shards import build_shards, load_shard_index
+from polygen.utils.manifest import main as manifest_main
+from polygen.utils.manifest import padding_efficiency
+from polygen.utils.mesh_store import main as build_mesh_store_main
+from polygen.utils.zip_index import build_zip_index
+
+DEFAULT_MESH_FILES = ["meshes/*.obj", "image_meshes/*/*/models/model_normalized.obj"]
+
+
+def find_mesh_files(patterns: List[str]) -> List[str]:
+    """Expands glob patterns into a sorted list of .obj files"""
+    mesh_files = sorted(set(f for pattern in patterns for f in glob.glob(pattern)))
+    if not mesh_files:
+        raise ValueError(f"No .obj files match {patterns}")
+    return mesh_files
+
+
+def write_grid_obj(obj_path: str, size: int) -> None:
+    """Writes a size x size grid of quads with v/vt/vn face vertices, as exported by modeling tools"""
+    with open(obj_path, "w") as obj_file:
+        for i in range(size):
+            for j in range(size):
+                obj_file.write(f"v {i / size - 0.5:.6f} {j / size - 0.5:.6f} 0.000000\n")
+        obj_file.write("vn 0.000000 0.000000 1.000000\n")
+        for i in range(size - 1):
+            for j in range(size - 1):
+                quad = [i * size + j + 1, i * size + j + 2, (i + 1) * size + j + 2, (i + 1) * size + j + 1]
+                obj_file.write("f " + " ".join(f"{v}/{v}/1" for v in quad) + "\n")
+
+
+def time_call(fn: Callable[[], None], repeats: int = 1) -> float:
+    """Returns the best wall clock time of fn over several repeats"""
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def benchmark_quantize_process_mesh(args: argparse.Namespace) -> None:
+    """Meshes/sec of quantize_process_mesh on already loaded meshes"""
+    meshes = []
+    for mesh_file in find_mesh_files(args.mesh_files):
+        vertices, faces = read_obj(mesh_file)
+        vertices = torch.from_numpy(vertices)[:, [2, 0, 1]]
+        meshes.append((normalize_vertices_scale(center_vertices(vertices)), faces))
+    num_faces = sum(len(faces) for _, faces in meshes)
+    print(f"{len(meshes)} meshes, {num_faces} faces, {args.quantization_bits} quantization bits")
+
+    def _process() -> None:
+        for vertices, faces in meshes:
+            quantize_process_mesh(vertices, faces, quantization_bits=args.quantization_bits)
+
+    elapsed = time_call(_process, args.repeats)
+    print(f"{'meshes/s':>10} {'faces/s':>12}")
+    print(f"{len(meshes) / elapsed:>10.1f} {num_faces / elapsed:>12.1f}")
+
+
+def benchmark_read_obj(args: argparse.Namespace) -> None:
+    """Files/sec and MB/sec of read_obj and read_obj_fast on the mesh files and a large synthetic grid"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        mesh_files = find_mesh_files(args.mesh_files)
+        grid_file = os.path.join(tmp_dir, "grid.obj")
+        write_grid_obj(grid_file, args.grid_size)
+        print(f"{'files':>12} {'implementation':>16} {'files/s':>10} {'MB/s':>8}")
+        for name, files in [("mesh files", mesh_files), (f"{args.grid_size}x{args.grid_size} grid", [grid_file])]:
+            num_megabytes = sum(os.path.getsize(f) for f in files) / 2 ** 20
+            for implementation, read in [("read_obj", read_obj), ("read_obj_fast", read_obj_fast)]:
+
+                def _read() -> None:
+                    for mesh_file in files:
+                        read(mesh_file)
+
+                elapsed = time_call(_read, args.repeats)
+                print(f"{name:>12} {implementation:>16} {len(files) / elapsed:>10.1f} {num_megabytes / elapsed:>8.1f}")
+
+
+def write_renderings(data_dir: str, num_renderings: int, size: int = 256) -> None:
+    """Writes random .jpeg renderings next to every mesh of a ShapeNet-style directory"""
+    rng = np.random.default_rng(0)
+    for mesh_file in ShapenetDataset(data_dir).all_files:
+        renderings_dir = os.path.join(os.path.dirname(os.path.dirname(mesh_file)), "renderings")
+        os.makedirs(renderings_dir, exist_ok=True)
+        for i in range(num_renderings):
+            pixels = rng.integers(0, 256, size=[size, size, 3], dtype=np.uint8)
+            Image.fromarray(pixels).save(os.path.join(renderings_dir, f"{i}.jpeg"))
+
+
+def benchmark_mesh_store(args: argparse.Namespace) -> None:
+    """Meshes/sec of ShapenetDataset preprocessing .obj files and serving them from a mesh store"""
+    with tempfile.TemporaryDirectory() as store_dir:
+        start = time.perf_counter()
+        build_mesh_store_main(["--data-dir", args.data_dir, "--store-dir", store_dir])
+        print(f"built the store in {time.perf_counter() - start:.2f}s")
+        datasets = [
+            ("obj files", ShapenetDataset(args.data_dir)),
+            ("mesh store", ShapenetDataset(args.data_dir, mesh_store_dir=store_dir)),
+        ]
+        print(f"{'dataset':>12} {'meshes/s':>10}")
+        for name, dataset in datasets:
+
+            def _load() -> None:
+                for idx in range(len(dataset)):
+                    dataset[idx]
+
+            elapsed = time_call(_load, args.repeats)
+            print(f"{name:>12} {len(dataset) / elapsed:>10.1f}")
+
+
+def benchmark_manifest(args: argparse.Namespace) -> None:
+    """Construction time of ShapenetDataset globbing the data directory and reading a manifest"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        manifest_path = os.path.join(tmp_dir, "manifest.npz")
+        start = time.perf_counter()
+        manifest_main(["build", "--data-dir", args.data_dir, "--manifest", manifest_path])
+        print(f"built the manifest in {time.perf_counter() - start:.2f}s")
+        constructors = [
+            ("glob", lambda: ShapenetDataset(args.data_dir)),
+            ("manifest", lambda: ShapenetDataset(args.data_dir, manifest_path=manifest_path)),
+        ]
+        print(f"{'dataset':>12} {'ms':>10}")
+        for name, construct in constructors:
+            elapsed = time_call(construct, args.repeats)
+            print(f"{name:>12} {1000 * elapsed:>10.2f}")
+
+
+def benchmark_batch_sampler(args: argparse.Namespace) -> None:
+    """Padding ratio of random fixed-size batches and token budget batches on long-tailed ShapeNet-like lengths"""
+    # Vertex token lengths of ShapeNet meshes roughly follow a log-normal distribution
+    lengths = np.random.default_rng(0).lognormal(mean=6, sigma=0.9, size=50000).astype(np.int64) + 1
+    batch_size = 8
+    max_tokens = batch_size * int(np.mean(lengths))
+    print(f"{len(lengths)} sequences, mean length {np.mean(lengths):.0f}, max length {lengths.max()}")
+    print(f"{'batching':>24} {'padding ratio':>14} {'batches':>8}")
+    print(f"{f'random, {batch_size} per batch':>24} {1 - padding_efficiency(lengths, batch_size):>14.3f} "
+          f"{len(lengths) // batch_size:>8}")
+    for bucket_size in [256, 4096]:
+        sampler = TokenBudgetBatchSampler(lengths, max_tokens=max_tokens, bucket_size=bucket_size)
+        elapsed = time_call(sampler.batches)
+        name = f"{max_tokens} tokens, {bucket_size}"
+        print(f"{name:>24} {sampler.padding_ratio:>14.3f} {len(sampler):>8}  planned in {1000 * elapsed:.0f}ms")
+
+
+def benchmark_collate(args: argparse.Namespace) -> None:
+    """Milliseconds per batch of the vectorized collate functions against batch size"""
+    # Random shifts sample a truncated normal per mesh and are left out to time the batching
+    print(f"{'collate':>10} {'batch size':>10} {'ms':>10} {'us per mesh':>12}")
+    for name, collate_method in [("vertices", CollateMethod.VERTICES), ("faces", CollateMethod.FACES)]:
+        data_module = PolygenDataModule(
+            args.data_dir,
+            collate_method=collate_method,
+            batch_size=1,
+            apply_random_shift_vertices=False,
+            apply_random_shift_faces=False,
+        )
+        dataset = data_module.shapenet_dataset
+        meshes = [dataset[idx] for idx in range(len(dataset))]
+        for batch_size in [4, 16, 64, 256]:
+            ds = [meshes[i % len(meshes)] for i in range(batch_size)]
+            elapsed = time_call(lambda: data_module.collate_fn(ds), args.repeats)
+            print(f"{name:>10} {batch_size:>10} {1000 * elapsed:>10.2f} {1e6 * elapsed / batch_size:>12.1f}")
+
+
+def benchmark_random_shift(args: argparse.Namespace) -> None:
+    """Milliseconds per batch of shifting meshes one by one and with one truncated normal draw per batch"""
+    dataset = ShapenetDataset(args.data_dir)
+    meshes = [dataset[idx]["vertices"] for idx in range(len(dataset))]
+    print(f"{'batch size':>10} {'per mesh ms':>12} {'batched ms':>11} {'seeded ms':>10}")
+    for batch_size in [4, 16, 64, 256]:
+        vertices_list = [meshes[i % len(meshes)] for i in range(batch_size)]
+        vertices = torch.cat(vertices_list)
+        num_vertices = torch.tensor([len(v) for v in vertices_list])
+        bits = args.quantization_bits
+        shifts = [
+            lambda: [random_shift(v, quantization_bits=bits) for v in vertices_list],
+            lambda: random_shift_batch(vertices, num_vertices, quantization_bits=bits),
+            lambda: random_shift_batch(vertices, num_vertices, quantization_bits=bits, seeds=list(range(batch_size))),
+        ]
+        elapsed = [time_call(shift, args.repeats) for shift in shifts]
+        print(f"{batch_size:>10} " + " ".join(f"{1000 * e:>{w}.2f}" for e, w in zip(elapsed, [12, 11, 10])))
+
+
+def benchmark_compact_dtypes(args: argparse.Namespace) -> None:
+    """Pickled bytes and collate time per batch of 64 meshes with int32/float32 and compact dtypes"""
+    print(f"{'collate':>10} {'dtypes':>8} {'item bytes':>11} {'batch bytes':>12} {'collate ms':>11}")
+    for name, collate_method in [("vertices", CollateMethod.VERTICES), ("faces", CollateMethod.FACES)]:
+        for compact_dtypes in [False, True]:
+            data_module = PolygenDataModule(
+                args.data_dir,
+                collate_method=collate_method,
+                batch_size=1,
+                quantization_bits=args.quantization_bits,
+                compact_dtypes=compact_dtypes,
+            )
+            dataset = data_module.shapenet_dataset
+            ds = [dataset[i % len(dataset)] for i in range(64)]
+            item_bytes = sum(len(pickle.dumps(element)) for element in ds) / len(ds)
+            batch_bytes = len(pickle.dumps(data_module.collate_fn(ds)))
+            elapsed = time_call(lambda: data_module.collate_fn(ds), args.repeats)
+            dtypes = "compact" if compact_dtypes else "int32"
+            print(f"{name:>10} {dtypes:>8} {item_bytes:>11.0f} {batch_bytes:>12} {1000 * elapsed:>11.2f}")
+
+
+def worker_memory() -> Dict[str, int]:
+    """Resident, proportional and private memory of the current process in kB, from /proc/self/smaps_rollup"""
+    memory = {}
+    with open("/proc/self/smaps_rollup") as smaps_file:
+        for line in smaps_file:
+            fields = line.split()
+            if fields[0] in ["Rss:", "Pss:", "Private_Clean:", "Private_Dirty:"]:
+                memory[fields[0][:-1]] = int(fields[1])
+    return {"rss": memory["Rss"], "pss": memory["Pss"], "private": memory["Private_Clean"] + memory["Private_Dirty"]}
+
+
+class MemoryReportingCollate:
+    def __init__(self, collate_fn: Callable) -> None:
+        """Collate function that also reports the pid and memory of the worker process that ran it"""
+        self.collate_fn = collate_fn
+
+    def __call__(self, ds: List[Dict[str, Any]]) -> Tuple[Dict[str, torch.Tensor], int, Dict[str, int]]:
+        return self.collate_fn(ds), os.getpid(), worker_memory()
+
+
+def benchmark_dataloader_workers(args: argparse.Namespace) -> None:
+    """Samples/sec and per-worker memory of DataLoader workers with list-backed and shared-memory datasets"""
+    mesh_files = sorted(ShapenetDataset(args.data_dir).all_files)
+    # Repeat the meshes to get a file list and a set of processed meshes of a realistic size
+    all_files = mesh_files * args.num_repeats
+    label_dict = {mesh_file: i for i, mesh_file in enumerate(mesh_files)}
+    print(f"{len(all_files)} meshes, {args.num_workers} workers")
+    print(f"{'dataset':>14} {'samples/s':>10} {'rss kB':>9} {'pss kB':>9} {'private kB':>11}")
+    for name, shared_memory in [("lists", False), ("shared memory", True)]:
+        data_module = PolygenDataModule(
+            args.data_dir,
+            collate_method=CollateMethod.FACES,
+            batch_size=16,
+            default_shapenet=False,
+            all_files=all_files,
+            label_dict=label_dict,
+            num_workers=args.num_workers,
+            shared_memory=shared_memory,
+            pin_memory=torch.cuda.is_available(),
+        )
+        dataloader = DataLoader(
+            data_module.shapenet_dataset,
+            batch_size=16,
+            shuffle=True,
+            **{**data_module.dataloader_kwargs(), "collate_fn": MemoryReportingCollate(data_module.collate_fn)},
+        )
+        memory = {}
+        start = time.perf_counter()
+        for _, pid, pid_memory in dataloader:
+            memory[pid] = pid_memory
+        samples_per_second = len(all_files) / (time.perf_counter() - start)
+        mean_memory = {key: sum(m[key] for m in memory.values()) / len(memory) for key in ["rss", "pss", "private"]}
+        print(
+            f"{name:>14} {samples_per_second:>10.1f} {mean_memory['rss']:>9.0f} {mean_memory['pss']:>9.0f} "
+            f"{mean_memory['private']:>11.0f}"
+        )
+
+
+def benchmark_feature_store(args: argparse.Namespace) -> None:
+    """Per-step cost of the image context: decoding renderings and running the frozen resnet vs cached features"""
+    batch_size = 16
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = os.path.join(tmp_dir, "data")
+        shutil.copytree(args.data_dir, data_dir)
+        write_renderings(data_dir, num_renderings=8)
+        # Random weights cost as much as the ImageNet ones and need no download
+        res_net = PolygenResnet(pretrained=False)
+        store_dir = os.path.join(tmp_dir, "features")
+        start = time.perf_counter()
+        cached_dataset = ImageDataset(data_dir, feature_store_dir=store_dir, feature_backbone=res_net)
+        print(f"built the store of {len(cached_dataset)} renderings in {time.perf_counter() - start:.2f}s")
+        store_bytes = os.path.getsize(os.path.join(store_dir, "features.npy"))
+        print(f"{store_bytes / len(cached_dataset) / 1e3:.0f} kB/rendering")
+        image_dataset = ImageDataset(data_dir)
+        indices = list(range(batch_size))
+
+        def _images() -> None:
+            images = torch.stack([image_dataset[idx]["image"] for idx in indices])
+            extract_features(res_net, images)
+
+        def _features() -> None:
+            torch.stack([cached_dataset[idx]["image_features"] for idx in indices]).to(torch.float32)
+
+        print(f"{'context':>16} {'ms/batch':>10}")
+        for name, fn in [("images + resnet", _images), ("cached features", _features)]:
+            print(f"{name:>16} {time_call(fn, args.repeats) * 1e3:>10.1f}")
+
+
+def benchmark_mesh_lru(args: argparse.Namespace) -> None:
+    """Per-rendering latency of ImageDataset with and without processed-mesh caches, in shuffled order"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = os.path.join(tmp_dir, "data")
+        shutil.copytree(args.data_dir, data_dir)
+        write_renderings(data_dir, num_renderings=24, size=64)
+        mesh_cache_dir = os.path.join(tmp_dir, "cache")
+        indices = np.random.default_rng(0).permutation(len(ImageDataset(data_dir)))
+        print(f"{len(indices)} renderings")
+        print(f"{'meshes':>18} {'ms/rendering':>13} {'hit rate':>9}")
+        for name, kwargs in [
+            ("processed", {}),
+            ("disk cache", {"mesh_cache_dir": mesh_cache_dir}),
+            ("lru", {"max_cached_meshes": 64}),
+            ("lru + disk cache", {"max_cached_meshes": 64, "mesh_cache_dir": mesh_cache_dir}),
+        ]:
+            dataset = ImageDataset(data_dir, **kwargs)
+
+            def _load() -> None:
+                for idx in indices:
+                    dataset[int(idx)]
+
+            elapsed = time_call(_load)
+            hit_rate = f"{dataset.mesh_lru.hit_rate:.3f}" if dataset.mesh_lru is not None else "-"
+            print(f"{name:>18} {elapsed / len(indices) * 1e3:>13.3f} {hit_rate:>9}")
+
+
+def benchmark_image_decode(args: argparse.Namespace) -> None:
+    """Per-rendering latency of decoding full renderings, of the fast decoding path and of an image store"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = os.path.join(tmp_dir, "data")
+        shutil.copytree(args.data_dir, data_dir)
+        write_renderings(data_dir, num_renderings=4, size=args.image_size)
+        store_dir = os.path.join(tmp_dir, "images")
+        start = time.perf_counter()
+        build_image_store_main(["--data-dir", data_dir, "--store-dir", store_dir])
+        print(f"built the store in {time.perf_counter() - start:.2f}s")
+        print(f"{'images':>18} {'ms/rendering':>13}")
+        for name, kwargs in [
+            ("tensor, resize", {"fast_decode": False}),
+            ("draft, resize", {}),
+            ("image store", {"image_store_dir": store_dir}),
+            ("image store uint8", {"image_store_dir": store_dir, "compact_dtypes": True}),
+        ]:
+            dataset = ImageDataset(data_dir, **kwargs)
+
+            def _load() -> None:
+                for idx in range(len(dataset)):
+                    dataset.image(idx, dataset.images[idx])
+
+            print(f"{name:>18} {time_call(_load, args.repeats) / len(dataset) * 1e3:>13.3f}")
+
+
+def benchmark_mesh_shards(args: argparse.Namespace) -> None:
+    """Samples/sec and file opens of reading .obj files in random order and of streaming shards"""
+    mesh_files = sorted(ShapenetDataset(args.data_dir).all_files)
+    all_files = mesh_files * args.num_repeats
+    label_dict = {mesh_file: i for i, mesh_file in enumerate(mesh_files)}
+    with tempfile.TemporaryDirectory() as shard_dir:
+        start = time.perf_counter()
+        build_shards(all_files, [label_dict[f] for f in all_files], shard_dir, samples_per_shard=256)
+        print(f"sharded {len(all_files)} meshes in {time.perf_counter() - start:.2f}s")
+        shards = load_shard_index(shard_dir)["shards"]
+        obj_dataset = ShapenetDataset(args.data_dir, default_shapenet=False, all_files=all_files, label_dict=label_dict)
+        datasets = [("obj files", obj_dataset), ("shards", MeshShardDataset(shards))]
+        print(f"{'dataset':>10} {'samples/s':>10} {'file opens':>11}")
+        for name, dataset in datasets:
+            dataloader = DataLoader(dataset, batch_size=16, shuffle=name == "obj files", collate_fn=lambda ds: ds)
+
+            def _load() -> None:
+                for _ in dataloader:
+                    pass
+
+            num_opens = len(all_files) if name == "obj files" else len(shards)
+            print(f"{name:>10} {len(all_files) / time_call(_load, args.repeats):>10.1f} {num_opens:>11}")
+
+
+def benchmark_zip_archives(args: argparse.Namespace) -> None:
+    """Meshes/sec of reading extracted .obj files, of zipfile and of zip members read by indexed offset"""
+    mesh_files = sorted(ShapenetDataset(args.data_dir).all_files)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # One archive per category, with each mesh of the category repeated as num_repeats models
+        zip_files = []
+        for mesh_file in mesh_files:
+            category = mesh_file.split("/")[-4]
+            zip_files.append(os.path.join(tmp_dir, f"{category}.zip"))
+            with zipfile.ZipFile(zip_files[-1], "w", compression=zipfile.ZIP_DEFLATED) as archive:
+                for i in range(args.num_repeats):
+                    archive.write(mesh_file, f"{category}/{i:06d}/models/model_normalized.obj")
+        index_path = os.path.join(tmp_dir, "index.json")
+        start = time.perf_counter()
+        stats = build_zip_index(zip_files, index_path)
+        print(f"indexed {stats['meshes']} meshes of {len(zip_files)} archives in {time.perf_counter() - start:.3f}s")
+        zip_dataset = ShapenetDataset(args.data_dir, zip_index_path=index_path)
+        rng = np.random.default_rng(0)
+        zip_indices = rng.permutation(len(zip_dataset))[:1000]
+        obj_files = [mesh_files[i % len(mesh_files)] for i in range(len(zip_indices))]
+
+        def _obj_files() -> None:
+            for obj_file in obj_files:
+                with open(obj_file, "rb") as f:
+                    f.read()
+
+        def _zipfile() -> None:
+            archives = {zip_file: zipfile.ZipFile(zip_file) for zip_file in zip_files}
+            for idx in zip_indices:
+                mesh_file = zip_dataset.all_files[idx]
+                zip_file = mesh_file[: mesh_file.index(".zip") + 4]
+                archives[zip_file].read(mesh_file[len(zip_file) + 1 :])
+
+        def _indexed() -> None:
+            for idx in zip_indices:
+                zip_dataset.zip_archives.read(zip_dataset.all_files[idx])
+
+        print(f"{'reads':>14} {'meshes/s':>10}")
+        for name, fn in [("obj files", _obj_files), ("zipfile", _zipfile), ("indexed zip", _indexed)]:
+            print(f"{name:>14} {len(zip_indices) / time_call(fn, args.repeats):>10.1f}")
+
+
+BENCHMARKS = {
+    "collate": benchmark_collate,
+    "compact_dtypes": benchmark_compact_dtypes,
+    "dataloader_workers": benchmark_dataloader_workers,
+    "feature_store": benchmark_feature_store,
+    "image_decode": benchmark_image_decode,
+    "mesh_lru": benchmark_mesh_lru,
+    "mesh_shards": benchmark_mesh_shards,
+    "batch_sampler": benchmark_batch_sampler,
+    "manifest": benchmark_manifest,
+    "mesh_store": benchmark_mesh_store,
+    "quantize_process_mesh": benchmark_quantize_process_mesh,
+    "random_shift": benchmark_random_shift,
+    "read_obj": benchmark_read_obj,
+    "zip_archives": benchmark_zip_archives,
+}
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--mesh-files", nargs="+", default=DEFAULT_MESH_FILES)
+    parser.add_argument("--data-dir", default="image_meshes/")
+    parser.add_argument("--quantization-bits", type=int, default=8)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--grid-size", type=int, default=200)
+    parser.add_argument("--num-workers", type=int, default=2)
+    parser.add_argument("--num-repeats", type=int, default=500)
+    parser.add_argument("--image-size", type=int, default=1024)
+    args = parser.parse_args(argv)
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,502 @@
+"""
+Benchmarks for autoregressive sampling of the vertex and face models.
+
+Unless noted otherwise, benchmarks run on randomly initialized models, so sampling
+is forced to run to `max_sample_length` by masking the stop token. Run a benchmark from the
+repository root (with the package installed through `pip install -e .`) with:
+
+    python benchmarks/benchmark_sampling.py <benchmark_name> [--device cpu]
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import resource
+import time
+from typing import Callable, Dict, List
+
+import torch
+
+from polygen.modules.data_modules import CollateMethod, PolygenDataModule
+from polygen.modules.face_model import FaceModel
+from polygen.modules.generation_engine import GenerationEngine, GenerationRequest
+from polygen.modules.polygen_decoder import TransformerDecoder
+from polygen.modules.utils import filter_logits, gumbel_max_sample, top_k_logits, top_p_logits
+from polygen.modules.vertex_model import VertexModel
+
+DECODER_CONFIG = {
+    "hidden_size": 256,
+    "fc_size": 1024,
+    "num_layers": 6,
+    "dropout_rate": 0.0,
+}
+
+
+def load_models(device: str, mask_stop_token: bool = True) -> Dict[str, torch.nn.Module]:
+    """Creates randomly initialized vertex and face models in eval mode
+
+    Args:
+        device: Device the models are moved to
+        mask_stop_token: Whether sampling is forced to run to max_sample_length
+
+    Returns:
+        models: Dictionary with a vertex model and a face model
+    """
+    vertex_model = VertexModel(
+        decoder_config=DECODER_CONFIG,
+        quantization_bits=8,
+        class_conditional=True,
+        num_classes=4,
+        max_num_input_verts=800,
+    )
+    face_model = FaceModel(
+        encoder_config=DECODER_CONFIG,
+        decoder_config=DECODER_CONFIG,
+        class_conditional=False,
+        max_seq_length=3000,
+    )
+    models = {"vertex_model": vertex_model, "face_model": face_model}
+    for model in models.values():
+        model.to(device)
+        model.eval()
+        if mask_stop_token:
+            disable_stop_token(model)
+    return models
+
+
+def disable_stop_token(model: torch.nn.Module) -> None:
+    """Masks the stop token so that sampling always runs to max_sample_length
+
+    Args:
+        model: Vertex model or face model whose _create_dist method gets wrapped
+    """
+    create_dist = model._create_dist
+
+    def _create_dist_without_stop(*args, **kwargs) -> torch.Tensor:
+        logits = create_dist(*args, **kwargs)
+        logits[..., 0] = -1e9
+        return logits
+
+    model._create_dist = _create_dist_without_stop
+
+
+def face_model_context(num_samples: int, num_vertices: int, device: str) -> Dict[str, torch.Tensor]:
+    """Random vertices used to condition the face model
+
+    Args:
+        num_samples: Batch size
+        num_vertices: Number of vertices in every sample
+        device: Device of the returned tensors
+
+    Returns:
+        context: Dictionary with vertices and vertices_mask
+    """
+    return {
+        "vertices": torch.rand([num_samples, num_vertices, 3], device=device) - 0.5,
+        "vertices_mask": torch.ones([num_samples, num_vertices], device=device),
+    }
+
+
+def time_call(fn: Callable[[], None], repeats: int = 1) -> float:
+    """Returns the best wall clock time of fn over several repeats"""
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def benchmark_decoder_cache(args: argparse.Namespace) -> None:
+    """Tokens/sec of a bare TransformerDecoder with the raw input cache and the projected cache"""
+    decoder = TransformerDecoder(**DECODER_CONFIG).to(args.device).eval()
+    print(f"{'length':>8} {'raw cache tok/s':>16} {'projected tok/s':>16} {'speedup':>8}")
+    for length in args.lengths:
+        inputs = torch.randn([length, args.batch_size, DECODER_CONFIG["hidden_size"]], device=args.device)
+        results = []
+        for projected in [False, True]:
+
+            def _decode() -> None:
+                cache = decoder.initialize_cache(args.batch_size, projected=projected)
+                for i in range(length):
+                    decoder(inputs[i : i + 1], cache=cache)
+
+            with torch.no_grad():
+                elapsed = time_call(_decode, args.repeats)
+            results.append(length * args.batch_size / elapsed)
+        print(f"{length:>8} {results[0]:>16.1f} {results[1]:>16.1f} {results[1] / results[0]:>7.2f}x")
+
+
+def benchmark_sample_throughput(args: argparse.Namespace) -> None:
+    """Tokens/sec of VertexModel.sample and FaceModel.sample against sequence length"""
+    models = load_models(args.device)
+    vertex_model, face_model = models["vertex_model"], models["face_model"]
+    class_labels = torch.zeros([args.batch_size], dtype=torch.int64, device=args.device)
+    print(f"{'model':>12} {'tokens':>8} {'seconds':>9} {'tok/s':>10}")
+    for length in args.lengths:
+        num_vertices = max(length // 3, 1)
+
+        def _sample_vertices() -> None:
+            vertex_model.sample(
+                num_samples=args.batch_size,
+                context={"class_label": class_labels},
+                max_sample_length=num_vertices,
+                only_return_complete=False,
+            )
+
+        with torch.no_grad():
+            elapsed = time_call(_sample_vertices, args.repeats)
+        tokens = (num_vertices * 3 + 1) * args.batch_size
+        print(f"{'vertex':>12} {num_vertices * 3 + 1:>8} {elapsed:>9.3f} {tokens / elapsed:>10.1f}")
+
+        context = face_model_context(args.batch_size, 100, args.device)
+
+        def _sample_faces() -> None:
+            face_model.sample(context=dict(context), max_sample_length=length, only_return_complete=False)
+
+        with torch.no_grad():
+            elapsed = time_call(_sample_faces, args.repeats)
+        tokens = length * args.batch_size
+        print(f"{'face':>12} {length:>8} {elapsed:>9.3f} {tokens / elapsed:>10.1f}")
+
+
+def _decode_with_cache_mode(mode: str, length: int, batch_size: int, device: str) -> Dict[str, float]:
+    """Runs a decoding loop in the current process and measures its latency and memory high-water mark
+
+    Args:
+        mode: "raw" grows a cache of raw inputs and the token tensor with torch.cat (the original sampling loop),
+              "projected" grows a projected cache, "preallocated" writes into buffers allocated once
+        length: Number of decoding steps
+        batch_size: Number of sequences decoded together
+        device: Device used for decoding
+
+    Returns:
+        stats: Latency in seconds and peak memory growth in megabytes during the loop
+    """
+    torch.manual_seed(0)
+    decoder = TransformerDecoder(**DECODER_CONFIG).to(device).eval()
+    inputs = torch.randn([1, batch_size, DECODER_CONFIG["hidden_size"]], device=device)
+    use_cuda = torch.device(device).type == "cuda"
+    if use_cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        baseline = torch.cuda.memory_allocated()
+    else:
+        baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    start = time.perf_counter()
+    with torch.no_grad():
+        if mode == "preallocated":
+            cache = decoder.initialize_cache(batch_size, projected=True, max_length=length)
+            tokens = torch.zeros([batch_size, length], dtype=torch.int32, device=device)
+        else:
+            cache = decoder.initialize_cache(batch_size, projected=mode == "projected")
+            tokens = torch.zeros([batch_size, 0], dtype=torch.int32, device=device)
+        for i in range(length):
+            outputs = decoder(inputs, cache=cache)
+            next_token = torch.argmax(outputs[-1], dim=-1).to(torch.int32)
+            if mode == "preallocated":
+                tokens[:, i] = next_token
+            else:
+                tokens = torch.cat([tokens, next_token[:, None]], dim=1)
+    if use_cuda:
+        torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated()
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return {"seconds": time.perf_counter() - start, "peak_mb": (peak - baseline) / 2 ** 20}
+
+
+def benchmark_decode_allocation(args: argparse.Namespace) -> None:
+    """Latency and memory high-water mark of growing caches against preallocated buffers
+
+    Every configuration runs in a fresh process because the resident set size high-water mark on CPU never decreases.
+    """
+    context = multiprocessing.get_context("spawn")
+    modes = ["raw", "projected", "preallocated"]
+    print(f"{'length':>8} " + " ".join(f"{mode + ' s':>16} {mode + ' MB':>16}" for mode in modes))
+    for length in args.lengths:
+        row = []
+        for mode in modes:
+            with context.Pool(1) as pool:
+                stats = pool.apply(_decode_with_cache_mode, (mode, length, args.batch_size, args.device))
+            row.append(f"{stats['seconds']:>16.3f} {stats['peak_mb']:>16.1f}")
+        print(f"{length:>8} " + " ".join(row))
+
+
+def benchmark_face_batch_scaling(args: argparse.Namespace) -> None:
+    """Training steps/sec and sampling tokens/sec of the face model against batch size"""
+    face_model = load_models(args.device)["face_model"]
+    optimizer = face_model.configure_optimizers()["optimizer"]
+    num_vertices, num_faces, sample_length = 200, 800, 200
+    print(f"{'batch':>6} {'train steps/s':>14} {'train tok/s':>12} {'sample tok/s':>13}")
+    for batch_size in args.batch_sizes:
+        batch = face_model_context(batch_size, num_vertices, args.device)
+        batch["faces"] = torch.randint(0, num_vertices + 2, [batch_size, num_faces], device=args.device)
+        batch["faces_mask"] = torch.ones([batch_size, num_faces], device=args.device)
+
+        def _train_step() -> None:
+            face_model.train()
+            optimizer.zero_grad()
+            # Same loss as FaceModel.training_step, without logging outside of a Trainer
+            logits = face_model(batch)
+            log_probs = torch.distributions.categorical.Categorical(logits=logits).log_prob(batch["faces"])
+            loss = -torch.sum(log_probs * batch["faces_mask"])
+            loss.backward()
+            optimizer.step()
+
+        _train_step()  # warm up
+        train_elapsed = time_call(_train_step, args.repeats)
+
+        face_model.eval()
+        context = face_model_context(batch_size, num_vertices, args.device)
+
+        def _sample() -> None:
+            face_model.sample(context=dict(context), max_sample_length=sample_length, only_return_complete=False)
+
+        with torch.no_grad():
+            sample_elapsed = time_call(_sample, args.repeats)
+        print(
+            f"{batch_size:>6} {1 / train_elapsed:>14.2f} {batch_size * num_faces / train_elapsed:>12.1f} "
+            f"{batch_size * sample_length / sample_elapsed:>13.1f}"
+        )
+
+
+def count_decoded_rows(model: torch.nn.Module) -> Dict[str, int]:
+    """Counts the batch rows and decoding steps that go through the decoder of a model
+
+    Args:
+        model: Vertex model or face model whose decoder forward method gets wrapped
+
+    Returns:
+        counts: Dictionary with the running number of decoded rows and decoder calls
+    """
+    counts = {"rows": 0, "steps": 0}
+    forward = model.decoder.forward
+
+    def _counting_forward(inputs: torch.Tensor, *args, **kwargs) -> torch.Tensor:
+        counts["rows"] += inputs.shape[1]
+        counts["steps"] += 1
+        return forward(inputs, *args, **kwargs)
+
+    model.decoder.forward = _counting_forward
+    return counts
+
+
+def benchmark_sampling_waste(args: argparse.Namespace) -> None:
+    """Decoder row-steps spent with finished rows dropped from the batch against running the whole batch to the end
+
+    Samples are conditioned on the meshes in image_meshes/. The stop token is not masked, so rows finish at different
+    steps; load trained weights through --vertex-checkpoint and --face-checkpoint for realistic sequence lengths.
+    """
+    models = load_models(args.device, mask_stop_token=False)
+    vertex_model, face_model = models["vertex_model"], models["face_model"]
+    for model, checkpoint in [(vertex_model, args.vertex_checkpoint), (face_model, args.face_checkpoint)]:
+        if checkpoint is not None:
+            model.load_state_dict(torch.load(checkpoint, map_location=args.device)["state_dict"])
+
+    vertex_counts = count_decoded_rows(vertex_model)
+    face_counts = count_decoded_rows(face_model)
+    data_modules = [
+        PolygenDataModule(
+            data_dir=args.data_dir,
+            collate_method=collate_method,
+            batch_size=args.batch_size,
+            training_split=1.0,
+            val_split=0.0,
+            apply_random_shift_vertices=False,
+            apply_random_shift_faces=False,
+            shuffle_vertices=False,
+        )
+        for collate_method in [CollateMethod.VERTICES, CollateMethod.FACES]
+    ]
+    for data_module in data_modules:
+        data_module.setup()
+
+    # Without compaction every decoder call of a sample call runs on the full batch
+    full_batch_rows = {"vertex": 0, "face": 0}
+    with torch.no_grad():
+        for vertex_batch, face_batch in zip(*[data_module.train_dataloader() for data_module in data_modules]):
+            batch_size = vertex_batch["class_label"].shape[0]
+            steps = vertex_counts["steps"]
+            vertex_model.sample(
+                num_samples=batch_size,
+                context={"class_label": vertex_batch["class_label"].to(args.device)},
+                max_sample_length=args.lengths[0],
+                only_return_complete=False,
+            )
+            full_batch_rows["vertex"] += batch_size * (vertex_counts["steps"] - steps)
+
+            steps = face_counts["steps"]
+            face_model.sample(
+                context={
+                    "vertices": face_batch["vertices"].to(args.device),
+                    "vertices_mask": face_batch["vertices_mask"].to(args.device),
+                },
+                max_sample_length=args.lengths[0] * 3,
+                only_return_complete=False,
+            )
+            full_batch_rows["face"] += face_batch["vertices"].shape[0] * (face_counts["steps"] - steps)
+
+    print(f"{'model':>8} {'active row-steps':>17} {'full batch row-steps':>21} {'saved':>7}")
+    for name, counts in [("vertex", vertex_counts), ("face", face_counts)]:
+        saved = 1 - counts["rows"] / max(full_batch_rows[name], 1)
+        print(f"{name:>8} {counts['rows']:>17} {full_batch_rows[name]:>21} {saved:>7.1%}")
+
+
+def benchmark_continuous_batching(args: argparse.Namespace) -> None:
+    """Latency and tokens/sec of a stream of vertex model requests with continuous batching against static batches
+
+    Every request asks for a random class label and a random max_sample_length of --lengths tokens. Static batching samples
+    --batch-size requests at a time with VertexModel.sample and the largest max_sample_length of the batch. The stop token is
+    not masked; load trained weights through --vertex-checkpoint for realistic sequence lengths.
+    """
+    vertex_model = load_models(args.device, mask_stop_token=False)["vertex_model"]
+    if args.vertex_checkpoint is not None:
+        vertex_model.load_state_dict(torch.load(args.vertex_checkpoint, map_location=args.device)["state_dict"])
+    rng = random.Random(0)
+    max_num_vertices = [max(length // 3, 1) for length in args.lengths]
+    request_specs = [(rng.randrange(vertex_model.num_classes), rng.choice(max_num_vertices)) for _ in range(args.num_requests)]
+
+    engine = GenerationEngine(vertex_model, max_batch_size=args.batch_size, max_sample_length=max(max_num_vertices))
+    start = time.perf_counter()
+    results = engine.run(
+        [GenerationRequest({"class_label": torch.tensor([label])}, length) for label, length in request_specs]
+    )
+    engine_elapsed = time.perf_counter() - start
+    engine_latencies = sorted(result["latency"] for result in results)
+    engine_tokens = sum(result["num_tokens"] for result in results)
+
+    static_latencies, static_tokens = [], 0
+    start = time.perf_counter()
+    with torch.no_grad():
+        for i in range(0, len(request_specs), args.batch_size):
+            batch_specs = request_specs[i : i + args.batch_size]
+            samples = vertex_model.sample(
+                num_samples=len(batch_specs),
+                context={"class_label": torch.tensor([label for label, _ in batch_specs], device=args.device)},
+                max_sample_length=max(length for _, length in batch_specs),
+                only_return_complete=False,
+            )
+            # Every request of a static batch waits for the whole batch, and all requests were submitted at the start
+            static_latencies += [time.perf_counter() - start] * len(batch_specs)
+            static_tokens += int(torch.sum(samples["num_vertices"] * 3 + samples["completed"].to(torch.int64)))
+    static_elapsed = time.perf_counter() - start
+    static_latencies.sort()
+
+    print(f"{'scheduler':>12} {'requests':>9} {'tok/s':>10} {'p50 latency':>12} {'p90 latency':>12}")
+    for name, latencies, tokens, elapsed in [
+        ("continuous", engine_latencies, engine_tokens, engine_elapsed),
+        ("static", static_latencies, static_tokens, static_elapsed),
+    ]:
+        p50, p90 = latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.9)]
+        print(f"{name:>12} {len(latencies):>9} {tokens / elapsed:>10.1f} {p50:>12.3f} {p90:>12.3f}")
+
+
+def benchmark_sampler(args: argparse.Namespace) -> None:
+    """Microseconds per sampling step of Categorical with top_k_logits/top_p_logits against filter_logits with Gumbel-max"""
+    print(f"{'batch':>6} {'vocab':>6} {'top_k':>6} {'top_p':>6} {'categorical us':>15} {'gumbel us':>10} {'speedup':>8}")
+    settings = [(0, 1.0), (50, 1.0), (0, 0.9), (50, 0.9)]
+    for batch_size in args.batch_sizes:
+        for vocab_size in [257, 2000]:
+            logits = torch.randn([batch_size, 1, vocab_size], device=args.device)
+            for top_k, top_p in settings:
+
+                def _categorical() -> None:
+                    filtered = top_p_logits(top_k_logits(logits, top_k), top_p)
+                    torch.distributions.categorical.Categorical(logits=filtered[:, -1]).sample()
+
+                def _gumbel() -> None:
+                    gumbel_max_sample(filter_logits(logits, top_k, top_p)[:, -1])
+
+                timings = []
+                for fn in [_categorical, _gumbel]:
+                    fn()  # warm up
+                    timings.append(time_call(lambda: [fn() for _ in range(100)], args.repeats) / 100 * 1e6)
+                print(
+                    f"{batch_size:>6} {vocab_size:>6} {top_k:>6} {top_p:>6} {timings[0]:>15.1f} {timings[1]:>10.1f} "
+                    f"{timings[0] / timings[1]:>7.2f}x"
+                )
+
+
+def benchmark_stop_check_interval(args: argparse.Namespace) -> None:
+    """Tokens/sec of VertexModel.sample and FaceModel.sample against the number of steps between stop token checks
+
+    Every run is recorded with torch.profiler, which counts the host synchronizations (aten::_local_scalar_dense and
+    aten::nonzero calls) of the sampling loop. With --trace-dir, a Chrome trace of every run is written for inspection in
+    chrome://tracing or Perfetto.
+    """
+    models = load_models(args.device)
+    vertex_model, face_model = models["vertex_model"], models["face_model"]
+    class_labels = torch.zeros([args.batch_size], dtype=torch.int64, device=args.device)
+    context = face_model_context(args.batch_size, 100, args.device)
+    length = args.lengths[0]
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.device(args.device).type == "cuda":
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+    print(f"{'model':>8} {'interval':>9} {'tok/s':>10} {'syncs':>7}")
+    for interval in args.stop_check_intervals:
+        runs = {
+            "vertex": lambda: vertex_model.sample(
+                num_samples=args.batch_size,
+                context={"class_label": class_labels},
+                max_sample_length=max(length // 3, 1),
+                only_return_complete=False,
+                stop_check_interval=interval,
+            ),
+            "face": lambda: face_model.sample(
+                context=dict(context), max_sample_length=length, only_return_complete=False, stop_check_interval=interval
+            ),
+        }
+        for name, run in runs.items():
+            with torch.no_grad():
+                run()  # warm up
+                with torch.profiler.profile(activities=activities) as profiler:
+                    start = time.perf_counter()
+                    run()
+                    elapsed = time.perf_counter() - start
+            syncs = sum(
+                event.count
+                for event in profiler.key_averages()
+                if event.key in ("aten::_local_scalar_dense", "aten::nonzero")
+            )
+            if args.trace_dir is not None:
+                os.makedirs(args.trace_dir, exist_ok=True)
+                profiler.export_chrome_trace(os.path.join(args.trace_dir, f"{name}_interval_{interval}.json"))
+            tokens = (max(length // 3, 1) * 3 + 1 if name == "vertex" else length) * args.batch_size
+            print(f"{name:>8} {interval:>9} {tokens / elapsed:>10.1f} {syncs:>7}")
+
+
+BENCHMARKS = {
+    "continuous_batching": benchmark_continuous_batching,
+    "decode_allocation": benchmark_decode_allocation,
+    "decoder_cache": benchmark_decoder_cache,
+    "face_batch_scaling": benchmark_face_batch_scaling,
+    "sample_throughput": benchmark_sample_throughput,
+    "sampler": benchmark_sampler,
+    "sampling_waste": benchmark_sampling_waste,
+    "stop_check_interval": benchmark_stop_check_interval,
+}
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--lengths", type=int, nargs="+", default=[150, 300, 600, 1200, 2400])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32, 64])
+    parser.add_argument("--repeats", type=int, default=1)
+    parser.add_argument("--num-requests", type=int, default=32)
+    parser.add_argument("--stop-check-intervals", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--trace-dir", default=None)
+    parser.add_argument("--data-dir", default="image_meshes/")
+    parser.add_argument("--vertex-checkpoint", default=None)
+    parser.add_argument("--face-checkpoint", default=None)
+    args = parser.parse_args(argv)
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    main()
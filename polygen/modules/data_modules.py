@@ -1,13 +1,19 @@
 from enum import Enum
 import glob
+import io
+import json
+import math
 import os
 import pdb
 import random
-from typing import List, Dict, Optional
+from typing import Any, Iterator, List, Dict, Optional, Tuple, Union
 
+import numpy as np
 import torch
+import torch.nn as nn
+import torch.distributed as dist
 import torch.nn.functional as F
-from torch.utils.data import Dataset, DataLoader, random_split
+from torch.utils.data import Dataset, DataLoader, IterableDataset, get_worker_info, random_split
 from torchvision.io import read_image
 import torchvision.transforms as T
 # from pytorch3d.io import load_obj
@@ -15,6 +21,28 @@ import pytorch_lightning as pl
 from PIL import Image
 
 import polygen.utils.data_utils as data_utils
+from polygen.utils.batch_sampler import TokenBudgetBatchSampler
+from polygen.utils.feature_store import FeatureStore, open_feature_store
+from polygen.utils.image_store import ImageStore, load_image_uint8
+from polygen.utils.manifest import Manifest, select_lengths
+from polygen.utils.mesh_cache import MeshCache, MeshLRU
+from polygen.utils.mesh_shards import decode_array, iterate_shard, load_shard_index
+from polygen.utils.mesh_store import MeshStore
+from polygen.utils.shared_memory import SharedMeshes, StringArray, preload_meshes
+from polygen.utils.zip_index import ZipMeshArchives
+
+
+def shapenet_label_dict(mesh_files: List[str]) -> Dict[str, int]:
+    """Numbers the ShapeNet categories of .obj files in sorted order
+
+    Args:
+        mesh_files: Paths to model_normalized.obj files, whose category folder is fourth from the end
+
+    Returns:
+        label_dict: Mapping from category folder to class label, the same for extracted directories and zip archives
+    """
+    categories = sorted(set(mesh_file.split("/")[-4] for mesh_file in mesh_files))
+    return {category: i for i, category in enumerate(categories)}
 
 
 class ShapenetDataset(Dataset):
@@ -24,70 +52,319 @@ class ShapenetDataset(Dataset):
         default_shapenet: bool = True,
         all_files: Optional[List[str]] = None,
         label_dict: Dict[str, int] = None,
+        quantization_bits: int = 8,
+        mesh_store_dir: Optional[str] = None,
+        mesh_cache_dir: Optional[str] = None,
+        manifest_path: Optional[str] = None,
+        max_num_input_verts: Optional[int] = None,
+        max_seq_length: Optional[int] = None,
+        compact_dtypes: bool = False,
+        shared_memory: bool = False,
+        zip_index_path: Optional[str] = None,
     ) -> None:
         """
         Args:
             training_dir: Root folder of shapenet dataset
+            default_shapenet: Whether or not we are using the default shapenet data structure
+            all_files: List of all .obj files (needs to be provided if default_shapnet = false)
+            label_dict: Mapping of .obj file to class label (needs to be provided if default_shapnet = false)
+            quantization_bits: How many bits we are using to quantize the vertices
+            mesh_store_dir: Directory of a mesh store built with polygen.utils.mesh_store. If provided, meshes are
+                served from the store instead of being read from training_dir.
+            mesh_cache_dir: Directory of a content-hashed cache of preprocessed meshes, see polygen.utils.mesh_cache
+            manifest_path: Manifest built with polygen.utils.manifest. If provided, the .obj files and class labels
+                are read from it instead of globbing training_dir.
+            max_num_input_verts: Meshes with more vertices are left out, requires a manifest or a mesh store
+            max_seq_length: Meshes with longer flattened faces are left out, requires a manifest or a mesh store
+            compact_dtypes: Whether to return uint8 or int16 vertices and int16 faces where they fit instead of int32
+            shared_memory: Whether to keep paths and labels in NumPy arrays and preload the processed meshes into shared
+                memory, so that DataLoader workers share them instead of copying them. Meshes of a mesh store are
+                shared through its memory maps and are not preloaded.
+            zip_index_path: Index of ShapeNet zip archives built with polygen.utils.zip_index. If provided, meshes are
+                read from the archives by offset instead of globbing the extracted training_dir.
         """
         self.training_dir = training_dir
         self.default_shapenet = default_shapenet
-        if default_shapenet:
+        self.quantization_bits = quantization_bits
+        self.compact_dtypes = compact_dtypes
+        self.mesh_store = None
+        self.mesh_cache = MeshCache(mesh_cache_dir, quantization_bits) if mesh_cache_dir is not None else None
+        # Number of vertices and flattened face length of every mesh, known without opening it from a manifest or store
+        self.num_vertices = None
+        self.face_lengths = None
+        self.zip_archives = None
+        if zip_index_path is not None:
+            if mesh_store_dir is not None or manifest_path is not None or mesh_cache_dir is not None or shared_memory:
+                raise ValueError("Zip archives cannot be combined with a mesh store, manifest, cache or shared memory")
+            self.zip_archives = ZipMeshArchives(zip_index_path)
+            self.all_files = self.zip_archives.mesh_files
+            # Categories are the folders of the members, the same as the folders of an extracted copy
+            self.label_dict = shapenet_label_dict(self.all_files)
+            self.default_shapenet = True
+        elif mesh_store_dir is not None:
+            self.mesh_store = MeshStore(mesh_store_dir)
+            if self.mesh_store.quantization_bits != quantization_bits:
+                raise ValueError(
+                    f"Mesh store {mesh_store_dir} uses {self.mesh_store.quantization_bits} quantization bits, "
+                    f"not {quantization_bits}"
+                )
+            self.all_files = self.mesh_store.mesh_files
+            self.label_dict = self.mesh_store.meta["label_dict"]
+            self.num_vertices = self.mesh_store.lengths[:, 0]
+            self.face_lengths = self.mesh_store.lengths[:, 1]
+        elif manifest_path is not None:
+            manifest = load_manifest(manifest_path, quantization_bits)
+            self.all_files = manifest.mesh_files
+            self.label_dict = manifest.label_dict
+            self.num_vertices = manifest.num_vertices
+            self.face_lengths = manifest.face_lengths
+        elif default_shapenet:
             self.all_files = glob.glob(f"{self.training_dir}/*/*/models/model_normalized.obj")
-            self.label_dict = {}
-            for i, class_label in enumerate(os.listdir(training_dir)):
-                self.label_dict[class_label] = i
+            self.label_dict = shapenet_label_dict(self.all_files)
         else:
             self.all_files = all_files
             self.label_dict = label_dict
 
+        # Positions of the meshes within the length limits in all_files, or in the store
+        self.indices = None
+        if max_num_input_verts is not None or max_seq_length is not None:
+            if self.num_vertices is None:
+                raise ValueError("Filtering meshes by length requires a manifest_path or a mesh_store_dir")
+            self.indices = select_lengths(self.num_vertices, self.face_lengths, max_num_input_verts, max_seq_length)
+            self.all_files = [self.all_files[i] for i in self.indices]
+            self.num_vertices = self.num_vertices[self.indices]
+            self.face_lengths = self.face_lengths[self.indices]
+
+        self.shared_meshes = None
+        self.class_labels = None
+        if shared_memory:
+            if self.mesh_store is None:
+                self.shared_meshes = SharedMeshes(pack_meshes(self.all_files, quantization_bits, self.mesh_cache))
+                self.class_labels = np.array([self.class_label(mesh_file) for mesh_file in self.all_files])
+            self.all_files = StringArray(self.all_files)
+
     def __len__(self) -> int:
         """Returns number of 3D objects"""
         return len(self.all_files)
 
+    def class_label(self, mesh_file: str) -> int:
+        """Returns the class label of an .obj file"""
+        if self.default_shapenet:
+            return self.label_dict[mesh_file.split("/")[-4]]
+        else:
+            return self.label_dict[mesh_file]
+
     def __getitem__(self, idx: int) -> Dict[str, torch.Tensor]:
         """Returns processed vertices, faces and class label of a mesh
         Args:
             idx: Which 3D object we're retrieving
         Returns:
-            mesh_dict: Dictionary containing vertices, faces and class label
+            mesh_dict: Dictionary containing vertices, faces, class label and the index of the mesh
         """
+        if self.mesh_store is not None:
+            mesh = self.mesh_store[idx if self.indices is None else int(self.indices[idx])]
+            vertices, faces = unpack_mesh(mesh["vertices"], mesh["faces"], self.quantization_bits, self.compact_dtypes)
+            return {"vertices": vertices, "faces": faces, "class_label": mesh["class_label"], "index": idx}
+        if self.shared_meshes is not None:
+            vertices, faces = unpack_mesh(*self.shared_meshes[idx], self.quantization_bits, self.compact_dtypes)
+            return {"vertices": vertices, "faces": faces, "class_label": int(self.class_labels[idx]), "index": idx}
+
         mesh_file = self.all_files[idx]
-        # vertices, faces, _ = load_obj(mesh_file)
-        vertices, faces = data_utils.read_obj(mesh_file)
-        vertices  = torch.from_numpy(vertices)
-        # faces = faces.verts_idx
-        vertices = vertices[:, [2, 0, 1]]
-        vertices = data_utils.center_vertices(vertices)
-        vertices = data_utils.normalize_vertices_scale(vertices)
-        vertices, faces, _ = data_utils.quantize_process_mesh(vertices, faces)
-        faces = data_utils.flatten_faces(faces)
-        vertices = vertices.to(torch.int32)
-        faces = faces.to(torch.int32)
-        if self.default_shapenet:
-            class_label = self.label_dict[mesh_file.split("/")[-4]]
+        if self.zip_archives is not None:
+            vertices, faces = data_utils.process_mesh_bytes(self.zip_archives.read(mesh_file), self.quantization_bits)
+        elif self.mesh_cache is not None:
+            vertices, faces = self.mesh_cache.load_process_mesh(mesh_file)
         else:
-            class_label = self.label_dict[mesh_file]
-        mesh_dict = {"vertices": vertices, "faces": faces, "class_label": class_label}
+            vertices, faces = data_utils.load_process_mesh(mesh_file, self.quantization_bits)
+        if self.compact_dtypes:
+            vertices, faces = data_utils.compact_mesh(vertices, faces, self.quantization_bits)
+        mesh_dict = {"vertices": vertices, "faces": faces, "class_label": self.class_label(mesh_file), "index": idx}
         return mesh_dict
 
 
+def pack_meshes(
+    mesh_files: List[str], quantization_bits: int, mesh_cache: Optional[MeshCache] = None
+) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+    """Processes .obj files for shared memory, through the mesh cache if there is one and a process pool otherwise
+
+    Returns:
+        meshes: Vertices packed into the smallest dtype that holds them and int32 flattened faces of every file
+    """
+    if mesh_cache is not None:
+        meshes = [mesh_cache.load_process_mesh(mesh_file) for mesh_file in mesh_files]
+    else:
+        meshes = preload_meshes(mesh_files, quantization_bits)
+    vertex_dtype = data_utils.compact_vertex_dtype(quantization_bits)
+    return [(vertices.to(vertex_dtype), faces) for vertices, faces in meshes]
+
+
+def unpack_mesh(
+    vertices: Union[np.ndarray, torch.Tensor],
+    faces: Union[np.ndarray, torch.Tensor],
+    quantization_bits: int,
+    compact_dtypes: bool,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Converts packed vertices and faces of a mesh store or shared memory to the dtypes of a dataset"""
+    vertices, faces = torch.as_tensor(vertices), torch.as_tensor(faces)
+    if compact_dtypes:
+        # Vertices stay views of the store or shared memory when they are packed as uint8
+        return data_utils.compact_mesh(vertices, faces, quantization_bits)
+    # Faces stay views of the store or shared memory, vertices are widened from the packed dtype
+    return vertices.to(torch.int32), faces
+
+
+def load_manifest(manifest_path: str, quantization_bits: int) -> Manifest:
+    """Loads a manifest and checks that it was built with the same quantization bits as the dataset"""
+    manifest = Manifest.load(manifest_path)
+    if manifest.quantization_bits != quantization_bits:
+        raise ValueError(
+            f"Manifest {manifest_path} uses {manifest.quantization_bits} quantization bits, not {quantization_bits}"
+        )
+    return manifest
+
+
 class ImageDataset(Dataset):
-    def __init__(self, training_dir: str, image_extension: str = "jpeg") -> None:
+    def __init__(
+        self,
+        training_dir: str,
+        image_extension: str = "jpeg",
+        quantization_bits: int = 8,
+        mesh_cache_dir: Optional[str] = None,
+        manifest_path: Optional[str] = None,
+        max_num_input_verts: Optional[int] = None,
+        max_seq_length: Optional[int] = None,
+        compact_dtypes: bool = False,
+        shared_memory: bool = False,
+        feature_store_dir: Optional[str] = None,
+        feature_backbone: Optional[nn.Module] = None,
+        max_cached_meshes: int = 0,
+        image_store_dir: Optional[str] = None,
+        fast_decode: bool = True,
+    ) -> None:
         """Initializes Image Dataset
 
         Args:
             training_dir: Where model files along with renderings are located
             image_extension: Whether it's a .png or .jpeg or other type of file
+            quantization_bits: How many bits we are using to quantize the vertices
+            mesh_cache_dir: Directory of a content-hashed cache of preprocessed meshes, see polygen.utils.mesh_cache
+            manifest_path: Manifest built with polygen.utils.manifest. If provided, the renderings are read from it
+                instead of globbing training_dir.
+            max_num_input_verts: Renderings of meshes with more vertices are left out, requires a manifest
+            max_seq_length: Renderings of meshes with a longer flattened face sequence are left out, requires a manifest
+            compact_dtypes: Whether to return uint8 or int16 vertices and int16 faces where they fit instead of int32,
+                and uint8 instead of float images
+            shared_memory: Whether to keep paths in NumPy arrays and preload the processed meshes into shared memory,
+                so that DataLoader workers share them instead of copying them
+            feature_store_dir: Directory of a feature store built with polygen.utils.feature_store. If provided,
+                elements hold the cached backbone features of the rendering under "image_features" instead of the
+                decoded image under "image".
+            feature_backbone: Frozen backbone the features are extracted with. If provided, the feature store is built
+                or rebuilt when it is missing renderings or was extracted with other weights.
+            max_cached_meshes: If positive, every process keeps this many processed meshes in a least recently used
+                cache keyed by model folder, so that the renderings of a model process its mesh once
+            image_store_dir: Directory of an image store built with polygen.utils.image_store. If provided, images are
+                read from it instead of decoding the renderings.
+            fast_decode: Whether to decode JPEGs at reduced size and resize renderings before converting them to
+                tensors, instead of converting the full-resolution rendering and resizing the tensor
         """
         self.training_dir = training_dir
-        self.images = glob.glob(f"{self.training_dir}/*/*/renderings/*.{image_extension}")
-
-        self.transforms = T.Compose([T.ToTensor(), T.Resize((256))])
+        self.quantization_bits = quantization_bits
+        self.compact_dtypes = compact_dtypes
+        self.mesh_cache = MeshCache(mesh_cache_dir, quantization_bits) if mesh_cache_dir is not None else None
+        self.mesh_lru = MeshLRU(max_cached_meshes) if max_cached_meshes > 0 else None
+        # Number of vertices and flattened face length of the mesh of every rendering, known from a manifest
+        self.num_vertices = None
+        self.face_lengths = None
+        if manifest_path is not None:
+            manifest = load_manifest(manifest_path, quantization_bits)
+            image_ids = np.arange(len(manifest.image_files))
+            if max_num_input_verts is not None or max_seq_length is not None:
+                selected = np.zeros(len(manifest), dtype=bool)
+                selected[manifest.select(max_num_input_verts, max_seq_length)] = True
+                image_ids = image_ids[selected[manifest.image_mesh_ids]]
+            self.images = [manifest.image_files[i] for i in image_ids]
+            mesh_ids = manifest.image_mesh_ids[image_ids]
+            self.num_vertices = manifest.num_vertices[mesh_ids]
+            self.face_lengths = manifest.face_lengths[mesh_ids]
+        elif max_num_input_verts is not None or max_seq_length is not None:
+            raise ValueError("Filtering renderings by mesh length requires a manifest_path")
+        else:
+            self.images = glob.glob(f"{self.training_dir}/*/*/renderings/*.{image_extension}")
+
+        self.image_size = 256
+        self.fast_decode = fast_decode
+        self.transforms = T.Compose([T.ToTensor(), T.Resize((self.image_size))])
+        self.image_store = None
+        self.image_store_ids = None
+        if image_store_dir is not None:
+            self.image_store = ImageStore(image_store_dir)
+            if self.image_store.size != self.image_size:
+                raise ValueError(
+                    f"Image store {image_store_dir} has size {self.image_store.size}, not {self.image_size}"
+                )
+            self.image_store_ids = self.image_store.indices(self.images)
+
+        self.feature_store = None
+        self.feature_ids = None
+        if feature_store_dir is not None:
+            if feature_backbone is not None:
+                self.feature_store = open_feature_store(
+                    feature_store_dir, self.images, feature_backbone, self.load_image
+                )
+            else:
+                self.feature_store = FeatureStore(feature_store_dir)
+            self.feature_ids = self.feature_store.indices(self.images)
+
+        self.shared_meshes = None
+        self.mesh_ids = None
+        if shared_memory:
+            # Every mesh is preloaded once, however many renderings it has
+            mesh_ids = {}
+            for img_file in self.images:
+                mesh_ids.setdefault(self.mesh_file(img_file), len(mesh_ids))
+            self.mesh_ids = np.array([mesh_ids[self.mesh_file(img_file)] for img_file in self.images], dtype=np.int64)
+            self.shared_meshes = SharedMeshes(pack_meshes(list(mesh_ids), quantization_bits, self.mesh_cache))
+            self.images = StringArray(self.images)
+
+    @staticmethod
+    def mesh_file(img_file: str) -> str:
+        """Path to the .obj file of a rendering"""
+        folder_path = "/".join(img_file.split("/")[:-2])
+        return os.path.sep.join([folder_path, "models", "model_normalized.obj"])
 
     def __len__(self) -> int:
         """How many renderings we have"""
         return len(self.images)
 
+    def load_mesh(self, model_file: str) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Processes the mesh of a model, through the mesh cache if there is one"""
+        if self.mesh_cache is not None:
+            vertices, faces = self.mesh_cache.load_process_mesh(model_file)
+        else:
+            vertices, faces = data_utils.load_process_mesh(model_file, self.quantization_bits)
+        if self.compact_dtypes:
+            vertices, faces = data_utils.compact_mesh(vertices, faces, self.quantization_bits)
+        return vertices, faces
+
+    def load_image(self, img_file: str) -> torch.Tensor:
+        """Decodes a rendering into an image tensor of shape [3, img_height, img_width] with values in [0, 1]"""
+        if self.fast_decode:
+            return load_image_uint8(img_file, self.image_size).to(torch.float32) / 255
+        img = Image.open(img_file).convert("RGB")
+        return self.transforms(img)
+
+    def image(self, idx: int, img_file: str) -> torch.Tensor:
+        """Returns the image of a rendering, uint8 if compact_dtypes is set and float in [0, 1] otherwise"""
+        if self.image_store is not None:
+            image = self.image_store[int(self.image_store_ids[idx])]
+        elif self.fast_decode:
+            image = load_image_uint8(img_file, self.image_size)
+        else:
+            # The slow path converts to float before resizing, so it is never narrowed back to uint8
+            return self.load_image(img_file)
+        return image if self.compact_dtypes else image.to(torch.float32) / 255
+
     def __getitem__(self, idx) -> Dict[str, torch.Tensor]:
         """Gets image object along with associated mesh
 
@@ -95,25 +372,192 @@ class ImageDataset(Dataset):
             idx: Index of image to retrieve
 
         Returns:
-            mesh_dict: Dictionary containing vertices, faces of .obj file and image tensor
+            mesh_dict: Dictionary containing vertices, faces of .obj file, image tensor or cached image features and the
+                index of the image
         """
         img_file = self.images[idx]
-        folder_path = "/".join(img_file.split("/")[:-2])
-        model_file = os.path.sep.join([folder_path, "models", "model_normalized.obj"])
-        # verts, faces, _ = load_obj(model_file)
-        verts, faces = data_utils.read_obj(model_file)
-        faces = faces.verts_idx
-        verts = verts[:, [2, 0, 1]]
-        vertices = data_utils.center_vertices(verts)
-        vertices = data_utils.normalize_vertices_scale(vertices)
-        vertices, faces, _ = data_utils.quantize_process_mesh(vertices, faces)
-        faces = data_utils.flatten_faces(faces)
-        img = Image.open(img_file).convert("RGB")
-        img = self.transforms(img)
-        mesh_dict = {"vertices": vertices, "faces": faces, "image": img}
+        if self.shared_meshes is not None:
+            vertices, faces = self.shared_meshes[int(self.mesh_ids[idx])]
+            vertices, faces = unpack_mesh(vertices, faces, self.quantization_bits, self.compact_dtypes)
+        elif self.mesh_lru is not None:
+            model_file = self.mesh_file(img_file)
+            # Renderings of a model share its folder, two levels above the .obj file
+            model_dir = os.path.dirname(os.path.dirname(model_file))
+            vertices, faces = self.mesh_lru.get(model_dir, lambda: self.load_mesh(model_file))
+        else:
+            vertices, faces = self.load_mesh(self.mesh_file(img_file))
+        mesh_dict = {"vertices": vertices, "faces": faces, "index": idx}
+        if self.feature_store is not None:
+            mesh_dict["image_features"] = self.feature_store[int(self.feature_ids[idx])]
+        else:
+            mesh_dict["image"] = self.image(idx, img_file)
         return mesh_dict
 
 
+class MeshShardDataset(IterableDataset):
+    # Number of DataLoader workers whose epochs are tracked
+    MAX_WORKERS = 256
+
+    def __init__(
+        self,
+        shards: List[Dict[str, Any]],
+        quantization_bits: int = 8,
+        compact_dtypes: bool = False,
+        shuffle: bool = True,
+        shuffle_buffer_size: int = 1000,
+        seed: int = 0,
+        num_replicas: Optional[int] = None,
+        rank: Optional[int] = None,
+        drop_last: bool = False,
+    ) -> None:
+        """Streams preprocessed meshes, and renderings if the shards hold them, from tar shards
+
+        Every epoch the shards are shuffled with the same seed on every rank, dealt out to the ranks, then to the
+        DataLoader workers of each rank, and read sequentially. Samples pass through a shuffle buffer of
+        shuffle_buffer_size samples, so that samples of different shards mix. Every rank yields the same number of
+        samples, ceil(num_samples / num_replicas) or floor with drop_last, which repeats or skips a few samples of
+        its shards, as ranks must take as many steps for the gradient synchronization.
+
+        Args:
+            shards: Shards built with polygen.utils.mesh_shards, as listed by load_shard_index
+            quantization_bits: How many bits the vertices of the shards are quantized with
+            compact_dtypes: Whether to return uint8 or int16 vertices, int16 faces and uint8 images where they fit
+            shuffle: Whether to shuffle the shards and samples every epoch
+            shuffle_buffer_size: Number of samples the shuffle buffer holds
+            seed: Seed of the shuffles, must be the same on every rank
+            num_replicas: Number of distributed processes, defaults to the world size
+            rank: Rank of this process, defaults to the current rank
+            drop_last: Whether to skip samples instead of repeating samples so that every rank gets as many
+        """
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+        if not 0 <= rank < num_replicas:
+            raise ValueError(f"Invalid rank {rank}, rank should be in the interval [0, {num_replicas - 1}]")
+        self.shards = shards
+        self.quantization_bits = quantization_bits
+        self.compact_dtypes = compact_dtypes
+        self.shuffle = shuffle
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        num_samples = sum(shard["num_samples"] for shard in shards)
+        if drop_last:
+            self.samples_per_rank = num_samples // num_replicas
+        else:
+            self.samples_per_rank = math.ceil(num_samples / num_replicas)
+        # Epoch of every worker, in shared memory so that workers started for the next epoch see it. Each worker
+        # iterates the dataset once per epoch and only advances its own epoch, so the workers never race.
+        self.epochs = torch.zeros(self.MAX_WORKERS, dtype=torch.int64).share_memory_()
+        # Mesh lengths are unknown without reading the shards
+        self.num_vertices = None
+        self.face_lengths = None
+
+    def set_epoch(self, epoch: int) -> None:
+        """Sets the epoch the shuffles of every worker are seeded with, for example to resume training"""
+        self.epochs.fill_(epoch)
+
+    def __len__(self) -> int:
+        """Number of samples this rank yields in an epoch"""
+        return self.samples_per_rank
+
+    def worker_shards(self, epoch: int, worker_id: int, num_workers: int) -> Tuple[List[int], int]:
+        """Plans the shards a worker reads in an epoch and how many samples it yields
+
+        Returns:
+            shard_ids: Shards of the worker, in reading order
+            num_samples: Number of samples the worker yields, reading its shards again if they hold fewer
+        """
+        rng = np.random.default_rng([self.seed, epoch])
+        order = rng.permutation(len(self.shards)) if self.shuffle else np.arange(len(self.shards))
+        rank_shards = order[self.rank :: self.num_replicas].tolist()
+        if not rank_shards:
+            # More ranks than shards, ranks share shards to still yield their samples
+            rank_shards = [int(order[self.rank % len(order)])] if len(order) else []
+        num_active_workers = min(num_workers, len(rank_shards))
+        if worker_id >= num_active_workers:
+            return [], 0
+        # The samples this rank needs beyond, or short of, its shards are spread over its workers
+        missing = self.samples_per_rank - sum(self.shards[i]["num_samples"] for i in rank_shards)
+        shard_ids = rank_shards[worker_id::num_active_workers]
+        num_samples = sum(self.shards[i]["num_samples"] for i in shard_ids)
+        num_samples += missing // num_active_workers + (worker_id < missing % num_active_workers)
+        return shard_ids, max(num_samples, 0)
+
+    def decode(self, sample: Dict[str, bytes]) -> Dict[str, Any]:
+        """Decodes the members of a sample into the elements of ShapenetDataset or ImageDataset"""
+        meta = json.loads(sample["json"])
+        vertices, faces = unpack_mesh(
+            decode_array(sample["vertices.npy"]),
+            decode_array(sample["faces.npy"]),
+            self.quantization_bits,
+            self.compact_dtypes,
+        )
+        element = {"vertices": vertices, "faces": faces, "class_label": meta["class_label"], "index": meta["index"]}
+        for extension in sample.keys() - {"json", "vertices.npy", "faces.npy"}:
+            image = load_image_uint8(io.BytesIO(sample[extension]))
+            element["image"] = image if self.compact_dtypes else image.to(torch.float32) / 255
+        return element
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        if num_workers > self.MAX_WORKERS:
+            raise ValueError(f"MeshShardDataset supports up to {self.MAX_WORKERS} workers, not {num_workers}")
+        epoch = int(self.epochs[worker_id])
+        self.epochs[worker_id] += 1
+        shard_ids, num_samples = self.worker_shards(epoch, worker_id, num_workers)
+        rng = np.random.default_rng([self.seed, epoch, self.rank, worker_id])
+
+        def _samples() -> Iterator[Dict[str, bytes]]:
+            while True:
+                for shard_id in shard_ids:
+                    yield from iterate_shard(self.shards[shard_id]["file"])
+
+        samples = _samples()
+        buffer_size = self.shuffle_buffer_size if self.shuffle else 0
+        # Samples are kept encoded in the buffer and decoded when they leave it
+        buffer = []
+        for _ in range(num_samples):
+            sample = next(samples)
+            if len(buffer) < buffer_size:
+                buffer.append(sample)
+                continue
+            if buffer_size > 0:
+                i = rng.integers(buffer_size)
+                buffer[i], sample = sample, buffer[i]
+            yield self.decode(sample)
+        rng.shuffle(buffer)
+        for sample in buffer:
+            yield self.decode(sample)
+
+
+def pad_ragged(values: torch.Tensor, lengths: torch.Tensor, max_length: int) -> torch.Tensor:
+    """Scatters concatenated sequences into a zero-padded batch
+
+    Args:
+        values: Tensor of shape (sum(lengths), ...) with the sequences one after another
+        lengths: Tensor of shape (batch_size,) with the length of every sequence
+        max_length: Length the sequences are padded to
+
+    Returns:
+        padded: Tensor of shape (batch_size, max_length, ...) with the dtype of values
+    """
+    padded = values.new_zeros([len(lengths), max_length, *values.shape[1:]])
+    rows = torch.repeat_interleave(torch.arange(len(lengths)), lengths)
+    offsets = torch.cumsum(lengths, dim=0) - lengths
+    columns = torch.arange(values.shape[0]) - offsets[rows]
+    padded[rows, columns] = values
+    return padded
+
+
+def length_mask(lengths: torch.Tensor, max_length: int, dtype: torch.dtype = torch.int32) -> torch.Tensor:
+    """Mask of shape (batch_size, max_length) with ones at the first lengths positions of every row"""
+    return (torch.arange(max_length)[None] < lengths[:, None]).to(dtype)
+
+
 class CollateMethod(Enum):
     VERTICES = 1
     FACES = 2
@@ -138,6 +582,27 @@ class PolygenDataModule(pl.LightningDataModule):
         apply_random_shift_faces: bool = True,
         shuffle_vertices: bool = True,
         num_workers: int = 0, # 0 for debugging
+        mesh_store_dir: Optional[str] = None,
+        mesh_cache_dir: Optional[str] = None,
+        manifest_path: Optional[str] = None,
+        max_num_input_verts: Optional[int] = None,
+        max_seq_length: Optional[int] = None,
+        max_tokens_per_batch: Optional[int] = None,
+        bucket_size: int = 1024,
+        shift_seed: Optional[int] = None,
+        compact_dtypes: bool = False,
+        shared_memory: bool = False,
+        persistent_workers: bool = False,
+        pin_memory: bool = False,
+        prefetch_factor: Optional[int] = None,
+        feature_store_dir: Optional[str] = None,
+        feature_backbone: Optional[nn.Module] = None,
+        max_cached_meshes: int = 0,
+        image_store_dir: Optional[str] = None,
+        fast_decode: bool = True,
+        shard_dir: Optional[str] = None,
+        shuffle_buffer_size: int = 1000,
+        zip_index_path: Optional[str] = None,
     ) -> None:
         """
         Args:
@@ -155,6 +620,39 @@ class PolygenDataModule(pl.LightningDataModule):
             apply_random_shift_vertices: Whether or not we're applying random shift to vertices for vertex model
             apply_random_shift_faces: Whether or not we're applying random shift to vertices for face model
             shuffle_vertices: Whether or not we're shuffling the order of vertices during batch generation for face model
+            num_workers: Number of dataloader worker processes
+            mesh_store_dir: Directory of a preprocessed mesh store to serve the shapenet dataset from
+            mesh_cache_dir: Directory of a content-hashed cache of preprocessed meshes shared by both datasets
+            manifest_path: Manifest of data_dir built with polygen.utils.manifest, which saves globbing data_dir
+            max_num_input_verts: Leaves out meshes with more vertices, requires a manifest or a mesh store
+            max_seq_length: Leaves out meshes with a longer flattened face sequence, requires a manifest or a mesh store
+            max_tokens_per_batch: If provided, training batches group meshes of similar length and are capped by their
+                padded number of tokens per device instead of batch_size. Requires a manifest or a mesh store, and
+                a Trainer that does not replace the sampler, as the batch sampler splits batches across ranks itself.
+            bucket_size: Number of meshes sorted by length together when max_tokens_per_batch is provided
+            shift_seed: If provided, the random shift of every mesh is seeded with shift_seed plus the dataset index of
+                the mesh, so that a mesh is shifted the same way in every epoch and every worker
+            compact_dtypes: Whether datasets and batches hold the smallest integer types that fit, which shrinks the
+                batches sent from worker processes. Face model batches then hold quantized instead of dequantized
+                vertices, uint8 masks and int16 faces and tokens where they fit.
+            shared_memory: Whether datasets keep paths in NumPy arrays and preload processed meshes into shared memory,
+                so that num_workers dataloader workers share them instead of copying them
+            persistent_workers: Whether dataloader workers are kept alive between epochs
+            pin_memory: Whether batches are copied into pinned memory for faster transfers to the GPU
+            prefetch_factor: Number of batches loaded in advance by each worker, the DataLoader default if None
+            feature_store_dir: Feature store of the renderings built with polygen.utils.feature_store. If provided,
+                image batches hold the cached backbone features under "image_features" instead of the images.
+            feature_backbone: Frozen backbone of the image model, the feature store is rebuilt if its weights change
+            max_cached_meshes: Number of processed meshes each process of the image dataset keeps in an LRU cache,
+                so that the renderings of a model process its mesh once per worker
+            image_store_dir: Store of decoded and resized renderings built with polygen.utils.image_store
+            fast_decode: Whether the image dataset decodes JPEGs at reduced size and resizes before tensor conversion
+            shard_dir: Directory of tar shards built with polygen.utils.mesh_shards. If provided, meshes and renderings
+                are streamed from the shards instead of opening files in data_dir, and the splits are contiguous
+                ranges of shards instead of a random split of the meshes.
+            shuffle_buffer_size: Number of samples the shuffle buffer of the streamed training set holds
+            zip_index_path: Index of ShapeNet zip archives built with polygen.utils.zip_index, to read meshes from the
+                archives instead of an extracted data_dir
         """
         super().__init__()
 
@@ -168,22 +666,75 @@ class PolygenDataModule(pl.LightningDataModule):
         self.batch_size = batch_size
 
         self.num_workers = num_workers
-
-        if use_image_dataset:
-            self.shapenet_dataset = ImageDataset(training_dir=self.data_dir, image_extension=img_extension)
+        self.shared_memory = shared_memory
+        self.persistent_workers = persistent_workers
+        self.pin_memory = pin_memory
+        self.prefetch_factor = prefetch_factor
+        self.shuffle_buffer_size = shuffle_buffer_size
+
+        self.shard_index = None
+        if shard_dir is not None:
+            self.shard_index = load_shard_index(shard_dir)
+            if self.shard_index["quantization_bits"] != quantization_bits:
+                raise ValueError(
+                    f"Shards in {shard_dir} use {self.shard_index['quantization_bits']} quantization bits, "
+                    f"not {quantization_bits}"
+                )
+            if use_image_dataset and not self.shard_index["images"]:
+                raise ValueError(f"Shards in {shard_dir} hold no renderings, rebuild them with --images")
+            self.shapenet_dataset = MeshShardDataset(
+                self.shard_index["shards"],
+                quantization_bits=quantization_bits,
+                compact_dtypes=compact_dtypes,
+                shuffle=False,
+            )
+        elif use_image_dataset:
+            self.shapenet_dataset = ImageDataset(
+                training_dir=self.data_dir,
+                image_extension=img_extension,
+                quantization_bits=quantization_bits,
+                mesh_cache_dir=mesh_cache_dir,
+                manifest_path=manifest_path,
+                max_num_input_verts=max_num_input_verts,
+                max_seq_length=max_seq_length,
+                compact_dtypes=compact_dtypes,
+                shared_memory=shared_memory,
+                feature_store_dir=feature_store_dir,
+                feature_backbone=feature_backbone,
+                max_cached_meshes=max_cached_meshes,
+                image_store_dir=image_store_dir,
+                fast_decode=fast_decode,
+            )
         else:
             self.shapenet_dataset = ShapenetDataset(
                 self.data_dir,
                 default_shapenet=default_shapenet,
                 all_files=all_files,
                 label_dict=label_dict,
+                quantization_bits=quantization_bits,
+                mesh_store_dir=mesh_store_dir,
+                mesh_cache_dir=mesh_cache_dir,
+                manifest_path=manifest_path,
+                max_num_input_verts=max_num_input_verts,
+                max_seq_length=max_seq_length,
+                compact_dtypes=compact_dtypes,
+                shared_memory=shared_memory,
+                zip_index_path=zip_index_path,
             )
 
+        self.collate_method = collate_method
+        self.max_tokens_per_batch = max_tokens_per_batch
+        self.bucket_size = bucket_size
+        if max_tokens_per_batch is not None and self.shapenet_dataset.num_vertices is None:
+            raise ValueError("max_tokens_per_batch requires a manifest_path or a mesh_store_dir")
+
         self.training_split = training_split
         self.val_split = val_split
         self.quantization_bits = quantization_bits
         self.apply_random_shift_vertices = apply_random_shift_vertices
         self.apply_random_shift_faces = apply_random_shift_faces
+        self.shift_seed = shift_seed
+        self.compact_dtypes = compact_dtypes
         self.shuffle_vertices = shuffle_vertices
 
         if collate_method == CollateMethod.VERTICES:
@@ -193,6 +744,24 @@ class PolygenDataModule(pl.LightningDataModule):
         elif collate_method == CollateMethod.IMAGES:
             self.collate_fn = self.collate_img_model_batch
 
+    def random_shift(
+        self, vertices: torch.Tensor, num_vertices: torch.Tensor, ds: List[Dict[str, torch.Tensor]]
+    ) -> torch.Tensor:
+        """Shifts the concatenated vertices of a batch, seeding every mesh by its index if shift_seed is provided"""
+        seeds = None
+        if self.shift_seed is not None:
+            seeds = [self.shift_seed + element["index"] for element in ds]
+        return data_utils.random_shift_batch(
+            vertices, num_vertices, quantization_bits=self.quantization_bits, seeds=seeds
+        )
+
+    def batch_dtypes(self, default_dtype: torch.dtype = torch.int32) -> Tuple[torch.dtype, torch.dtype]:
+        """Dtypes of the vertex tokens and the masks of a batch, default_dtype for both unless compact_dtypes is set"""
+        if self.compact_dtypes:
+            # Tokens are quantized vertices + 1, up to 2 ** quantization_bits
+            return data_utils.compact_index_dtype(2 ** self.quantization_bits), torch.uint8
+        return default_dtype, default_dtype
+
     def collate_vertex_model_batch(self, ds: List[Dict[str, torch.Tensor]]) -> Dict[str, torch.Tensor]:
         """Applying padding to different length vertex sequences so we can batch them
         Args:
@@ -200,28 +769,18 @@ class PolygenDataModule(pl.LightningDataModule):
         Returns
             vertex_model_batch: A single dictionary which represents the whole batch
         """
+        num_vertices = torch.tensor([element["vertices"].shape[0] for element in ds])
+        max_vertices = int(num_vertices.max())
+        vertices = torch.cat([element["vertices"] for element in ds])
+        if self.apply_random_shift_vertices:
+            vertices = self.random_shift(vertices, num_vertices, ds)
+        token_dtype, mask_dtype = self.batch_dtypes()
+        # Vertices are flattened in z, y, x order, and +1 reserves token 0 for the stopping token and padding
+        vertices_flat = vertices[:, [2, 1, 0]].reshape([-1]).to(token_dtype) + 1
         vertex_model_batch = {}
-        num_vertices_list = [shape_dict["vertices"].shape[0] for shape_dict in ds]
-        max_vertices = max(num_vertices_list)
-        num_elements = len(ds) # number of elements in a batch
-        vertices_flat = torch.zeros([num_elements, max_vertices * 3 + 1], dtype=torch.int32) # this is for the whole batch
-        class_labels = torch.zeros([num_elements], dtype=torch.int32)
-        vertices_flat_mask = torch.zeros_like(vertices_flat, dtype=torch.int32)
-        for i, element in enumerate(ds):
-            vertices = element["vertices"] # this is for the current element in batch
-            if self.apply_random_shift_vertices:
-                vertices = data_utils.random_shift(vertices)
-            initial_vertex_size = vertices.shape[0]
-            padding_size = max_vertices - initial_vertex_size
-            vertices_permuted = torch.stack([vertices[..., 2], vertices[..., 1], vertices[..., 0]], dim=-1)
-            curr_vertices_flat = vertices_permuted.reshape([-1])
-            vertices_flat[i] = F.pad(curr_vertices_flat + 1, [0, padding_size * 3 + 1])[None] # +1 does the reindexing of the vertex coords
-            class_labels[i] = torch.Tensor([element["class_label"]])
-            vertices_flat_mask[i] = torch.zeros_like(vertices_flat[i], dtype=torch.float32) # this is probably not needed
-            vertices_flat_mask[i, : initial_vertex_size * 3 + 1] = 1 # padding tokens are left as zero, +1 because last element in slice is not included
-        vertex_model_batch["vertices_flat"] = vertices_flat
-        vertex_model_batch["class_label"] = class_labels
-        vertex_model_batch["vertices_flat_mask"] = vertices_flat_mask
+        vertex_model_batch["vertices_flat"] = pad_ragged(vertices_flat, num_vertices * 3, max_vertices * 3 + 1)
+        vertex_model_batch["class_label"] = torch.tensor([element["class_label"] for element in ds], dtype=torch.int32)
+        vertex_model_batch["vertices_flat_mask"] = length_mask(num_vertices * 3 + 1, max_vertices * 3 + 1, mask_dtype)
         return vertex_model_batch
 
     def collate_face_model_batch(
@@ -235,57 +794,45 @@ class PolygenDataModule(pl.LightningDataModule):
         Returns:
             face_model_batch: A single dictionary which represents the whole face model batch
         """
+        num_vertices = torch.tensor([element["vertices"].shape[0] for element in ds])
+        num_faces = torch.tensor([element["faces"].shape[0] for element in ds])
+        max_vertices = int(num_vertices.max())
+        max_faces = int(num_faces.max())
+        vertices = torch.cat([element["vertices"] for element in ds])
+        if self.apply_random_shift_faces:
+            vertices = self.random_shift(vertices, num_vertices, ds)
+        faces = torch.cat([element["faces"] for element in ds]).to(torch.int64)
+
+        if self.shuffle_vertices:
+            # A uniform permutation of all vertices, stably sorted by mesh, shuffles the vertices within every mesh
+            vertex_offsets = torch.cumsum(num_vertices, dim=0) - num_vertices
+            vertex_mesh_ids = torch.repeat_interleave(torch.arange(len(ds)), num_vertices)
+            permutation = torch.randperm(vertices.shape[0])
+            permutation = permutation[torch.argsort(vertex_mesh_ids[permutation], stable=True)]
+            vertices = vertices[permutation]
+            # Face indices point at vertices + 2, after the stopping tokens 0 and 1
+            inverse_permutation = torch.argsort(permutation)
+            face_vertex_offsets = torch.repeat_interleave(vertex_offsets, num_faces)
+            is_vertex = faces >= 2
+            shuffled_indices = inverse_permutation[torch.where(is_vertex, faces - 2 + face_vertex_offsets, 0)]
+            faces = torch.where(is_vertex, shuffled_indices - face_vertex_offsets + 2, faces)
+
+        if self.compact_dtypes:
+            # FaceModel embeds quantized vertices directly, skipping the float round trip
+            face_vertices = vertices.to(data_utils.compact_vertex_dtype(self.quantization_bits))
+            faces_dtype, mask_dtype = data_utils.compact_index_dtype(max_vertices + 1), torch.uint8
+        else:
+            face_vertices = data_utils.dequantize_verts(vertices, self.quantization_bits).to(torch.float32)
+            faces_dtype, mask_dtype = torch.int32, torch.int32
         face_model_batch = {}
-        num_vertices_list = [shape_dict["vertices"].shape[0] for shape_dict in ds]
-        max_vertices = max(num_vertices_list)
-        num_faces_list = [shape_dict["faces"].shape[0] for shape_dict in ds]
-        max_faces = max(num_faces_list)
-        num_elements = len(ds)
-
-        shuffled_faces = torch.zeros([num_elements, max_faces], dtype=torch.int32)
-        face_vertices = torch.zeros([num_elements, max_vertices, 3])
-        face_vertices_mask = torch.zeros([num_elements, max_vertices], dtype=torch.int32)
-        faces_mask = torch.zeros_like(shuffled_faces, dtype=torch.int32)
-
-        for i, element in enumerate(ds):
-            vertices = element["vertices"]
-            num_vertices = vertices.shape[0]
-            if self.apply_random_shift_faces:
-                vertices = data_utils.random_shift(vertices)
-
-            if self.shuffle_vertices:
-                permutation = torch.randperm(num_vertices)
-                vertices = vertices[permutation]
-                vertices = vertices.unsqueeze(0)
-                face_permutation = torch.cat(
-                    [
-                        torch.Tensor([0, 1]).to(torch.int32),
-                        torch.argsort(permutation).to(torch.int32) + 2,
-                    ],
-                    dim=0,
-                )
-                curr_faces = face_permutation[element["faces"].to(torch.int64)][None]
-            else:
-                curr_faces = element["faces"][None]
-
-            vertex_padding_size = max_vertices - num_vertices
-            initial_faces_size = curr_faces.shape[1]
-            face_padding_size = max_faces - initial_faces_size
-            shuffled_faces[i] = F.pad(curr_faces, [0, face_padding_size, 0, 0])
-            curr_verts = data_utils.dequantize_verts(vertices, self.quantization_bits)
-            face_vertices[i] = F.pad(curr_verts, [0, 0, 0, vertex_padding_size])
-            face_vertices_mask[i] = torch.zeros_like(face_vertices[i][..., 0], dtype=torch.float32)
-            face_vertices_mask[i, :num_vertices] = 1
-            faces_mask[i] = torch.zeros_like(shuffled_faces[i], dtype=torch.float32)
-            faces_mask[i, : initial_faces_size + 1] = 1
-        face_model_batch["faces"] = shuffled_faces
-        face_model_batch["vertices"] = face_vertices
-        face_model_batch["vertices_mask"] = face_vertices_mask
-        face_model_batch["faces_mask"] = faces_mask
+        face_model_batch["faces"] = pad_ragged(faces.to(faces_dtype), num_faces, max_faces)
+        face_model_batch["vertices"] = pad_ragged(face_vertices, num_vertices, max_vertices)
+        face_model_batch["vertices_mask"] = length_mask(num_vertices, max_vertices, mask_dtype)
+        face_model_batch["faces_mask"] = length_mask(num_faces + 1, max_faces, mask_dtype)
         return face_model_batch
 
     def collate_img_model_batch(self, ds: List[Dict[str, torch.Tensor]]) -> Dict[str, torch.Tensor]:
-        """Applies padding to different length vertex sequences and collects images for batching
+        """Applies padding to different length vertex sequences and collects images or their cached features
 
         Args:
             ds: List of dictionaries where each dictionary has information about a 3D object
@@ -293,41 +840,48 @@ class PolygenDataModule(pl.LightningDataModule):
         Returns:
             img_vertex_model_batch: A single dictionary which represents the whole batch
         """
+        num_vertices = torch.tensor([element["vertices"].shape[0] for element in ds])
+        max_vertices = int(num_vertices.max())
+        vertices = torch.cat([element["vertices"] for element in ds])
+        token_dtype, mask_dtype = self.batch_dtypes(default_dtype=torch.float32)
+        vertices_flat = vertices[:, [2, 1, 0]].reshape([-1]).to(token_dtype) + 1
         img_vertex_model_batch = {}
-        num_vertices_list = [shape_dict["vertices"].shape[0] for shape_dict in ds]
-        max_vertices = max(num_vertices_list)
-        num_elements = len(ds)
-        vertices_flat = torch.zeros([num_elements, max_vertices * 3 + 1])
-        vertices_flat_mask = torch.zeros_like(vertices_flat)
-        images = torch.zeros(
-            [
-                num_elements,
-                ds[0]["image"].shape[0],
-                ds[0]["image"].shape[1],
-                ds[0]["image"].shape[2],
-            ]
+        img_vertex_model_batch["vertices_flat"] = pad_ragged(vertices_flat, num_vertices * 3, max_vertices * 3 + 1)
+        img_vertex_model_batch["vertices_flat_mask"] = length_mask(
+            num_vertices * 3 + 1, max_vertices * 3 + 1, mask_dtype
         )
-
-        for i, element in enumerate(ds):
-            vertices = element["vertices"]
-            initial_vertex_size = vertices.shape[0]
-            padding_size = max_vertices - initial_vertex_size
-            vertices_permuted = torch.stack([vertices[..., 2], vertices[..., 1], vertices[..., 0]], dim=-1)
-            curr_vertices_flat = vertices_permuted.reshape([-1])
-            vertices_flat[i] = F.pad(curr_vertices_flat + 1, [0, padding_size * 3 + 1])[None]
-
-            vertices_flat_mask[i] = torch.zeros_like(vertices_flat[i], dtype=torch.float32)
-            vertices_flat_mask[i, : initial_vertex_size * 3 + 1] = 1
-
-            images[i] = element["image"]
-
-        img_vertex_model_batch["vertices_flat"] = vertices_flat
-        img_vertex_model_batch["vertices_flat_mask"] = vertices_flat_mask
-        img_vertex_model_batch["image"] = images
+        if "image_features" in ds[0]:
+            # Cached features stay float16 and are cast by the model
+            img_vertex_model_batch["image_features"] = torch.stack([element["image_features"] for element in ds])
+        else:
+            images = torch.stack([element["image"] for element in ds])
+            # uint8 images stay compact and are scaled to [0, 1] by the model
+            img_vertex_model_batch["image"] = images if images.dtype == torch.uint8 else images.to(torch.float32)
         return img_vertex_model_batch
 
     def setup(self, stage: Optional = None) -> None:
         """Pytorch Lightning Data Module setup method"""
+        if self.shard_index is not None:
+            # The shards hold the samples in random order, so contiguous ranges of shards are random splits
+            shards = self.shard_index["shards"]
+            num_train_shards = int(len(shards) * self.training_split)
+            num_val_shards = int(len(shards) * self.val_split)
+            split_shards = [
+                shards[:num_train_shards],
+                shards[num_train_shards : num_train_shards + num_val_shards],
+                shards[num_train_shards + num_val_shards :],
+            ]
+            self.train_set, self.val_set, self.test_set = [
+                MeshShardDataset(
+                    split,
+                    quantization_bits=self.quantization_bits,
+                    compact_dtypes=self.compact_dtypes,
+                    shuffle=shuffle,
+                    shuffle_buffer_size=self.shuffle_buffer_size,
+                )
+                for split, shuffle in zip(split_shards, [True, False, False])
+            ]
+            return
         num_files = len(self.shapenet_dataset)
         train_set_length = int(num_files * self.training_split)
         val_set_length = int(num_files * self.val_split)
@@ -335,19 +889,53 @@ class PolygenDataModule(pl.LightningDataModule):
         self.train_set, self.val_set, self.test_set = random_split(
             self.shapenet_dataset, [train_set_length, val_set_length, test_set_length]
         )
+        if self.shared_memory:
+            # Subsets index through Python lists of ints, which workers would copy like the file lists
+            for subset in [self.train_set, self.val_set, self.test_set]:
+                subset.indices = np.array(subset.indices, dtype=np.int64)
+
+    def dataloader_kwargs(self) -> Dict[str, Any]:
+        """Worker, pinning and prefetching options shared by all dataloaders"""
+        kwargs = {
+            "collate_fn": self.collate_fn,
+            "num_workers": self.num_workers,
+            "pin_memory": self.pin_memory,
+        }
+        # Persistent workers and prefetching only apply to worker processes
+        if self.num_workers > 0:
+            kwargs["persistent_workers"] = self.persistent_workers
+            if self.prefetch_factor is not None:
+                kwargs["prefetch_factor"] = self.prefetch_factor
+        return kwargs
+
+    def sequence_lengths(self) -> np.ndarray:
+        """Number of tokens every mesh of the dataset is padded to by the collate function"""
+        if self.collate_method == CollateMethod.FACES:
+            return self.shapenet_dataset.face_lengths
+        return self.shapenet_dataset.num_vertices * 3 + 1
 
     def train_dataloader(self) -> DataLoader:
         """
         Returns:
             train_dataloader: Dataloader used to load training batches
         """
+        if self.max_tokens_per_batch is not None:
+            batch_sampler = TokenBudgetBatchSampler(
+                self.sequence_lengths()[self.train_set.indices],
+                max_tokens=self.max_tokens_per_batch,
+                bucket_size=self.bucket_size,
+            )
+            return DataLoader(
+                self.train_set,
+                batch_sampler=batch_sampler,
+                **self.dataloader_kwargs(),
+            )
         return DataLoader(
             self.train_set,
             self.batch_size,
-            shuffle=True,
-            collate_fn=self.collate_fn,
-            num_workers=self.num_workers,
-            persistent_workers=False,
+            # Streamed training sets shuffle themselves
+            shuffle=not isinstance(self.train_set, IterableDataset),
+            **self.dataloader_kwargs(),
         )
 
     def val_dataloader(self) -> DataLoader:
@@ -359,9 +947,7 @@ class PolygenDataModule(pl.LightningDataModule):
             self.val_set,
             self.batch_size,
             shuffle=False,
-            collate_fn=self.collate_fn,
-            num_workers=self.num_workers,
-            persistent_workers=False,
+            **self.dataloader_kwargs(),
         )
 
     def test_dataloader(self) -> DataLoader:
@@ -373,7 +959,5 @@ class PolygenDataModule(pl.LightningDataModule):
             self.test_set,
             self.batch_size,
             shuffle=False,
-            collate_fn=self.collate_fn,
-            num_workers=self.num_workers,
-            persistent_workers=False,
+            **self.dataloader_kwargs(),
         )
@@ -1,4 +1,4 @@
-from typing import Dict, Optional, Tuple, Any
+from typing import Dict, List, Optional, Tuple, Any, Union
 import math
 import pdb
 
@@ -11,7 +11,7 @@ from polygen.utils.data_utils import quantize_verts
 
 from .polygen_encoder import PolygenEncoder
 from .polygen_decoder import TransformerDecoder
-from .utils import top_k_logits, top_p_logits
+from .utils import broadcast_rows, filter_logits, gumbel_max_sample
 
 
 class FaceModel(pl.LightningModule):
@@ -123,7 +123,8 @@ class FaceModel(pl.LightningModule):
         """Provides value embeddings for vertices
 
         Args:
-            vertices: A tensor of shape [batch_size, num_vertices, 3]. Represents vertices in the generated mesh.
+            vertices: A tensor of shape [batch_size, num_vertices, 3]. Represents vertices in the generated mesh, either
+                      as dequantized floats or as integers that are already quantized.
             vertices_mask: A tensor of shape [batch_size, num_vertices]. Provides information about which vertices are complete.
 
         Returns:
@@ -131,7 +132,10 @@ class FaceModel(pl.LightningModule):
         """
         if self.use_discrete_vertex_embeddings:
             vertex_embeddings = 0.0
-            verts_quantized = quantize_verts(vertices, self.quantization_bits).to(torch.long)
+            if vertices.is_floating_point():
+                verts_quantized = quantize_verts(vertices, self.quantization_bits).to(torch.long)
+            else:
+                verts_quantized = vertices.to(torch.long)
             vertex_embeddings = (
                 self.coord0_embedder(verts_quantized[..., 0])
                 + self.coord1_embedder(verts_quantized[..., 1])
@@ -165,19 +169,11 @@ class FaceModel(pl.LightningModule):
             embeddings: A tensor of shape [num_faces + 1, batch_size, embed_size].
                         The first two dimensions are transposed such that they can be fed directly to the decoder.
         """
-        face_embeddings = torch.zeros(
-            size=[
-                vertex_embeddings.shape[0],
-                faces_long.shape[1],
-                vertex_embeddings.shape[2],
-            ]
+        # Gather the value embedding of every pointer for the whole batch at once, on the device of the embeddings
+        face_embeddings = torch.gather(
+            vertex_embeddings, 1, faces_long[..., None].expand(-1, -1, vertex_embeddings.shape[2])
         )
-
-        for i in range(vertex_embeddings.shape[0]):
-            face_embeddings[i] = vertex_embeddings[i, faces_long[i]]
-
-        face_embeddings = face_embeddings.type_as(faces_long)
-        pos_embeddings = self.pos_embedder(torch.arange(faces_long.shape[1]).type_as(faces_long)).type_as(faces_long)
+        pos_embeddings = self.pos_embedder(torch.arange(faces_long.shape[1], device=faces_long.device))
 
         batch_size = face_embeddings.shape[0]
 
@@ -191,6 +187,63 @@ class FaceModel(pl.LightningModule):
 
         return embeddings
 
+    def _embed_next_input(
+        self,
+        faces_long: torch.Tensor,
+        vertex_embeddings: torch.Tensor,
+        global_context_embedding: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """Embeds only the newest pointer token for cached decoding. Gives the same result as the last element of _embed_inputs.
+
+        Args:
+            faces_long: A tensor of shape [batch_size, sampled_faces]. Only the last column is embedded.
+            vertex_embeddings: A tensor of shape [batch_size, num_vertices + 2, embed_size]
+            global_context_embedding: If it exists its a tensor of shape [batch_size, embed_size]
+
+        Returns:
+            embeddings: A tensor of shape [1, batch_size, embed_size]. If nothing has been sampled yet, this is the beginning of sequence embedding.
+        """
+        batch_size, seq_length = faces_long.shape[0], faces_long.shape[1]
+        if seq_length == 0:
+            if global_context_embedding is None:
+                zero_embed_tiled = torch.repeat_interleave(self.zero_embed, batch_size, dim=0)
+            else:
+                zero_embed_tiled = global_context_embedding[:, None]
+            return zero_embed_tiled.transpose(0, 1).to(torch.float32)
+
+        positions = torch.full([batch_size], seq_length, dtype=torch.int64, device=vertex_embeddings.device)
+        return self._embed_step(faces_long[:, -1], positions, vertex_embeddings, global_context_embedding)
+
+    def _embed_step(
+        self,
+        last_tokens: torch.Tensor,
+        positions: torch.Tensor,
+        vertex_embeddings: torch.Tensor,
+        global_context_embedding: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """Embeds the newest pointer token of every row for cached decoding, where rows can be at different positions of their sequence.
+
+        Args:
+            last_tokens: A tensor of shape [batch_size,]. The last sampled pointer of every row. Ignored for rows at position 0.
+            positions: A tensor of shape [batch_size,]. How many pointers every row has sampled so far.
+            vertex_embeddings: A tensor of shape [batch_size, num_vertices + 2, embed_size]
+            global_context_embedding: If it exists its a tensor of shape [batch_size, embed_size]
+
+        Returns:
+            embeddings: A tensor of shape [1, batch_size, embed_size]. Rows at position 0 get the beginning of sequence embedding.
+        """
+        device = vertex_embeddings.device
+        positions = positions.to(device)
+        batch_indices = torch.arange(positions.shape[0], device=device)
+        face_embeddings = vertex_embeddings[batch_indices, last_tokens.to(device=device, dtype=torch.int64)]
+        embeddings = face_embeddings + self.pos_embedder(torch.clamp(positions - 1, min=0))  # [batch_size, embed_size]
+        if global_context_embedding is None:
+            bos_embeddings = self.zero_embed[0].expand(positions.shape[0], -1)
+        else:
+            bos_embeddings = global_context_embedding
+        embeddings = torch.where((positions == 0)[:, None], bos_embeddings.to(embeddings.dtype), embeddings)
+        return embeddings[None].to(torch.float32)
+
     def _project_to_pointers(self, inputs: torch.Tensor) -> torch.Tensor:
         """Passes inputs through a linear layer
 
@@ -202,6 +255,35 @@ class FaceModel(pl.LightningModule):
         """
         return self.linear_layer(inputs)
 
+    def _pointer_logits(
+        self, decoder_outputs: torch.Tensor, vertex_embeddings: torch.Tensor, vertices_mask: torch.Tensor
+    ) -> torch.Tensor:
+        """Scores decoder outputs against vertex embeddings to point at the next vertex
+
+        Args:
+            decoder_outputs: A tensor of shape [sequence_length, batch_size, embed_size]
+            vertex_embeddings: A tensor of shape [batch_size, num_vertices + 2, embed_size] representing value embeddings for vertices
+            vertices_mask: A tensor of shape [batch_size, num_vertices], representing which vertices are complete
+
+        Returns:
+            logits: Logits of shape [batch_size, sequence_length, num_vertices + 2]
+        """
+        pred_pointers = self._project_to_pointers(decoder_outputs.transpose(0, 1))
+
+        num_dimensions = len(vertex_embeddings.shape)
+        penultimate_dim, last_dim = num_dimensions - 2, num_dimensions - 1
+        vertex_embeddings_transposed = vertex_embeddings.transpose(penultimate_dim, last_dim)
+
+        logits = torch.matmul(pred_pointers, vertex_embeddings_transposed)
+        logits = logits / math.sqrt(self.embedding_dim)
+
+        # each example in the batch needs to have max_num_vertices, so that we can create a batch from multiple classes
+        f_verts_mask = F.pad(vertices_mask, [2, 0, 0, 0], value=1)[:, None]
+
+        logits = logits * f_verts_mask
+        logits = logits - (1.0 - f_verts_mask) * 1e9
+        return logits
+
     def _create_dist(
         self,
         vertex_embeddings: torch.Tensor,
@@ -209,9 +291,9 @@ class FaceModel(pl.LightningModule):
         faces_long: torch.Tensor,
         global_context_embedding: Optional[torch.Tensor] = None,
         sequential_context_embeddings: Optional[torch.Tensor] = None,
-        temperature: float = 1.0,
-        top_k: int = 0,
-        top_p: float = 1.0,
+        temperature: Union[float, torch.Tensor] = 1.0,
+        top_k: Union[int, torch.Tensor] = 0,
+        top_p: Union[float, torch.Tensor] = 1.0,
         cache: Optional[Dict[str, torch.Tensor]] = None,
     ) -> torch.Tensor:
         """Outputs logits that can be used to create a categorical distribution
@@ -222,51 +304,37 @@ class FaceModel(pl.LightningModule):
             faces_long: A tensor of shape [batch_size, sampled_faces] representing currently sampled face indices
             global_context_embedding: A tensor of shape [batch_size, embed_size]
             sequential_context_embeddings: A tensor of shape [batch_size, num_vertices + 2, embed_size]
-            temperature: A constant to normalize logits
-            temperature: Scalar softmax temperature > 0.
-            top_k: Number of tokens to keep for top-k sampling.
-            top-p: Proportion of probability mass to keep for top-p sampling.
+            temperature: Softmax temperature > 0. Either a scalar or a Tensor of shape [batch_size,] with one value per row.
+            top_k: Number of tokens to keep for top-k sampling. Either a scalar or a Tensor of shape [batch_size,].
+            top-p: Proportion of probability mass to keep for top-p sampling. Either a scalar or a Tensor of shape [batch_size,].
             cache: A list of dictionaries in the following format: {'k': torch.Tensor, 'v': torch.Tensor}. Each dictionary in the list represents the cache at the respective decoder layer.
 
         Returns:
             logits: Logits of shape [batch_size, sequence_length, num_vertices] that can be used to create a categorical distribution over vertex indices.
         """
 
-        decoder_inputs = self._embed_inputs(
-            faces_long.to(torch.int64),
-            vertex_embeddings,
-            global_context_embedding,
-        )
-
         # check whether we are starting a sequence, or continuing a previous one
         if cache is not None:
-            cached_decoder_inputs = decoder_inputs[-1:, :]
+            # The cache already holds every previous pointer, so only the newest one is embedded
+            cached_decoder_inputs = self._embed_next_input(faces_long, vertex_embeddings, global_context_embedding)
         else:
-            cached_decoder_inputs = decoder_inputs
+            cached_decoder_inputs = self._embed_inputs(
+                faces_long.to(torch.int64),
+                vertex_embeddings,
+                global_context_embedding,
+            )
+        if sequential_context_embeddings is not None:
+            sequential_context_embeddings = sequential_context_embeddings.transpose(0, 1)
         decoder_outputs = self.decoder(
             cached_decoder_inputs,
             cache=cache,
-            sequential_context_embeddings=sequential_context_embeddings.transpose(0, 1).type_as(faces_long),
+            sequential_context_embeddings=sequential_context_embeddings,
         )
 
-        pred_pointers = self._project_to_pointers(decoder_outputs.transpose(0, 1))
-
-        num_dimensions = len(vertex_embeddings.shape)
-        penultimate_dim, last_dim = num_dimensions - 2, num_dimensions - 1
-        vertex_embeddings_transposed = vertex_embeddings.transpose(penultimate_dim, last_dim)
+        logits = self._pointer_logits(decoder_outputs, vertex_embeddings, vertices_mask)
+        logits = logits / broadcast_rows(temperature, logits)
 
-        logits = torch.matmul(pred_pointers, vertex_embeddings_transposed)
-        logits = logits / math.sqrt(self.embedding_dim)
-
-        # each example in the batch needs to have max_num_vertices, so that we can create a batch from multiple classes
-        f_verts_mask = F.pad(vertices_mask, [2, 0, 0, 0], value=1)[:, None]
-
-        logits = logits * f_verts_mask
-        logits = logits - (1.0 - f_verts_mask) * 1e9
-        logits = logits / temperature
-
-        logits = top_k_logits(logits, top_k)
-        logits = top_p_logits(logits, top_p)
+        logits = filter_logits(logits, top_k, top_p)
 
         return logits
 
@@ -303,6 +371,7 @@ class FaceModel(pl.LightningModule):
         face_pred_dist = torch.distributions.categorical.Categorical(logits=face_logits)
         face_loss = -torch.sum(face_pred_dist.log_prob(face_model_batch["faces"]) * face_model_batch["faces_mask"])
         self.log("train_loss", face_loss)
+        self.log("padding_ratio", 1 - face_model_batch["faces_mask"].float().mean())
         return face_loss
 
     def validation_step(self, val_batch, batch_idx):
@@ -339,20 +408,24 @@ class FaceModel(pl.LightningModule):
         self,
         context: Dict[str, Any],
         max_sample_length: int = 5000,
-        temperature: float = 1.0,
-        top_k: int = 0,
-        top_p: float = 1.0,
+        temperature: Union[float, torch.Tensor] = 1.0,
+        top_k: Union[int, torch.Tensor] = 0,
+        top_p: Union[float, torch.Tensor] = 1.0,
         only_return_complete: bool = True,
+        stop_check_interval: int = 1,
     ) -> Dict[str, torch.Tensor]:
         """Autoregressive sampling method to generate faces
 
         Args:
             context: A dictionary with keys for vertices and vertices_mask.
             max_sample_length: Maximum length of sampled faces. Sequences that do not complete are truncated.
-            temperature: Scalar softmax temperature > 0.
-            top_k: Number of tokens to keep for top-k sampling.
-            top-p: Proportion of probability mass to keep for top-p sampling.
+            temperature: Softmax temperature > 0. Either a scalar or a Tensor of shape [num_samples,] with one value per sample.
+            top_k: Number of tokens to keep for top-k sampling. Either a scalar or a Tensor of shape [num_samples,].
+            top-p: Proportion of probability mass to keep for top-p sampling. Either a scalar or a Tensor of shape [num_samples,].
             only_return_complete: If True, only return completed samples. Otherwise return all samples along with completed indicator.
+            stop_check_interval: Number of decoding steps between checks for stop tokens. Every check waits for the device to finish the
+                                 previous steps, so larger intervals save synchronizations at the cost of decoding finished samples
+                                 for up to stop_check_interval - 1 extra steps. Tokens after a stop token are ignored either way.
 
         Returns:
             outputs: Output dictionary with fields
@@ -361,25 +434,29 @@ class FaceModel(pl.LightningModule):
                 'faces': Tensor of shape [batch_size, num_faces]. Represents sampled faces.
                 'num_face_indices': A tensor of shape [batch_size,]. Represents ending point of every sampled face.
         """
+        if stop_check_interval < 1:
+            raise ValueError(f"stop_check_interval should be at least 1, got {stop_check_interval}")
         vertex_embeddings, global_context, seq_context = self._prepare_context(context)
         num_samples = vertex_embeddings.shape[0]
+        temperature, top_k, top_p = [
+            value.to(self.device) if torch.is_tensor(value) else value for value in (temperature, top_k, top_p)
+        ]
 
-        def _loop_body(i: int, samples: torch.Tensor, cache: Dict) -> Tuple[int, torch.Tensor]:
-            """While-loop body for autoregression calculation.
+        def _loop_body(i: int, samples: torch.Tensor, cache: List[Dict[str, Any]]) -> int:
+            """While-loop body for autoregression calculation. Writes the next token in place.
 
             Args:
                 i: Current iteration in the loop
-                samples: tensor of shape [batch_size, i].
-                cache: A list of dictionaries in the following format: {'k': torch.Tensor, 'v': torch.Tensor}. Each dictionary in the list represents the cache at the respective decoder layer.
+                samples: preallocated tensor of shape [num_active_samples, max_sample_length]. The first i columns are sampled.
+                cache: A list of dictionaries in the format returned by TransformerDecoder.initialize_cache. Each dictionary in the list represents the cache at the respective decoder layer.
             Returns:
                 next_iter: i + 1.
-                samples: tensor of shape [batch_size, i + 1].
             """
 
             logits = self._create_dist(
                 vertex_embeddings,
-                context["vertices_mask"],
-                samples,
+                vertices_mask,
+                samples[:, :i],
                 global_context_embedding=global_context,
                 sequential_context_embeddings=seq_context,
                 cache=cache,
@@ -387,31 +464,42 @@ class FaceModel(pl.LightningModule):
                 top_k=top_k,
                 top_p=top_p,
             )
-            pred_dist = torch.distributions.categorical.Categorical(logits=logits)
-            next_sample = pred_dist.sample()[:, -1:].to(torch.int32)
-            samples = torch.cat([samples, next_sample], dim=1)
-            return i + 1, samples
+            samples[:, i] = gumbel_max_sample(logits[:, -1])
+            return i + 1
 
-        def _stopping_cond(samples: torch.Tensor) -> bool:
-            """Stopping condition for sampling while-loop. Looking for stop token (represented by 0)
-
-            Args:
-                samples: tensor of shape of [batch_size, i], where i is the current iteration.
-            Returns:
-                token_found: Boolean that represents if stop token has been found in every row of samples.
-            """
-            nonzero_boolean_matrix = torch.ne(samples, 0)
-            reduced_matrix = torch.all(
-                nonzero_boolean_matrix, dim=-1
-            )  # Checks if stopping token is present in every row
-            return torch.any(reduced_matrix)
-
-        samples = torch.zeros([num_samples, 0], dtype=torch.int32)
-        cache = self.decoder.initialize_cache(num_samples)
         max_sample_length = max_sample_length or self.max_seq_length
+        vertices_mask = context["vertices_mask"]
+        # The token buffers and the decoder cache are allocated once on the model device and filled in place through the step counter j
+        samples = torch.zeros([num_samples, max_sample_length], dtype=torch.int32, device=self.device)
+        active_samples = torch.zeros([num_samples, max_sample_length], dtype=torch.int32, device=self.device)
+        # Vertex context never changes while sampling, so its cross attention keys and values are projected once
+        memory = seq_context.transpose(0, 1) if seq_context is not None else None
+        cache = self.decoder.initialize_cache(num_samples, projected=True, max_length=max_sample_length, memory=memory)
+
+        # Rows that sampled a stop token are dropped from the decoded batch. active_rows maps the rows
+        # that are still decoding to their row in samples, where finished rows are written back.
+        active_rows = torch.arange(num_samples, device=self.device)
         j = 0
-        while _stopping_cond(samples) and j < max_sample_length:
-            j, samples = _loop_body(j, samples, cache)
+        while active_rows.shape[0] > 0 and j < max_sample_length:
+            j = _loop_body(j, active_samples, cache)
+            if j % stop_check_interval != 0:
+                continue
+            finished = torch.any(active_samples[:, :j] == 0, dim=-1)
+            if torch.any(finished):
+                samples[active_rows[finished]] = active_samples[finished]
+                keep = torch.nonzero(~finished).squeeze(-1)
+                active_rows = active_rows[keep]
+                active_samples = active_samples[keep]
+                vertex_embeddings = vertex_embeddings[keep]
+                vertices_mask = vertices_mask[keep]
+                global_context = global_context[keep] if global_context is not None else None
+                seq_context = seq_context[keep] if seq_context is not None else None
+                temperature, top_k, top_p = [
+                    value[keep] if torch.is_tensor(value) else value for value in (temperature, top_k, top_p)
+                ]
+                self.decoder.select_cache_rows(cache, keep)
+        samples[active_rows] = active_samples
+        samples = samples[:, :j].cpu()
 
         completed_samples_boolean = samples == 0  # Checks for stopping token in every row of sampled faces
         complete_samples = torch.any(
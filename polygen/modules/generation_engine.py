@@ -0,0 +1,305 @@
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+import time
+
+import torch
+import torch.nn.functional as F
+
+from polygen.utils.data_utils import dequantize_verts
+
+from .face_model import FaceModel
+from .utils import broadcast_rows, filter_logits, gumbel_max_sample
+from .vertex_model import VertexModel
+
+
+class GenerationRequest:
+    def __init__(
+        self,
+        context: Dict[str, torch.Tensor],
+        max_sample_length: int,
+        temperature: Optional[float] = None,
+        top_k: Optional[int] = None,
+        top_p: Optional[float] = None,
+    ) -> None:
+        """A single generation request for the GenerationEngine
+
+        Args:
+            context: Context of the request in the format expected by the sample method of the model, with a batch size of 1.
+                     For example {'class_label': torch.Tensor([2])} for a class conditional vertex model, or vertices and
+                     vertices_mask for a face model.
+            max_sample_length: Maximum number of vertices (vertex model) or face indices (face model) of the sample.
+            temperature: Softmax temperature of this request. Defaults to the temperature of the engine.
+            top_k: Number of tokens to keep for top-k sampling. Defaults to top_k of the engine.
+            top_p: Proportion of probability mass to keep for top-p sampling. Defaults to top_p of the engine.
+        """
+        self.context = context
+        self.max_sample_length = max_sample_length
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.tokens: List[int] = []
+        self.submit_time: Optional[float] = None
+        self.admit_time: Optional[float] = None
+        self.finish_time: Optional[float] = None
+
+
+class GenerationEngine:
+    """Continuous batching sampler for a VertexModel or a FaceModel.
+
+    Requests decode together in a fixed number of batch slots that share one preallocated decoder cache. When a request
+    samples its stop token or reaches its max_sample_length it leaves its slot, and the next queued request starts decoding
+    in that slot at the following step, without restarting the loop for the other slots. Every slot masks the cached steps
+    written before its request started, and the oldest cache steps are dropped once the cache is full.
+    """
+
+    def __init__(
+        self,
+        model: torch.nn.Module,
+        max_batch_size: int = 8,
+        max_sample_length: int = 800,
+        cache_length: Optional[int] = None,
+        max_num_vertices: Optional[int] = None,
+        temperature: float = 1.0,
+        top_k: int = 0,
+        top_p: float = 1.0,
+        recenter_verts: bool = True,
+    ) -> None:
+        """
+        Args:
+            model: A VertexModel (or ImageToVertexModel) or a FaceModel. Put into eval mode.
+            max_batch_size: Number of requests that decode together.
+            max_sample_length: Largest max_sample_length a request may ask for.
+            cache_length: Number of decoding steps the cache holds. Defaults to twice the decoding steps of the longest request,
+                          so that dropping old cache steps is rare.
+            max_num_vertices: Largest number of vertices in the context of a face model request. Defaults to the number of
+                              position embeddings of the face model.
+            temperature: Default softmax temperature > 0 of requests that don't set their own.
+            top_k: Default number of tokens to keep for top-k sampling.
+            top_p: Default proportion of probability mass to keep for top-p sampling.
+            recenter_verts: If True, center vertex samples around origin, as in VertexModel.sample.
+        """
+        if not isinstance(model, (VertexModel, FaceModel)):
+            raise TypeError(f"Expected a VertexModel or a FaceModel, got {type(model).__name__}")
+        self.model = model.eval()
+        self.is_face_model = isinstance(model, FaceModel)
+        self.max_batch_size = max_batch_size
+        self.max_sample_length = max_sample_length
+        self.cache_length = cache_length or 2 * self._max_decoding_steps(max_sample_length)
+        if self.cache_length < self._max_decoding_steps(max_sample_length):
+            raise ValueError(f"A cache of length {self.cache_length} can't hold requests of length {max_sample_length}")
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.recenter_verts = recenter_verts
+
+        self.queue: Deque[GenerationRequest] = deque()
+        self.slots: List[Optional[GenerationRequest]] = [None] * max_batch_size
+        self.positions = torch.zeros([max_batch_size], dtype=torch.int64)
+        self.last_tokens = torch.zeros([max_batch_size], dtype=torch.int64)
+        # Sampling parameters of the request in every slot, so that requests with different settings share the batch
+        self.temperatures = torch.ones([max_batch_size], device=model.device)
+        self.top_ks = torch.zeros([max_batch_size], dtype=torch.int64, device=model.device)
+        self.top_ps = torch.ones([max_batch_size], device=model.device)
+        self.cache = model.decoder.initialize_cache(max_batch_size, projected=True, max_length=self.cache_length)
+        model.decoder.reset_cache_rows(self.cache, torch.arange(max_batch_size))
+        self.global_context: Optional[torch.Tensor] = None
+        if self.is_face_model:
+            self.max_num_vertices = max_num_vertices or model.max_seq_length
+            self.vertex_embeddings = torch.zeros(
+                [max_batch_size, self.max_num_vertices + 2, model.embedding_dim], device=model.device
+            )
+            self.vertices_mask = torch.zeros([max_batch_size, self.max_num_vertices], device=model.device)
+        self.num_tokens = 0
+        self.decoding_seconds = 0.0
+
+    def _max_decoding_steps(self, max_sample_length: int) -> int:
+        """Number of tokens a request with the given max_sample_length can sample, including the stop token"""
+        return max_sample_length if self.is_face_model else max_sample_length * 3 + 1
+
+    def submit(self, request: GenerationRequest) -> GenerationRequest:
+        """Queues a request. It starts decoding as soon as a batch slot is free
+
+        Args:
+            request: The request to queue
+
+        Returns:
+            request: The queued request, which holds the sampled tokens and timings once it is finished
+        """
+        if request.max_sample_length > self.max_sample_length:
+            raise ValueError(f"max_sample_length of {request.max_sample_length} exceeds {self.max_sample_length}")
+        if self.is_face_model and request.context["vertices"].shape[1] > self.max_num_vertices:
+            raise ValueError(f"Face model requests can have at most {self.max_num_vertices} vertices")
+        request.submit_time = time.perf_counter()
+        self.queue.append(request)
+        return request
+
+    def _admit(self) -> None:
+        """Starts queued requests in the free batch slots"""
+        free_slots = [slot for slot, request in enumerate(self.slots) if request is None]
+        for slot in free_slots:
+            if not self.queue:
+                break
+            request = self.queue.popleft()
+            request.admit_time = time.perf_counter()
+            context = {key: value.to(self.model.device) for key, value in request.context.items()}
+            memory, memory_key_padding_mask = None, None
+            if self.is_face_model:
+                vertex_embeddings, global_context, seq_context = self.model._prepare_context(context)
+                num_vertices = context["vertices"].shape[1]
+                self.vertex_embeddings[slot] = 0.0
+                self.vertex_embeddings[slot, : num_vertices + 2] = vertex_embeddings[0]
+                self.vertices_mask[slot] = 0.0
+                self.vertices_mask[slot, :num_vertices] = context["vertices_mask"][0]
+                if seq_context is not None:
+                    # The memory of every slot is padded to the largest number of vertices, padding is ignored
+                    pad_size = self.max_num_vertices - num_vertices
+                    memory = F.pad(seq_context, [0, 0, 0, pad_size]).transpose(0, 1)
+                    memory_key_padding_mask = torch.arange(self.max_num_vertices + 2)[None] >= num_vertices + 2
+            else:
+                global_context, seq_context = self.model._prepare_context(context)
+                memory = seq_context.transpose(0, 1) if seq_context is not None else None
+            if global_context is not None:
+                if self.global_context is None:
+                    self.global_context = global_context.new_zeros([self.max_batch_size, global_context.shape[1]])
+                self.global_context[slot] = global_context[0]
+            self.model.decoder.reset_cache_rows(
+                self.cache, torch.tensor([slot]), memory=memory, memory_key_padding_mask=memory_key_padding_mask
+            )
+            self.positions[slot] = 0
+            self.last_tokens[slot] = 0
+            self.temperatures[slot] = self.temperature if request.temperature is None else request.temperature
+            self.top_ks[slot] = self.top_k if request.top_k is None else request.top_k
+            self.top_ps[slot] = self.top_p if request.top_p is None else request.top_p
+            self.slots[slot] = request
+
+    def _make_room(self) -> None:
+        """Drops the cache steps that no active request attends to once the cache is full"""
+        if self.cache[0]["length"] < self.cache_length:
+            return
+        idle_slots = [slot for slot, request in enumerate(self.slots) if request is None]
+        if idle_slots:
+            self.model.decoder.reset_cache_rows(self.cache, torch.tensor(idle_slots))
+        longest = max(int(self.positions[slot]) for slot, request in enumerate(self.slots) if request is not None)
+        self.model.decoder.trim_cache(self.cache, self.cache_length - longest)
+
+    def _logits(self, decoder_outputs: torch.Tensor) -> torch.Tensor:
+        """Turns decoder outputs of shape [1, batch_size, embed_size] into logits of shape [batch_size, vocab_size]"""
+        if self.is_face_model:
+            logits = self.model._pointer_logits(decoder_outputs, self.vertex_embeddings, self.vertices_mask)
+        else:
+            logits = self.model._project_to_logits(decoder_outputs.transpose(0, 1))
+        logits = logits / broadcast_rows(self.temperatures, logits)
+        logits = filter_logits(logits, self.top_ks, self.top_ps)
+        return logits[:, -1]
+
+    @torch.no_grad()
+    def step(self) -> List[GenerationRequest]:
+        """Admits queued requests and samples one token for every active request
+
+        Returns:
+            finished: The requests that finished in this step
+        """
+        self._admit()
+        if all(request is None for request in self.slots):
+            return []
+        start = time.perf_counter()
+        self._make_room()
+        if self.is_face_model:
+            inputs = self.model._embed_step(
+                self.last_tokens, self.positions, self.vertex_embeddings, self.global_context
+            )
+        else:
+            inputs = self.model._embed_step(self.last_tokens, self.positions, self.global_context)
+        outputs = self.model.decoder(inputs, cache=self.cache)
+        logits = self._logits(outputs)
+        next_tokens = gumbel_max_sample(logits).cpu()
+
+        finished = []
+        for slot, request in enumerate(self.slots):
+            if request is None:
+                continue
+            token = int(next_tokens[slot])
+            request.tokens.append(token)
+            self.num_tokens += 1
+            if token == 0 or len(request.tokens) == self._max_decoding_steps(request.max_sample_length):
+                request.finish_time = time.perf_counter()
+                self.slots[slot] = None
+                finished.append(request)
+        # Free slots restart from the beginning of sequence input, which keeps their positions within the embeddings
+        active = torch.tensor([request is not None for request in self.slots])
+        self.positions = torch.where(active, self.positions + 1, torch.zeros_like(self.positions))
+        self.last_tokens = torch.where(active, next_tokens.to(torch.int64), torch.zeros_like(self.last_tokens))
+        self.decoding_seconds += time.perf_counter() - start
+        return finished
+
+    def run(self, requests: List[GenerationRequest]) -> List[Dict[str, Any]]:
+        """Queues the requests and decodes until every queued request is finished
+
+        Args:
+            requests: Requests to sample
+
+        Returns:
+            results: A result dictionary for every request, in the order of requests. See result.
+        """
+        for request in requests:
+            self.submit(request)
+        while self.queue or any(request is not None for request in self.slots):
+            self.step()
+        return [self.result(request) for request in requests]
+
+    def result(self, request: GenerationRequest) -> Dict[str, Any]:
+        """Converts the sampled tokens of a finished request in the same way as the sample method of the model
+
+        Args:
+            request: A finished request
+
+        Returns:
+            result: Dictionary with fields
+                'completed': If True the request sampled a stop token within max_sample_length.
+                'vertices', 'num_vertices': Sampled vertices of shape [num_vertices, 3] (vertex model).
+                'faces', 'num_face_indices': Sampled face indices of shape [num_face_indices,] (face model).
+                'num_tokens': Number of sampled tokens.
+                'latency': Seconds from submitting the request until it finished.
+                'queue_time': Seconds the request waited for a free batch slot.
+        """
+        tokens = torch.tensor(request.tokens, dtype=torch.int64)
+        completed = bool(request.tokens) and request.tokens[-1] == 0
+        result = {
+            "completed": completed,
+            "num_tokens": len(request.tokens),
+            "latency": request.finish_time - request.submit_time,
+            "queue_time": request.admit_time - request.submit_time,
+        }
+        if self.is_face_model:
+            if completed:
+                num_face_indices = len(request.tokens)
+            else:
+                new_face_indices = torch.nonzero(tokens == 1).squeeze(-1)
+                num_face_indices = int(new_face_indices[-1]) + 1 if new_face_indices.numel() > 0 else 1
+            faces = tokens[:num_face_indices].clone()
+            faces[-1] = 0  # The last new face token or stop token is replaced with padding, as in FaceModel.sample
+            result["faces"] = faces
+            result["num_face_indices"] = num_face_indices
+        else:
+            num_vertices = (len(request.tokens) - 1) // 3 if completed else request.max_sample_length
+            vertices = dequantize_verts(tokens[: num_vertices * 3] - 1, self.model.quantization_bits)
+            vertices = torch.flip(torch.reshape(vertices, [num_vertices, 3]), dims=[-1])  # Converts from z-y-x to x-y-z.
+            if self.recenter_verts and num_vertices > 0:
+                vert_max, _ = torch.max(vertices, dim=0, keepdim=True)
+                vert_min, _ = torch.min(vertices, dim=0, keepdim=True)
+                vertices = vertices - 0.5 * (vert_max + vert_min)
+            result["vertices"] = vertices
+            result["num_vertices"] = num_vertices
+        return result
+
+    def throughput(self) -> Dict[str, float]:
+        """Aggregate decoding statistics over every step so far
+
+        Returns:
+            stats: Number of sampled tokens, seconds spent decoding and tokens per second
+        """
+        return {
+            "tokens": self.num_tokens,
+            "seconds": self.decoding_seconds,
+            "tokens_per_second": self.num_tokens / max(self.decoding_seconds, 1e-9),
+        }
@@ -11,9 +11,13 @@ import pytorch_lightning as pl
 class PolygenResnet(nn.Module):
     """Simple resnet used to extract image features"""
 
-    def __init__(self) -> None:
+    def __init__(self, pretrained: bool = True) -> None:
+        """
+        Args:
+            pretrained: Whether to load the ImageNet weights of Resnet18 instead of initializing it randomly
+        """
         super(PolygenResnet, self).__init__()
-        self.resnet = models.resnet18(pretrained=True)
+        self.resnet = models.resnet18(pretrained=pretrained)
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         """Forward pass through first 3 resnet layers
@@ -1,8 +1,10 @@
-from typing import Dict, Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple
+import math
 import pdb
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torch.nn import MultiheadAttention, Linear, Dropout, LayerNorm, ReLU, Parameter
 import pytorch_lightning as pl
 
@@ -63,7 +65,7 @@ class PolygenDecoderLayer(nn.TransformerDecoderLayer):
         memory_mask: Optional[torch.Tensor] = None,
         tgt_key_padding_mask: Optional[torch.Tensor] = None,
         memory_key_padding_mask: Optional[torch.Tensor] = None,
-        cache: Optional[Dict[str, torch.Tensor]] = None,
+        cache: Optional[Dict[str, Any]] = None,
     ) -> torch.Tensor:
         """Forward method of Decoder Layer
 
@@ -74,33 +76,54 @@ class PolygenDecoderLayer(nn.TransformerDecoderLayer):
             memory_mask: A Tensor of shape [sequence_length, source_sequence_length]. The mask for the memory sequence.
             tgt_key_padding_mask: A Tensor of shape [batch_size, sequence_length]. A Tensor that ignores specified padding elements in the target sequence.
             memory_key_padding_mask: A Tensor of shape [batch_size, source_sequence_length]. A Tensor that ignores specified padding elements in the memory sequence.
-            cache: A Dictionary in the following format: {'k': torch.Tensor, 'v': torch.Tensor}. Used for fast decoding.
+            cache: A Dictionary in the following format: {'k': torch.Tensor, 'v': torch.Tensor} or {'projected_k': torch.Tensor, 'projected_v': torch.Tensor}.
+                   Used for fast decoding. If it also holds 'memory_k' and 'memory_v', the cross attention uses those projected memory
+                   keys and values instead of projecting memory again. Projected caches build their own causal mask, so tgt_mask and
+                   tgt_key_padding_mask have to be None. Cached memory takes its padding mask from the cache, set through
+                   TransformerDecoder.initialize_cache or reset_cache_rows, so memory_mask and memory_key_padding_mask have to be None.
 
         Returns:
             tgt: A Tensor of shape [sequence_length, batch_size, embed_size]. The resultant tensor after the forward loop of one decoder layer.
+
+        Raises:
+            ValueError: If masks are passed for attention that reads from the cache, which would ignore them.
         """
-        if cache is not None:
-            saved_key = cache["k"]
-            saved_value = cache["v"]
-            key = cache["k"] = torch.cat([saved_key, tgt], axis=0)
-            value = cache["v"] = torch.cat([saved_value, tgt], axis=0)
+        if cache is not None and "projected_k" in cache:
+            if tgt_mask is not None or tgt_key_padding_mask is not None:
+                raise ValueError("Projected caches mask causally on their own and don't support tgt_mask or tgt_key_padding_mask")
+            tgt2 = self._cached_self_attention(tgt, cache)
         else:
-            key = tgt
-            value = tgt
-        tgt2 = self.norm1(tgt)
-        tgt2 = self.self_attn(tgt, key, value, attn_mask=tgt_mask, key_padding_mask=tgt_key_padding_mask)[0]
+            if cache is not None:
+                saved_key = cache["k"]
+                saved_value = cache["v"]
+                key = cache["k"] = torch.cat([saved_key, tgt], axis=0)
+                value = cache["v"] = torch.cat([saved_value, tgt], axis=0)
+            else:
+                key = tgt
+                value = tgt
+            tgt2 = self.norm1(tgt)
+            tgt2 = self.self_attn(tgt, key, value, attn_mask=tgt_mask, key_padding_mask=tgt_key_padding_mask)[0]
         if self.re_zero:
             tgt2 = tgt2 * self.alpha
         tgt = tgt + self.dropout1(tgt2)
-        if memory is not None:
-            tgt2 = self.norm2(tgt)
-            tgt2 = self.multihead_attn(
-                tgt,
-                memory.float(),
-                memory.float(),
-                attn_mask=memory_mask,
-                key_padding_mask=memory_key_padding_mask,
-            )[0]
+        use_memory_cache = cache is not None and "memory_k" in cache
+        if use_memory_cache or memory is not None:
+            if use_memory_cache:
+                if memory_mask is not None or memory_key_padding_mask is not None:
+                    raise ValueError(
+                        "Cached memory doesn't support memory_mask, "
+                        "pass memory_key_padding_mask to initialize_cache or reset_cache_rows instead"
+                    )
+                tgt2 = self._cached_cross_attention(tgt, cache)
+            else:
+                tgt2 = self.norm2(tgt)
+                tgt2 = self.multihead_attn(
+                    tgt,
+                    memory.float(),
+                    memory.float(),
+                    attn_mask=memory_mask,
+                    key_padding_mask=memory_key_padding_mask,
+                )[0]
             if self.re_zero:
                 tgt2 = tgt2 * self.beta
             tgt2 = self.dropout2(tgt2)
@@ -115,6 +138,133 @@ class PolygenDecoderLayer(nn.TransformerDecoderLayer):
         tgt = tgt + tgt2
         return tgt
 
+    def _split_heads(self, x: torch.Tensor, attn: MultiheadAttention) -> torch.Tensor:
+        """Splits projected inputs into attention heads
+
+        Args:
+            x: A Tensor of shape [sequence_length, batch_size, embed_size].
+            attn: The attention module whose head layout is used.
+
+        Returns:
+            x: A Tensor of shape [batch_size, num_heads, sequence_length, head_dim].
+        """
+        seq_length, batch_size, _ = x.shape
+        return x.reshape(seq_length, batch_size, attn.num_heads, attn.head_dim).permute(1, 2, 0, 3)
+
+    def _attend(
+        self,
+        query: torch.Tensor,
+        key: torch.Tensor,
+        value: torch.Tensor,
+        attn: MultiheadAttention,
+        attn_mask: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """Scaled dot product attention over already projected, head-split tensors
+
+        Args:
+            query: A Tensor of shape [batch_size, num_heads, sequence_length, head_dim].
+            key: A Tensor of shape [batch_size, num_heads, source_sequence_length, head_dim].
+            value: A Tensor of shape [batch_size, num_heads, source_sequence_length, head_dim].
+            attn: The attention module that owns the output projection and dropout rate.
+            attn_mask: Optional additive mask broadcastable to [batch_size, num_heads, sequence_length, source_sequence_length].
+
+        Returns:
+            outputs: A Tensor of shape [sequence_length, batch_size, embed_size] after the output projection.
+        """
+        batch_size, _, seq_length, _ = query.shape
+        query = query * (1.0 / math.sqrt(attn.head_dim))
+        weights = torch.matmul(query, key.transpose(-2, -1))
+        if attn_mask is not None:
+            weights = weights + attn_mask
+        weights = F.softmax(weights, dim=-1)
+        weights = F.dropout(weights, p=attn.dropout, training=self.training)
+        outputs = torch.matmul(weights, value)  # [batch_size, num_heads, sequence_length, head_dim]
+        outputs = outputs.permute(2, 0, 1, 3).reshape(seq_length, batch_size, attn.embed_dim)
+        return F.linear(outputs, attn.out_proj.weight, attn.out_proj.bias)
+
+    def _cached_self_attention(self, tgt: torch.Tensor, cache: Dict[str, Any]) -> torch.Tensor:
+        """Self attention that only projects the newest tokens and reuses projected keys and values from the cache
+
+        Args:
+            tgt: A Tensor of shape [new_sequence_length, batch_size, embed_size]. Represents the tokens appended in this step.
+            cache: A Dictionary in the following format: {'projected_k': torch.Tensor, 'projected_v': torch.Tensor}, where both tensors
+                   have shape [batch_size, num_heads, past_sequence_length, head_dim]. Updated in place. If the dictionary also holds
+                   an integer 'length' cursor, the tensors are preallocated buffers of shape [batch_size, num_heads, max_length, head_dim]
+                   and only the first 'length' steps are valid. An optional 'start' Tensor of shape [batch_size,] masks the steps a row
+                   wrote before its current sequence started, see TransformerDecoder.reset_cache_rows.
+
+        Returns:
+            tgt2: A Tensor of shape [new_sequence_length, batch_size, embed_size]. Output of the self attention block.
+        """
+        query, key, value = F.linear(tgt, self.self_attn.in_proj_weight, self.self_attn.in_proj_bias).chunk(3, dim=-1)
+        new_length = tgt.shape[0]
+        if "length" in cache:
+            # Preallocated cache, write the new keys and values in place behind the length cursor
+            past_length = cache["length"]
+            end = past_length + new_length
+            if end > cache["projected_k"].shape[2]:
+                raise ValueError(f"Cache of length {cache['projected_k'].shape[2]} can't hold {end} decoding steps")
+            cache["projected_k"][:, :, past_length:end] = self._split_heads(key, self.self_attn)
+            cache["projected_v"][:, :, past_length:end] = self._split_heads(value, self.self_attn)
+            cache["length"] = end
+            key = cache["projected_k"][:, :, :end]
+            value = cache["projected_v"][:, :, :end]
+        else:
+            past_length = cache["projected_k"].shape[2]
+            key = cache["projected_k"] = torch.cat([cache["projected_k"], self._split_heads(key, self.self_attn)], dim=2)
+            value = cache["projected_v"] = torch.cat([cache["projected_v"], self._split_heads(value, self.self_attn)], dim=2)
+
+        attn_mask = None
+        if new_length > 1:
+            # New tokens may only attend to the past and to themselves
+            query_positions = torch.arange(new_length, device=tgt.device)[:, None] + past_length
+            key_positions = torch.arange(past_length + new_length, device=tgt.device)[None]
+            attn_mask = torch.zeros([new_length, past_length + new_length], device=tgt.device)
+            attn_mask = attn_mask.masked_fill(key_positions > query_positions, float("-inf"))
+        if "start" in cache:
+            key_positions = torch.arange(past_length + new_length, device=tgt.device)[None]
+            start_mask = torch.zeros([tgt.shape[1], past_length + new_length], device=tgt.device)
+            start_mask = start_mask.masked_fill(key_positions < cache["start"][:, None], float("-inf"))[:, None, None]
+            attn_mask = start_mask if attn_mask is None else attn_mask + start_mask
+        return self._attend(self._split_heads(query, self.self_attn), key, value, self.self_attn, attn_mask)
+
+
+    def project_memory(self, memory: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Projects the memory sequence into cross attention keys and values
+
+        Args:
+            memory: A Tensor of shape [source_sequence_length, batch_size, embed_size]. Represents the sequence from the last layer of the encoder.
+
+        Returns:
+            memory_k: A Tensor of shape [batch_size, num_heads, source_sequence_length, head_dim].
+            memory_v: A Tensor of shape [batch_size, num_heads, source_sequence_length, head_dim].
+        """
+        embed_dim = self.multihead_attn.embed_dim
+        weight, bias = self.multihead_attn.in_proj_weight, self.multihead_attn.in_proj_bias
+        memory_k, memory_v = F.linear(memory.float(), weight[embed_dim:], bias[embed_dim:]).chunk(2, dim=-1)
+        return self._split_heads(memory_k, self.multihead_attn), self._split_heads(memory_v, self.multihead_attn)
+
+    def _cached_cross_attention(self, tgt: torch.Tensor, cache: Dict[str, Any]) -> torch.Tensor:
+        """Cross attention against memory keys and values that were projected once with project_memory
+
+        Args:
+            tgt: A Tensor of shape [sequence_length, batch_size, embed_size].
+            cache: A Dictionary with 'memory_k' and 'memory_v' tensors of shape [batch_size, num_heads, source_sequence_length, head_dim].
+                   An optional boolean 'memory_key_padding_mask' of shape [batch_size, source_sequence_length] ignores memory elements
+                   that are True.
+
+        Returns:
+            tgt2: A Tensor of shape [sequence_length, batch_size, embed_size]. Output of the cross attention block.
+        """
+        embed_dim = self.multihead_attn.embed_dim
+        query = F.linear(tgt, self.multihead_attn.in_proj_weight[:embed_dim], self.multihead_attn.in_proj_bias[:embed_dim])
+        query = self._split_heads(query, self.multihead_attn)
+        attn_mask = None
+        if "memory_key_padding_mask" in cache:
+            padding_mask = cache["memory_key_padding_mask"]
+            attn_mask = torch.zeros(padding_mask.shape, device=tgt.device).masked_fill(padding_mask, float("-inf"))[:, None, None]
+        return self._attend(query, cache["memory_k"], cache["memory_v"], self.multihead_attn, attn_mask)
+
 
 class PolygenDecoder(pl.LightningModule):
     """
@@ -209,6 +359,7 @@ class TransformerDecoder(pl.LightningModule):
         """
         super(TransformerDecoder, self).__init__()
         self.hidden_size = hidden_size
+        self.num_heads = num_heads
         self.num_layers = num_layers
         self.decoder = PolygenDecoder(
             PolygenDecoderLayer(
@@ -221,20 +372,135 @@ class TransformerDecoder(pl.LightningModule):
             norm=LayerNorm(self.hidden_size),
         )
 
-    def initialize_cache(self, batch_size) -> Dict[str, torch.Tensor]:
+    def initialize_cache(
+        self,
+        batch_size: int,
+        projected: bool = False,
+        max_length: Optional[int] = None,
+        memory: Optional[torch.Tensor] = None,
+        memory_key_padding_mask: Optional[torch.Tensor] = None,
+    ) -> List[Dict[str, Any]]:
         """
         Initializes the cache to be used in fast decoding
 
         Args:
             batch_size: Batch size of the inputs.
+            projected: If True, the cache stores keys and values after the self attention input projection, split into heads,
+                       so that each decoding step only projects the newest token. Otherwise it stores the raw layer inputs.
+            max_length: If provided, the projected cache is allocated once for max_length decoding steps and written in place
+                        through a length cursor instead of growing with every step. Requires projected to be True.
+            memory: If provided, a Tensor of shape [source_sequence_length, batch_size, embed_size] that stays fixed while decoding.
+                    Its cross attention keys and values are projected once here and reused by every decoding step.
+            memory_key_padding_mask: If provided, a boolean Tensor of shape [batch_size, source_sequence_length]. True elements of
+                                     memory are ignored by the cross attention. Requires memory.
         Returns:
             cache: A list of dictionaries where each dictionary contains a key and value for a specific Decoder Layer.
         """
-        k = torch.zeros([0, batch_size, self.hidden_size], device=self.device)
-        v = torch.zeros([0, batch_size, self.hidden_size], device=self.device)
-        cache = [{"k": k, "v": v} for _ in range(self.num_layers)]
+        if max_length is not None and not projected:
+            raise ValueError("Preallocated caches are only supported for projected caches")
+        if memory_key_padding_mask is not None and memory is None:
+            raise ValueError("A memory padding mask requires the memory to cache")
+        if projected:
+            head_dim = self.hidden_size // self.num_heads
+            cache_length = 0 if max_length is None else max_length
+            cache = []
+            for _ in range(self.num_layers):
+                k = torch.zeros([batch_size, self.num_heads, cache_length, head_dim], device=self.device)
+                v = torch.zeros([batch_size, self.num_heads, cache_length, head_dim], device=self.device)
+                layer_cache = {"projected_k": k, "projected_v": v}
+                if max_length is not None:
+                    layer_cache["length"] = 0
+                cache.append(layer_cache)
+        else:
+            k = torch.zeros([0, batch_size, self.hidden_size], device=self.device)
+            v = torch.zeros([0, batch_size, self.hidden_size], device=self.device)
+            cache = [{"k": k, "v": v} for _ in range(self.num_layers)]
+        if memory is not None:
+            for layer, layer_cache in zip(self.decoder.layers, cache):
+                layer_cache["memory_k"], layer_cache["memory_v"] = layer.project_memory(memory)
+                if memory_key_padding_mask is not None:
+                    layer_cache["memory_key_padding_mask"] = memory_key_padding_mask.to(self.device, torch.bool)
         return cache
 
+    def select_cache_rows(self, cache: List[Dict[str, Any]], indices: torch.Tensor) -> None:
+        """
+        Keeps only the given batch rows of a cache, e.g. to drop sequences that finished decoding
+
+        Args:
+            cache: A list of dictionaries in the format returned by initialize_cache. Updated in place.
+            indices: A Tensor of shape [new_batch_size,] with the batch rows to keep.
+        """
+        for layer_cache in cache:
+            for name, tensor in layer_cache.items():
+                if not torch.is_tensor(tensor):
+                    continue
+                batch_dim = 1 if name in ("k", "v") else 0  # Raw caches are [sequence_length, batch_size, embed_size]
+                layer_cache[name] = torch.index_select(tensor, batch_dim, indices.to(tensor.device))
+
+    def reset_cache_rows(
+        self,
+        cache: List[Dict[str, Any]],
+        rows: torch.Tensor,
+        memory: Optional[torch.Tensor] = None,
+        memory_key_padding_mask: Optional[torch.Tensor] = None,
+    ) -> None:
+        """
+        Starts new sequences in the given rows of a preallocated cache while the other rows keep decoding. The new sequences write
+        behind the shared length cursor, and everything their rows wrote before is masked through a per-row 'start' position.
+
+        Args:
+            cache: A list of dictionaries in the format returned by initialize_cache with max_length set. Updated in place.
+            rows: A Tensor of shape [num_rows,] with the batch rows that start a new sequence.
+            memory: If provided, a Tensor of shape [source_sequence_length, num_rows, embed_size] with the memory of the new sequences.
+                    The source sequence length has to match the memory of the other rows.
+            memory_key_padding_mask: If provided, a boolean Tensor of shape [num_rows, source_sequence_length]. True elements of
+                                     memory are ignored by the cross attention of the new sequences.
+        """
+        if "length" not in cache[0]:
+            raise ValueError("Only preallocated caches can start new sequences in some of their rows")
+        batch_size = cache[0]["projected_k"].shape[0]
+        rows = rows.to(self.device)
+        for layer_cache in cache:
+            if "start" not in layer_cache:
+                layer_cache["start"] = torch.zeros([batch_size], dtype=torch.int64, device=self.device)
+            layer_cache["start"][rows] = layer_cache["length"]
+
+        if memory is None:
+            return
+        for layer, layer_cache in zip(self.decoder.layers, cache):
+            memory_k, memory_v = layer.project_memory(memory)
+            if "memory_k" not in layer_cache:
+                layer_cache["memory_k"] = memory_k.new_zeros([batch_size, *memory_k.shape[1:]])
+                layer_cache["memory_v"] = memory_v.new_zeros([batch_size, *memory_v.shape[1:]])
+            layer_cache["memory_k"][rows] = memory_k
+            layer_cache["memory_v"][rows] = memory_v
+            if memory_key_padding_mask is not None:
+                if "memory_key_padding_mask" not in layer_cache:
+                    layer_cache["memory_key_padding_mask"] = torch.zeros(
+                        [batch_size, memory.shape[0]], dtype=torch.bool, device=self.device
+                    )
+                layer_cache["memory_key_padding_mask"][rows] = memory_key_padding_mask.to(self.device)
+
+    def trim_cache(self, cache: List[Dict[str, Any]], num_steps: int) -> None:
+        """
+        Drops the oldest decoding steps of a preallocated cache and moves the remaining steps to the front, freeing num_steps
+        steps behind the length cursor. Only steps that every row has masked through its 'start' position may be dropped.
+
+        Args:
+            cache: A list of dictionaries in the format returned by initialize_cache with max_length set. Updated in place.
+            num_steps: Number of decoding steps to drop.
+        """
+        if num_steps <= 0:
+            return
+        if "start" not in cache[0] or torch.any(cache[0]["start"] < num_steps):
+            raise ValueError(f"Can't drop {num_steps} decoding steps that are still attended to")
+        for layer_cache in cache:
+            length = layer_cache["length"]
+            for name in ["projected_k", "projected_v"]:
+                layer_cache[name][:, :, : length - num_steps] = layer_cache[name][:, :, num_steps:length].clone()
+            layer_cache["length"] = length - num_steps
+            layer_cache["start"] = layer_cache["start"] - num_steps
+
     def generate_square_subsequent_mask(self, sz: int) -> torch.Tensor:
         """
         Generates a target mask for the input sequence
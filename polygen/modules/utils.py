@@ -1,4 +1,5 @@
 import copy
+from typing import Union
 
 import torch
 import torch.nn as nn
@@ -54,6 +55,82 @@ def top_p_logits(logits: torch.Tensor, p: float) -> torch.Tensor:
         return torch.reshape(logits, [-1, seq, dim])
 
 
+def broadcast_rows(value: Union[float, torch.Tensor], logits: torch.Tensor) -> Union[float, torch.Tensor]:
+    """Reshapes a per-row sampling parameter so that it broadcasts against logits
+
+    Args:
+        value: A scalar, or a Tensor of shape [batch_size,] with one value per row of logits
+        logits: Tensor of shape [batch_size, ..., vocab_size]
+
+    Returns:
+        value: The scalar unchanged, or the Tensor reshaped to [batch_size, 1, ..., 1] on the device of logits
+    """
+    if not torch.is_tensor(value):
+        return value
+    return value.to(logits.device).reshape([-1] + [1] * (logits.dim() - 1))
+
+
+def filter_logits(
+    logits: torch.Tensor, top_k: Union[int, torch.Tensor] = 0, top_p: Union[float, torch.Tensor] = 1.0
+) -> torch.Tensor:
+    """Masks logits outside of the top-k and the top-p probability mass of every row, sorting each row at most once
+
+    Args:
+        logits: Tensor of shape [batch_size, ..., vocab_size] representing network predictions
+        top_k: How many logits of every row to keep, 0 keeps all of them. Either a scalar or a Tensor of shape [batch_size,].
+        top_p: Probability mass of every row to keep, after top-k filtering. Either a scalar or a Tensor of shape [batch_size,].
+
+    Returns:
+        logits: logits with the kept logits of every row intact and the others set to -1e9
+    """
+    vocab_size = logits.shape[-1]
+    per_row = torch.is_tensor(top_k) or torch.is_tensor(top_p)
+    if not per_row:
+        if top_k <= 0 or top_k >= vocab_size:
+            top_k = vocab_size
+        if top_k == vocab_size and top_p >= 1:
+            return logits
+        if top_p >= 1:
+            sorted_logits, _ = torch.topk(logits, top_k)
+            return logits.masked_fill(logits < sorted_logits[..., -1:], -1e9)
+    else:
+        top_k = torch.as_tensor(top_k, dtype=torch.int64, device=logits.device)
+        top_k = torch.where((top_k <= 0) | (top_k > vocab_size), torch.full_like(top_k, vocab_size), top_k)
+        top_k = broadcast_rows(top_k.expand(logits.shape[0]), logits)
+        top_p = broadcast_rows(torch.as_tensor(top_p, dtype=logits.dtype, device=logits.device).expand(logits.shape[0]), logits)
+        if torch.all(top_p >= 1):
+            if torch.all(top_k == vocab_size):
+                return logits
+            # Only the largest top_k of the batch needs to be sorted
+            sorted_logits, _ = torch.topk(logits, int(torch.max(top_k)))
+            threshold = torch.gather(sorted_logits, -1, (top_k - 1).expand(*logits.shape[:-1], 1))
+            return logits.masked_fill(logits < threshold, -1e9)
+
+    sorted_logits, _ = torch.sort(logits, descending=True)
+    ranks = torch.arange(vocab_size, device=logits.device)
+    sorted_logits = sorted_logits.masked_fill(ranks >= top_k, float("-inf"))
+    sorted_probs = F.softmax(sorted_logits, dim=-1)
+    # A logit is kept while the probability mass before it is at most top_p, so at least one logit is always kept
+    num_kept = torch.sum(torch.cumsum(sorted_probs, dim=-1) - sorted_probs <= top_p, dim=-1, keepdim=True)
+    num_kept = torch.clamp(torch.minimum(num_kept, torch.as_tensor(top_k, device=logits.device)), min=1)
+    threshold = torch.gather(sorted_logits, -1, num_kept - 1)
+    return logits.masked_fill(logits < threshold, -1e9)
+
+
+def gumbel_max_sample(logits: torch.Tensor) -> torch.Tensor:
+    """Samples one index per row from the categorical distribution given by logits with the Gumbel-max trick
+
+    Args:
+        logits: Tensor of shape [..., vocab_size] with unnormalized log probabilities
+
+    Returns:
+        samples: Tensor of shape [...] with the sampled indices
+    """
+    # argmax(logits + Gumbel noise), where the Gumbel noise is -log(E) with E drawn from an exponential distribution
+    exponential_noise = torch.empty_like(logits, dtype=torch.float32).exponential_()
+    return torch.argmax(logits - torch.log(exponential_noise), dim=-1)
+
+
 def get_clones(module: nn.Module, N: int) -> ModuleList:
     """Clone a module n-times
 
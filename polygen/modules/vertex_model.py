@@ -1,4 +1,4 @@
-from typing import Dict, Optional, Tuple, List, Any
+from typing import Dict, Optional, Tuple, List, Any, Union
 import pdb
 
 import torch
@@ -9,7 +9,7 @@ import pytorch_lightning as pl
 from polygen.utils.data_utils import dequantize_verts
 
 from .polygen_decoder import TransformerDecoder
-from .utils import top_k_logits, top_p_logits
+from .utils import broadcast_rows, filter_logits, gumbel_max_sample
 from .image_encoder import PolygenResnet
 
 
@@ -135,6 +135,54 @@ class VertexModel(pl.LightningModule):
         # Changing the dimension from [batch_size, seq_length, embed_size] to [seq_length, batch_size, embed_size] for TransformerDecoder
         return embeddings.transpose(0, 1)
 
+    def _embed_next_input(self, vertices: torch.Tensor, global_context_embedding: torch.Tensor = None) -> torch.Tensor:
+        """
+        Embeds only the newest flat vertex token for cached decoding. Gives the same result as the last element of _embed_inputs
+        but looks up a single coordinate and position embedding row instead of embedding the whole prefix.
+
+        Args:
+            vertices: A Tensor of shape [batch_size, sample_length]. Represents current sampled vertices, only the last column is embedded.
+            global_context_embedding: A Tensor of shape [batch_size, embed_size]. Represents class label conditioning.
+        Returns:
+            embeddings: A Tensor of shape [1, batch_size, embed_size]. If nothing has been sampled yet, this is the beginning of sequence embedding.
+        """
+        batch_size, seq_length = vertices.shape[0], vertices.shape[1]
+        if seq_length == 0:
+            if global_context_embedding is None:
+                return torch.repeat_interleave(self.zero_embed, batch_size, dim=0).transpose(0, 1)
+            return global_context_embedding[None].to(torch.float32)
+
+        positions = torch.full([batch_size], seq_length, dtype=torch.int64, device=self.device)
+        return self._embed_step(vertices[:, -1], positions, global_context_embedding)
+
+    def _embed_step(
+        self,
+        last_tokens: torch.Tensor,
+        positions: torch.Tensor,
+        global_context_embedding: torch.Tensor = None,
+    ) -> torch.Tensor:
+        """
+        Embeds the newest flat vertex token of every row for cached decoding, where rows can be at different positions of their sequence.
+
+        Args:
+            last_tokens: A Tensor of shape [batch_size,]. Represents the last sampled token of every row. Ignored for rows at position 0.
+            positions: A Tensor of shape [batch_size,]. Represents how many tokens every row has sampled so far.
+            global_context_embedding: A Tensor of shape [batch_size, embed_size]. Represents class label conditioning.
+        Returns:
+            embeddings: A Tensor of shape [1, batch_size, embed_size]. Rows at position 0 get the beginning of sequence embedding.
+        """
+        positions = positions.to(self.device)
+        token_positions = torch.clamp(positions - 1, min=0)
+        position_embeddings = self.coord_embedder(token_positions % 3) + self.pos_embedder(token_positions // 3)
+        vert_embeddings = self.vert_embedder_discrete(last_tokens.to(device=self.device, dtype=torch.int64))
+        embeddings = vert_embeddings + position_embeddings  # [batch_size, embed_size]
+        if global_context_embedding is None:
+            bos_embeddings = self.zero_embed[0].expand(positions.shape[0], -1)
+        else:
+            bos_embeddings = global_context_embedding.to(torch.float32)
+        embeddings = torch.where((positions == 0)[:, None], bos_embeddings, embeddings)
+        return embeddings[None]
+
     def _project_to_logits(self, inputs: torch.Tensor) -> torch.Tensor:
         """Runs decoder outputs through a linear layer
 
@@ -152,9 +200,9 @@ class VertexModel(pl.LightningModule):
         global_context_embedding: Optional[torch.Tensor] = None,
         sequential_context_embedding: Optional[torch.Tensor] = None,
         cache: Optional[List[Dict[str, torch.Tensor]]] = None,
-        temperature: float = 1.0,
-        top_k: int = 0,
-        top_p: int = 1,
+        temperature: Union[float, torch.Tensor] = 1.0,
+        top_k: Union[int, torch.Tensor] = 0,
+        top_p: Union[float, torch.Tensor] = 1.0,
     ) -> torch.Tensor:
         """Creates a predictive distribution for the next vertex sample
 
@@ -163,17 +211,19 @@ class VertexModel(pl.LightningModule):
             global_context_embedding: A Tensor of shape [batch_size, embed_size]. Represents conditioning on class labels.
             sequential_context_embeddings: A Tensor of shape [batch_size, context_seq_length, context_embed_size]. Represents conditioning on images or voxels.
             cache:  A list of dictionaries in the following format: {'k': torch.Tensor, 'v': torch.Tensor}. Each dictionary in the list represents the cache at the respective decoder layer.
-            temperature: Scalar softmax temperature > 0.
-            top_k: Number of tokens to take out for top-k sampling.
-            top-p: Proportion of probability mass to keep for top-p sampling.
+            temperature: Softmax temperature > 0. Either a scalar or a Tensor of shape [batch_size,] with one value per row.
+            top_k: Number of tokens to keep for top-k sampling. Either a scalar or a Tensor of shape [batch_size,].
+            top-p: Proportion of probability mass to keep for top-p sampling. Either a scalar or a Tensor of shape [batch_size,].
         Returns:
             logits: Logits that can be used to create a categorical distribution to sample the next vertex.
         """
         # vertices has dims [B, max_vertices_in_batch * 3] (without appended stop token)
         # decoder_inputs has dims [max_vertices_in_batch * 3 + 1, B, hidden_dim]
-        decoder_inputs = self._embed_inputs(vertices.to(torch.int64), global_context_embedding) # [T, B, hidden_dim], T is the sequence length
         if cache is not None:
-            decoder_inputs = decoder_inputs[-1:, :]
+            # The cache already holds every previous token, so only the newest one is embedded
+            decoder_inputs = self._embed_next_input(vertices, global_context_embedding) # [1, B, hidden_dim]
+        else:
+            decoder_inputs = self._embed_inputs(vertices.to(torch.int64), global_context_embedding) # [T, B, hidden_dim], T is the sequence length
         if sequential_context_embedding is not None:
             sequential_context_embedding = sequential_context_embedding.transpose(0, 1)
         outputs = self.decoder(
@@ -185,11 +235,9 @@ class VertexModel(pl.LightningModule):
         )  # Transpose to convert from [seq_length, batch_size, embedding_dim] to [batch_size, seq_length, embedding_dim]
         # pass through linear layer
         logits = self._project_to_logits(outputs) # [batch_size, sequence_length, 2 ** self.quantization_bits + 1]
-        logits = logits / temperature
-        # remove the smaller logits
-        logits = top_k_logits(logits, top_k) # shape of the tensor doesn't change
-        # then choose those that contribute to 90% of mass distribution
-        logits = top_p_logits(logits, top_p)
+        logits = logits / broadcast_rows(temperature, logits)
+        # keep the top-k logits of every row, then those that contribute to top_p of the probability mass
+        logits = filter_logits(logits, top_k, top_p) # shape of the tensor doesn't change
         return logits
 
     def forward(self, batch: Dict[str, torch.Tensor]) -> torch.Tensor:
@@ -227,6 +275,7 @@ class VertexModel(pl.LightningModule):
             vertex_pred_dist.log_prob(vertex_model_batch["vertices_flat"]) * vertex_model_batch["vertices_flat_mask"]
         )
         self.log("train_loss", vertex_loss)
+        self.log("padding_ratio", 1 - vertex_model_batch["vertices_flat_mask"].float().mean())
         return vertex_loss
 
     def configure_optimizers(self) -> Dict[str, Any]:
@@ -268,11 +317,12 @@ class VertexModel(pl.LightningModule):
         num_samples: int,
         max_sample_length: int = 50,
         context: Dict[str, torch.Tensor] = None,
-        temperature: float = 1.0,
-        top_k: int = 0,
-        top_p: float = 1.0,
+        temperature: Union[float, torch.Tensor] = 1.0,
+        top_k: Union[int, torch.Tensor] = 0,
+        top_p: Union[float, torch.Tensor] = 1.0,
         recenter_verts: bool = True,
         only_return_complete: bool = False,
+        stop_check_interval: int = 1,
     ) -> Dict[str, torch.Tensor]:
         """Autoregressive sampling method to generate vertices
 
@@ -280,11 +330,14 @@ class VertexModel(pl.LightningModule):
             num_samples: Number of samples to produce.
             context: A dictionary with the type of context to condition upon. This could be class labels or images or voxels.
             max_sample_length: Maximum length of sampled vertex samples. Sequences that do not complete are truncated.
-            temperature: Scalar softmax temperature > 0.
-            top_k: Number of tokens to keep for top-k sampling.
-            top-p: Proportion of probability mass to keep for top-p sampling.
+            temperature: Softmax temperature > 0. Either a scalar or a Tensor of shape [num_samples,] with one value per sample.
+            top_k: Number of tokens to keep for top-k sampling. Either a scalar or a Tensor of shape [num_samples,].
+            top-p: Proportion of probability mass to keep for top-p sampling. Either a scalar or a Tensor of shape [num_samples,].
             recenter_verts: If True, center vertex samples around origin. This should be used if model is trained using shift augmentations.
             only_return_complete: If True, only return completed samples. Otherwise return all samples along with completed indicator.
+            stop_check_interval: Number of decoding steps between checks for stop tokens. Every check waits for the device to finish the
+                                 previous steps, so larger intervals save synchronizations at the cost of decoding finished samples
+                                 for up to stop_check_interval - 1 extra steps. Tokens after a stop token are ignored either way.
 
         Returns:
             outputs: Output dictionary with fields
@@ -293,6 +346,8 @@ class VertexModel(pl.LightningModule):
                 'num_vertices': Tensor indicating number of vertices for each example in padded vertex samples.
                 'vertices_mask': Tensor of shape [num_samples, num_verts] that masks corresponding invalid elements in vertices.
         """
+        if stop_check_interval < 1:
+            raise ValueError(f"stop_check_interval should be at least 1, got {stop_check_interval}")
         global_context, seq_context = self._prepare_context(context)
 
         # limit context shape to number of samples desired
@@ -304,25 +359,29 @@ class VertexModel(pl.LightningModule):
         elif seq_context is not None:
             num_samples = min(num_samples, seq_context.shape[0])
             seq_context = seq_context[:num_samples]
+        # Per-sample sampling parameters follow the rows of the batch
+        temperature, top_k, top_p = [
+            value[:num_samples].to(self.device) if torch.is_tensor(value) else value
+            for value in (temperature, top_k, top_p)
+        ]
 
         def _loop_body(
             i: int,
             samples: torch.Tensor,
-            cache: Optional[List[Dict[str, torch.Tensor]]] = None,
-        ) -> Tuple[int, torch.Tensor]:
-            """While-loop body for autoregression calculation.
+            cache: List[Dict[str, Any]],
+        ) -> int:
+            """While-loop body for autoregression calculation. Writes the next token in place.
 
             Args:
                 i: Current iteration in the loop
-                samples: tensor of shape [num_samples, i].
-                cache: A list of dictionaries in the following format: {'k': torch.Tensor, 'v': torch.Tensor}.
+                samples: preallocated tensor of shape [num_active_samples, max_sample_length * 3 + 1]. The first i columns are sampled.
+                cache: A list of dictionaries in the format returned by TransformerDecoder.initialize_cache.
                        Each dictionary in the list represents the cache at the respective decoder layer.
             Returns:
                 next_iter: i + 1.
-                samples: tensor of shape [num_samples, i + 1] or of shape [num_samples, 2 * i + 1] if cache doesn't exist.
             """
             logits = self._create_dist(
-                samples,
+                samples[:, :i],
                 global_context_embedding=global_context,
                 sequential_context_embedding=seq_context,
                 cache=cache,
@@ -330,31 +389,42 @@ class VertexModel(pl.LightningModule):
                 top_k=top_k,
                 top_p=top_p,
             )
-            cat_dist = torch.distributions.categorical.Categorical(logits=logits)
-            next_sample = cat_dist.sample()
-            samples = torch.cat([samples, next_sample.to(torch.int32)], dim=1)
-            return i + 1, samples
+            samples[:, i] = gumbel_max_sample(logits[:, -1])
+            return i + 1
 
-        def _stopping_cond(samples: torch.Tensor) -> bool:
-            """
-            Stopping condition for sampling while-loop. Looking for stop token (represented by 0)
-            Args:
-                samples: tensor of shape [num_samples, i], where i is the current iteration.
-            Returns:
-                token_found: Boolean that represents if stop token has been found.
-            """
-            nonzero_boolean_matrix = torch.ne(samples, 0)
-            reduced_matrix = torch.all(
-                nonzero_boolean_matrix, dim=-1
-            )  # Checks if stopping token is present in every row
-            return torch.any(reduced_matrix)
-
-        samples = torch.zeros([num_samples, 0], dtype=torch.int32)
-        cache = self.decoder.initialize_cache(num_samples)
         max_sample_length = max_sample_length or self.max_num_input_verts
+        max_decoding_steps = max_sample_length * 3 + 1
+        # The token buffers and the decoder cache are allocated once on the model device and filled in place through the step counter j
+        samples = torch.zeros([num_samples, max_decoding_steps], dtype=torch.int32, device=self.device)
+        active_samples = torch.zeros([num_samples, max_decoding_steps], dtype=torch.int32, device=self.device)
+        # Image context never changes while sampling, so its cross attention keys and values are projected once
+        memory = seq_context.transpose(0, 1) if seq_context is not None else None
+        cache = self.decoder.initialize_cache(
+            num_samples, projected=True, max_length=max_decoding_steps, memory=memory
+        )
+
+        # Rows that sampled a stop token are dropped from the decoded batch. active_rows maps the rows
+        # that are still decoding to their row in samples, where finished rows are written back.
+        active_rows = torch.arange(num_samples, device=self.device)
         j = 0
-        while _stopping_cond(samples) and j < max_sample_length * 3 + 1:
-            j, samples = _loop_body(j, samples, cache)
+        while active_rows.shape[0] > 0 and j < max_decoding_steps:
+            j = _loop_body(j, active_samples, cache)
+            if j % stop_check_interval != 0:
+                continue
+            finished = torch.any(active_samples[:, :j] == 0, dim=-1)
+            if torch.any(finished):
+                samples[active_rows[finished]] = active_samples[finished]
+                keep = torch.nonzero(~finished).squeeze(-1)
+                active_rows = active_rows[keep]
+                active_samples = active_samples[keep]
+                global_context = global_context[keep] if global_context is not None else None
+                seq_context = seq_context[keep] if seq_context is not None else None
+                temperature, top_k, top_p = [
+                    value[keep] if torch.is_tensor(value) else value for value in (temperature, top_k, top_p)
+                ]
+                self.decoder.select_cache_rows(cache, keep)
+        samples[active_rows] = active_samples
+        samples = samples[:, :j].cpu()
 
         completed_samples_boolean = samples == 0  # Checks for stopping token
         completed = torch.any(
@@ -444,18 +514,36 @@ class ImageToVertexModel(VertexModel):
         self.res_net = PolygenResnet()
         for param in self.res_net.parameters():
             param.requires_grad = False
+        self.res_net.eval()
         self.embedder = nn.Linear(2, self.embedding_dim)
 
+    def train(self, mode: bool = True) -> "ImageToVertexModel":
+        """Sets the training mode of the model, keeping the frozen resnet in eval mode
+
+        The batch norms of the resnet would otherwise normalize with batch statistics and update their running
+        statistics during training, so the backbone would not be frozen and cached features would go stale.
+        """
+        super(ImageToVertexModel, self).train(mode)
+        self.res_net.eval()
+        return self
+
     def _prepare_context(self, context: Dict[str, torch.Tensor]) -> Tuple[None, torch.Tensor]:
         """Creates image embeddings using resnet and flattened image
 
         Args:
-            context: A dictionary that contains an image
+            context: A dictionary that contains a float image in [0, 1] or a uint8 image, or resnet features of the
+                image cached with polygen.utils.feature_store under "image_features"
 
         Returns:
             sequential_context_embeddings: Processed image embeddings
         """
-        image_embeddings = self.res_net(context["image"] - 0.5)
+        if "image_features" in context:
+            image_embeddings = context["image_features"].to(self.embedder.weight.dtype)
+        else:
+            image = context["image"]
+            if image.dtype == torch.uint8:
+                image = image.to(self.embedder.weight.dtype) / 255
+            image_embeddings = self.res_net(image - 0.5)
         image_embeddings = image_embeddings.permute(0, 2, 3, 1)
         processed_image_resolution = image_embeddings.shape[1:3]
         x = torch.linspace(-1, 1, processed_image_resolution[0], device=self.device)
@@ -27,6 +27,11 @@ class VertexModelConfig:
         gamma: float,
         training_steps: int,
         image_model: bool = False,
+        manifest_path: Optional[str] = None,
+        max_tokens_per_batch: Optional[int] = None,
+        compact_dtypes: bool = False,
+        feature_store_dir: Optional[str] = None,
+        shard_dir: Optional[str] = None,
     ) -> None:
         """Initializes vertex model and vertex data module
 
@@ -48,6 +53,11 @@ class VertexModelConfig:
             gamma: Decay rate for lr scheduler
             training_steps: How many total steps we want to train for
             image_model: Whether we're training the image model or class-conditioned model
+            manifest_path: Manifest of the dataset built with polygen.utils.manifest
+            max_tokens_per_batch: Token budget of a batch per device, batches are bucketed by length, needs a manifest
+            compact_dtypes: Whether batches hold the smallest integer types that fit, to shrink worker transfers
+            feature_store_dir: Where the image model caches the features of its frozen resnet, rebuilt when stale
+            shard_dir: Tar shards of the dataset built with polygen.utils.mesh_shards, streamed instead of dataset_path
         """
 
         self.num_gpus = torch.cuda.device_count()
@@ -92,6 +102,12 @@ class VertexModelConfig:
             quantization_bits=quantization_bits,
             use_image_dataset = image_model,
             apply_random_shift_vertices=apply_random_shift,
+            manifest_path=manifest_path,
+            max_tokens_per_batch=max_tokens_per_batch,
+            compact_dtypes=compact_dtypes,
+            feature_store_dir=feature_store_dir if image_model else None,
+            feature_backbone=self.vertex_model.res_net if image_model else None,
+            shard_dir=shard_dir,
         )
 
         self.training_steps = training_steps
@@ -118,6 +134,10 @@ class FaceModelConfig:
         step_size: int,
         gamma: float,
         training_steps: int,
+        manifest_path: Optional[str] = None,
+        max_tokens_per_batch: Optional[int] = None,
+        compact_dtypes: bool = False,
+        shard_dir: Optional[str] = None,
     ):
         """Initializes face model and face data module
 
@@ -141,6 +161,10 @@ class FaceModelConfig:
             step_size: How often to use lr scheduler
             gamma: Decay rate for lr scheduler
             training_steps: How many total steps we want to train for
+            manifest_path: Manifest of the dataset built with polygen.utils.manifest
+            max_tokens_per_batch: Token budget of a batch per device, batches are bucketed by length, needs a manifest
+            compact_dtypes: Whether batches hold the smallest integer types that fit, to shrink worker transfers
+            shard_dir: Tar shards of the dataset built with polygen.utils.mesh_shards, streamed instead of dataset_path
         """
 
         self.num_gpus = torch.cuda.device_count()
@@ -159,6 +183,10 @@ class FaceModelConfig:
             quantization_bits = quantization_bits,
             apply_random_shift_faces = apply_random_shift,
             shuffle_vertices = shuffle_vertices,
+            manifest_path = manifest_path,
+            max_tokens_per_batch = max_tokens_per_batch,
+            compact_dtypes = compact_dtypes,
+            shard_dir = shard_dir,
         )
 
         self.face_model = FaceModel(
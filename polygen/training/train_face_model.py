@@ -24,6 +24,8 @@ def main() -> None:
         accelerator=face_model_config.accelerator,
         gpus=face_model_config.num_gpus,
         max_epochs=num_epochs,
+        # The token budget batch sampler splits batches across ranks itself
+        replace_sampler_ddp=face_data_module.max_tokens_per_batch is None,
     )
     trainer.fit(face_model, face_data_module)
 
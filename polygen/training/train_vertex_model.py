@@ -26,6 +26,8 @@ def main(config_name: str) -> None:
         accelerator=vertex_model_config.accelerator,
         gpus=vertex_model_config.num_gpus,
         max_epochs=num_epochs,
+        # The token budget batch sampler splits batches across ranks itself
+        replace_sampler_ddp=vertex_data_module.max_tokens_per_batch is None,
     )
     trainer.fit(model=vertex_model, datamodule=vertex_data_module)
 
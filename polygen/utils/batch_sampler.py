@@ -0,0 +1,123 @@
+"""Batch sampler that groups meshes of similar length and caps batches by their padded number of tokens"""
+import math
+from typing import Iterator, List, Optional, Sequence
+
+import numpy as np
+import torch.distributed as dist
+from torch.utils.data import Sampler
+
+
+class TokenBudgetBatchSampler(Sampler[List[int]]):
+    def __init__(
+        self,
+        lengths: Sequence[int],
+        max_tokens: int,
+        max_batch_size: Optional[int] = None,
+        bucket_size: int = 1024,
+        shuffle: bool = True,
+        seed: int = 0,
+        num_replicas: Optional[int] = None,
+        rank: Optional[int] = None,
+        drop_last: bool = False,
+    ) -> None:
+        """Length-bucketed batch sampler with a token budget
+
+        Every epoch the dataset is shuffled and cut into buckets of bucket_size elements. Each bucket is sorted by
+        length and cut into batches whose padded size, number of elements times the longest element, stays within
+        max_tokens. The batches of all buckets are then shuffled together, so that lengths are mixed across steps.
+        Every rank plans the same batches from the same seed and takes every num_replicas-th of them.
+
+        Args:
+            lengths: Token length of every dataset element
+            max_tokens: Maximum number of tokens of a batch, padding included. Longer elements are batched alone.
+            max_batch_size: Maximum number of elements of a batch
+            bucket_size: Number of elements sorted together. Larger buckets pad less and shuffle less.
+            shuffle: Whether to shuffle the elements and batches every epoch
+            seed: Seed of the shuffles, must be the same on every rank
+            num_replicas: Number of distributed processes, defaults to the world size
+            rank: Rank of this process, defaults to the current rank
+            drop_last: Whether to drop the last batches instead of repeating batches so that every rank gets as many
+        """
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+        if not 0 <= rank < num_replicas:
+            raise ValueError(f"Invalid rank {rank}, rank should be in the interval [0, {num_replicas - 1}]")
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.drop_last = drop_last
+        self.epoch = 0
+        # Epoch of the last iteration, unless set_epoch was called since
+        self._iterated_epoch = None
+        self._planned_epoch = None
+        self._batches = None
+        # Fraction of padding tokens in the batches of the last planned epoch
+        self.padding_ratio = None
+
+    def set_epoch(self, epoch: int) -> None:
+        """Sets the epoch the shuffles are seeded with, like DistributedSampler.set_epoch"""
+        self.epoch = epoch
+        self._iterated_epoch = None
+
+    def _pack_bucket(self, bucket: np.ndarray) -> List[List[int]]:
+        """Cuts a bucket into batches within the token budget, in order of increasing length"""
+        bucket = bucket[np.argsort(self.lengths[bucket], kind="stable")]
+        batches, batch = [], []
+        for idx, length in zip(bucket.tolist(), self.lengths[bucket].tolist()):
+            # The bucket is sorted, so the new element is the longest of the batch
+            too_many_tokens = (len(batch) + 1) * length > self.max_tokens
+            too_many_elements = self.max_batch_size is not None and len(batch) >= self.max_batch_size
+            if batch and (too_many_tokens or too_many_elements):
+                batches.append(batch)
+                batch = []
+            batch.append(idx)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def batches(self) -> List[List[int]]:
+        """Plans the batches of this rank for the current epoch"""
+        if self._planned_epoch == self.epoch:
+            return self._batches
+        rng = np.random.default_rng([self.seed, self.epoch])
+        order = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        batches = []
+        for start in range(0, len(order), self.bucket_size):
+            batches.extend(self._pack_bucket(order[start : start + self.bucket_size]))
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+
+        # Every rank needs the same number of batches, or the gradient synchronization hangs
+        if self.drop_last:
+            num_batches = len(batches) // self.num_replicas
+        else:
+            num_batches = math.ceil(len(batches) / self.num_replicas)
+            padding = num_batches * self.num_replicas - len(batches)
+            batches += (batches * math.ceil(padding / max(len(batches), 1)))[:padding]
+        batches = batches[self.rank : num_batches * self.num_replicas : self.num_replicas]
+
+        num_tokens = sum(int(self.lengths[batch].sum()) for batch in batches)
+        num_padded_tokens = sum(len(batch) * int(self.lengths[batch].max()) for batch in batches)
+        self.padding_ratio = 1 - num_tokens / num_padded_tokens if num_padded_tokens else 0.0
+        self._planned_epoch, self._batches = self.epoch, batches
+        return batches
+
+    def __iter__(self) -> Iterator[List[int]]:
+        # Lightning only calls set_epoch on samplers, not on batch samplers, so iterating again without set_epoch
+        # advances to the next epoch. Advancing here rather than after planning keeps __len__ and padding_ratio on the
+        # epoch being iterated.
+        if self._iterated_epoch == self.epoch:
+            self.epoch += 1
+        self._iterated_epoch = self.epoch
+        return iter(self.batches())
+
+    def __len__(self) -> int:
+        """Number of batches of this rank in the current epoch, which is the epoch being iterated"""
+        return len(self.batches())
@@ -1,10 +1,13 @@
 """Utils for manipulating obj data, code is adapted from https://github.com/deepmind/deepmind-research/blob/master/polygen/data_utils.py"""
+import io
+import itertools
 import os
+import re
 import six
+import warnings
 from six.moves import range
 from typing import List, Tuple, Dict, Optional
 
-import networkx as nx
 import numpy as np
 import torch
 
@@ -20,33 +23,91 @@ MIN_RANGE = -0.5
 MAX_RANGE = 0.5
 
 
-def random_shift(vertices: torch.Tensor, shift_factor: float = 0.25) -> torch.Tensor:
+def random_shift(vertices: torch.Tensor, shift_factor: float = 0.25, quantization_bits: int = 8) -> torch.Tensor:
     """Randomly shift vertices in a cube according to some shift factor
 
     Args:
         vertices: tensor of shape (num_vertices, 3) representing current vertices
         shift_factor: float representing how much vertices should be shifted
+        quantization_bits: number of quantization bits, the vertices stay within [0, 2 ** quantization_bits - 1]
 
     Returns:
         vertices: Shifted vertices
     """
+    return random_shift_batch(vertices, torch.tensor([vertices.shape[0]]), shift_factor, quantization_bits)
 
-    max_positive_shift = (255 - torch.max(vertices, dim=0)[0]).to(torch.float32)
-    positive_condition_tensor = max_positive_shift > 1e-9
-    max_positive_shift = torch.where(positive_condition_tensor, max_positive_shift, torch.Tensor([1e-9, 1e-9, 1e-9]))
 
-    max_negative_shift = torch.min(vertices, dim=0)[0].to(torch.float32)
-    negative_condition_tensor = max_negative_shift > 1e-9
-    max_negative_shift = torch.where(negative_condition_tensor, max_negative_shift, torch.Tensor([1e-9, 1e-9, 1e-9]))
+def random_shift_batch(
+    vertices: torch.Tensor,
+    num_vertices: torch.Tensor,
+    shift_factor: float = 0.25,
+    quantization_bits: int = 8,
+    seeds: Optional[List[int]] = None,
+) -> torch.Tensor:
+    """Randomly shifts every mesh of a batch in a cube, drawing the shifts of all meshes from one truncated normal
+
+    Args:
+        vertices: Tensor of shape (sum(num_vertices), 3) with the quantized vertices of the meshes one after another
+        num_vertices: Tensor of shape (num_meshes,) with the number of vertices of every mesh
+        shift_factor: Standard deviation of the shift as a fraction of the quantization range
+        quantization_bits: number of quantization bits, the vertices stay within [0, 2 ** quantization_bits - 1]
+        seeds: Seed of every mesh. If provided, the shift of a mesh only depends on its seed.
+
+    Returns:
+        vertices: Shifted vertices, with the same shape and dtype
+    """
+    num_meshes = len(num_vertices)
+    max_value = 2 ** quantization_bits - 1
+    mesh_ids = torch.repeat_interleave(torch.arange(num_meshes), num_vertices)[:, None].expand(-1, 3)
+    float_vertices = vertices.to(torch.float32)
+    max_vertices = torch.zeros([num_meshes, 3]).scatter_reduce(0, mesh_ids, float_vertices, "amax", include_self=False)
+    min_vertices = torch.zeros([num_meshes, 3]).scatter_reduce(0, mesh_ids, float_vertices, "amin", include_self=False)
+    max_positive_shift = (max_value - max_vertices).clamp_min(1e-9)
+    max_negative_shift = min_vertices.clamp_min(1e-9)
     normal_dist = TruncatedNormal(
-        loc=torch.zeros((1, 3)),
-        scale=shift_factor * 255,
+        loc=torch.zeros((num_meshes, 3)),
+        scale=shift_factor * max_value,
         a=-max_negative_shift,
         b=max_positive_shift,
     )
-    shift = normal_dist.sample().to(torch.int32)
-    vertices += shift
-    return vertices
+    if seeds is None:
+        uniform = torch.rand([num_meshes, 3])
+    else:
+        uniform = torch.stack([torch.rand(3, generator=torch.Generator().manual_seed(int(seed))) for seed in seeds])
+    # Same open interval as TruncatedStandardNormal.rsample, so that icdf stays finite
+    uniform = uniform.clamp(normal_dist._dtype_min_gt_0, normal_dist._dtype_max_lt_1)
+    shift = normal_dist.icdf(uniform).to(torch.int32)
+    # Shifts are added in int32, as negative shifts do not fit compact unsigned vertices
+    return (vertices.to(torch.int32) + shift[mesh_ids[:, 0]]).to(vertices.dtype)
+
+
+def compact_vertex_dtype(quantization_bits: int) -> torch.dtype:
+    """Smallest torch integer type that holds vertices quantized with quantization_bits"""
+    if quantization_bits <= 8:
+        return torch.uint8
+    return torch.int16 if quantization_bits <= 15 else torch.int32
+
+
+def compact_index_dtype(max_value: int) -> torch.dtype:
+    """int16 if indices or tokens up to max_value fit into it, int32 otherwise"""
+    return torch.int16 if max_value <= torch.iinfo(torch.int16).max else torch.int32
+
+
+def compact_mesh(
+    vertices: torch.Tensor, faces: torch.Tensor, quantization_bits: int = 8
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Converts quantized vertices and flattened faces to the smallest integer types that hold them
+
+    Args:
+        vertices: Tensor of shape (num_vertices, 3) with quantized vertices
+        faces: Tensor of shape (num_face_indices,) with flattened faces, where vertex i is index i + 2
+        quantization_bits: number of quantization bits
+
+    Returns:
+        vertices: uint8 vertices for up to 8 quantization bits, int16 vertices for up to 15
+        faces: int16 faces if the mesh has fewer than 32766 vertices, int32 faces otherwise
+    """
+    return vertices.to(compact_vertex_dtype(quantization_bits)), faces.to(compact_index_dtype(vertices.shape[0] + 1))
 
 # obj file processing code taken from original PolyGen repo: https://github.com/google-deepmind/deepmind-research/tree/master/polygen
 def read_obj_file(obj_file):
@@ -92,6 +153,248 @@ def read_obj(obj_path):
   with open(obj_path) as obj_file:
     return read_obj_file(obj_file)
 
+
+def _is_separator(chars: np.ndarray) -> np.ndarray:
+    """Whether every character of a uint8 array is a space, a tab or a newline"""
+    return (chars == ord(" ")) | (chars == ord("\t")) | (chars == ord("\n"))
+
+
+def _split_tokens(chars: np.ndarray, num_lines: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Finds the whitespace separated tokens of newline terminated lines
+
+    Args:
+        chars: uint8 array with the characters of the lines
+        num_lines: Number of lines
+
+    Returns:
+        token_starts: Array with the position of the first character of every token
+        num_tokens: Array of shape (num_lines,) with the number of tokens on every line
+    """
+    is_separator = _is_separator(chars)
+    is_token_start = ~is_separator
+    is_token_start[1:] &= is_separator[:-1]
+    token_starts = np.flatnonzero(is_token_start)
+    line_ids = np.searchsorted(np.flatnonzero(chars == ord("\n")), token_starts)
+    return token_starts, np.bincount(line_ids, minlength=num_lines)
+
+
+def _integer_face_vertices(
+    face_chars: np.ndarray, token_starts: np.ndarray, num_vertices: int
+) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """Parses face vertex names made of 1 to 3 integers, such as 3, 3/5 or 3/5/7, without building strings
+
+    Names are compared by their integers, which is the same as comparing the strings when no integer has a
+    leading zero.
+
+    Args:
+        face_chars: uint8 array with the newline terminated payloads of all face records
+        token_starts: Array with the position of the first character of every face vertex name
+        num_vertices: Number of vertex records
+
+    Returns:
+        names: Array of shape (num_names, num_indices) with the indices of every distinct name, in the order
+            of their first occurrence. None if some names are not of this form.
+        name_ids: Array of shape (num_tokens,) with the position of every face vertex in names
+    """
+    # Wraps around for characters before "0"
+    is_digit = (face_chars - np.uint8(ord("0"))) < 10
+    is_slash = face_chars == ord("/")
+    if not np.all(is_digit | is_slash | _is_separator(face_chars)):
+        return None
+    follows_digit = np.zeros_like(is_digit)
+    follows_digit[1:] = is_digit[:-1]
+    precedes_digit = np.zeros_like(is_digit)
+    precedes_digit[:-1] = is_digit[1:]
+    # Empty indices (3//7) and leading zeros need to be compared as strings
+    if np.any(is_slash & ~(follows_digit & precedes_digit)) or np.any((face_chars == ord("0")) & ~follows_digit):
+        return None
+    slashes_per_token = np.add.reduceat(is_slash, token_starts, dtype=np.int64)
+    if np.any(slashes_per_token != slashes_per_token[0]) or slashes_per_token[0] > 2:
+        return None
+
+    separated = np.where(is_slash, np.uint8(ord(" ")), face_chars)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        indices = np.fromstring(separated.tobytes(), dtype=np.int64, sep=" ")
+    indices = indices.reshape(len(token_starts), slashes_per_token[0] + 1)
+    if np.any(indices < 1) or np.any(indices > num_vertices):
+        return None
+    # One integer key per name, digits in base num_vertices + 1
+    keys = np.zeros(len(indices), dtype=np.int64)
+    for column in indices.T:
+        keys = keys * (num_vertices + 1) + column
+    _, first_occurrence, name_ids = np.unique(keys, return_index=True, return_inverse=True)
+    return _order_by_first_occurrence(indices[first_occurrence], first_occurrence, name_ids.reshape(-1))
+
+
+def _string_face_vertices(
+    face_chars: np.ndarray, num_vertices: int
+) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """Parses face vertex names of the forms v, v/vt, v//vn or v/vt/vn as strings
+
+    Args:
+        face_chars: uint8 array with the newline terminated payloads of all face records
+        num_vertices: Number of vertex records
+
+    Returns:
+        names, name_ids: Same as _integer_face_vertices, or None if the names are not all of the same form
+    """
+    names, first_occurrence, name_ids = np.unique(
+        np.array(face_chars.tobytes().split()), return_index=True, return_inverse=True
+    )
+    parts = np.char.partition(names, b"/")
+    rest = np.char.partition(parts[:, 2], b"/")
+    if np.any(np.char.find(rest[:, 2], b"/") >= 0):
+        return None
+    # read_obj_file skips empty indices, so every name needs the same non-empty indices
+    indices = []
+    for index_names in [parts[:, 0], rest[:, 0], rest[:, 2]]:
+        present = np.char.str_len(index_names) > 0
+        if not np.any(present):
+            continue
+        if not np.all(present):
+            return None
+        indices.append(index_names.astype(np.int64))
+    if not indices:
+        return None
+    indices = np.stack(indices, axis=-1)
+    # Negative indices are relative to the vertices read so far, these are left to read_obj_file
+    if np.any(indices < 1) or np.any(indices > num_vertices):
+        return None
+    return _order_by_first_occurrence(indices, first_occurrence, name_ids.reshape(-1))
+
+
+def _order_by_first_occurrence(
+    names: np.ndarray, first_occurrence: np.ndarray, name_ids: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Reorders the sorted output of np.unique to the order in which the unique values first occur
+
+    Args:
+        names: Array of shape (num_names, ...) in sorted order
+        first_occurrence: Array of shape (num_names,) with the first position of every name
+        name_ids: Array of shape (num_tokens,) with the position of every token in names
+
+    Returns:
+        names: Array of shape (num_names, ...) in the order of first occurrence
+        name_ids: Array of shape (num_tokens,) with the position of every token in the reordered names
+    """
+    name_order = np.argsort(first_occurrence)
+    new_ids = np.empty(len(name_order), dtype=np.int64)
+    new_ids[name_order] = np.arange(len(name_order))
+    return names[name_order], new_ids[name_ids]
+
+
+def _parse_obj_records(obj_data: bytes) -> Optional[Tuple[np.ndarray, List[List[int]]]]:
+    """Parses the vertex and face records of an .obj file in bulk
+
+    Args:
+        obj_data: Contents of an .obj file with newlines as line endings
+
+    Returns:
+        vertices, faces: Same as read_obj_file, or None if the file uses features that are only handled by read_obj_file
+    """
+    if not obj_data.endswith(b"\n"):
+        obj_data += b"\n"
+    chars = np.frombuffer(obj_data, dtype=np.uint8)
+    # Control characters other than tabs and newlines, some of which str.split treats as whitespace
+    if np.any((chars < ord(" ")) & (chars != ord("\t")) & (chars != ord("\n"))):
+        return None
+    line_ends = np.flatnonzero(chars == ord("\n"))
+    line_starts = np.concatenate([[0], line_ends[:-1] + 1])
+    record_types = chars[line_starts]
+    if np.any((record_types == ord(" ")) | (record_types == ord("\t"))):
+        return None
+    # Records are lines starting with their type followed by a separator, a line of "v" alone is a vertex too
+    is_record = _is_separator(chars[np.minimum(line_starts + 1, line_ends)]) & (line_starts < line_ends)
+    vertex_lines = is_record & (record_types == ord("v"))
+    face_lines = is_record & (record_types == ord("f"))
+    # read_obj_file looks up face vertices while reading, so faces may only refer to vertices defined before them
+    if np.any(face_lines) and np.any(vertex_lines[np.argmax(face_lines) :]):
+        return None
+
+    # Payloads of each record type, with the type character removed and the newlines kept
+    line_lengths = line_ends - line_starts + 1
+    payloads = []
+    for record_lines in [vertex_lines, face_lines]:
+        keep = np.repeat(record_lines, line_lengths)
+        keep[line_starts[record_lines]] = False
+        payloads.append(chars[keep])
+    vertex_chars, face_chars = payloads
+    if np.any(vertex_chars >= 0x80) or np.any(face_chars >= 0x80):
+        return None
+
+    num_vertices = int(np.sum(vertex_lines))
+    _, vertex_widths = _split_tokens(vertex_chars, num_vertices)
+    if num_vertices and np.any(vertex_widths != vertex_widths[0]):
+        return None
+    vertex_width = int(vertex_widths[0]) if num_vertices else 0
+    with warnings.catch_warnings():
+        # Older numpy versions warn and stop at the first value they cannot parse, newer ones raise a ValueError
+        warnings.simplefilter("ignore", DeprecationWarning)
+        vertex_list = np.fromstring(vertex_chars.tobytes(), dtype=np.float64, sep=" ") if vertex_width else np.zeros(0)
+    if len(vertex_list) != num_vertices * vertex_width:
+        return None
+    vertex_list = vertex_list.reshape(num_vertices, vertex_width)
+
+    token_starts, face_lengths = _split_tokens(face_chars, int(np.sum(face_lines)))
+    if not len(token_starts):
+        return np.array([], dtype=np.float32), [[] for _ in range(len(face_lengths))]
+
+    # Face vertices with the same name share a flat vertex, numbered in the order of their first occurrence.
+    # read_obj_file concatenates the vertices at every index of the name.
+    parsed = _integer_face_vertices(face_chars, token_starts, num_vertices)
+    if parsed is None:
+        parsed = _string_face_vertices(face_chars, num_vertices)
+    if parsed is None:
+        return None
+    names, name_ids = parsed
+    vertices = vertex_list[names - 1].reshape(len(names), -1).astype(np.float32)
+
+    if np.all(face_lengths == face_lengths[0]):
+        return vertices, name_ids.reshape(len(face_lengths), -1).tolist()
+    flat_faces = name_ids.tolist()
+    face_ends = np.cumsum(face_lengths).tolist()
+    faces = [flat_faces[end - length : end] for end, length in zip(face_ends, face_lengths.tolist())]
+    return vertices, faces
+
+
+def read_obj_bytes(obj_data: bytes) -> Tuple[np.ndarray, List[List[int]]]:
+    """Reads vertices and faces from the contents of an .obj file with vectorized numpy
+
+    Gives the same outputs as read_obj_file. Files with records that the bulk parser does not cover, such as
+    negative indices or vertex records with different numbers of coordinates, are read with read_obj_file.
+
+    Args:
+        obj_data: Contents of an .obj file
+
+    Returns:
+        vertices: array of shape (num_flat_vertices, num_coordinates) with one row per distinct face vertex
+        faces: List of faces, each a list of indices into vertices
+    """
+    obj_data = obj_data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+    try:
+        parsed = _parse_obj_records(obj_data)
+    except ValueError:
+        parsed = None
+    if parsed is None:
+        return read_obj_file(io.StringIO(obj_data.decode()))
+    return parsed
+
+
+def read_obj_fast(obj_path: str) -> Tuple[np.ndarray, List[List[int]]]:
+    """Reads vertices and faces from the .obj file at obj_path, same as read_obj but with vectorized numpy
+
+    Args:
+        obj_path: Path to the .obj file
+
+    Returns:
+        vertices: array of shape (num_flat_vertices, num_coordinates) with one row per distinct face vertex
+        faces: List of faces, each a list of indices into vertices
+    """
+    with open(obj_path, "rb") as obj_file:
+        return read_obj_bytes(obj_file.read())
+
+
 def write_obj(
     vertices: np.ndarray,
     faces: List[List[int]],
@@ -156,23 +459,6 @@ def dequantize_verts(verts: torch.Tensor, n_bits: int = 8, add_noise: bool = Fal
     return dequantized_verts
 
 
-def face_to_cycles(faces: List[int]) -> List[int]:
-    """Find cycles in faces list
-
-    Args:
-        faces: List of vertex indices representing connectivity
-
-    Returns:
-        cycle_basis: All cycles in faces graph
-    """
-    g = nx.Graph()
-
-    for v in range(len(faces) - 1):
-        g.add_edge(faces[v], faces[v + 1])
-    g.add_edge(faces[-1], faces[0])
-    return list(nx.cycle_basis(g))
-
-
 def flatten_faces(faces: List[List[int]]) -> torch.Tensor:
     """Converts from list of faces to flat face array with stopping indices
 
@@ -274,6 +560,107 @@ def argmin(arr: List[float]) -> int:
     return min(range(len(arr)), key=lambda x: arr[x])
 
 
+def _cycle_basis(face: List[int]) -> List[List[int]]:
+    """Finds the cycles of the graph that connects consecutive vertices of a face
+
+    Follows networkx.cycle_basis (networkx >= 3.0) step by step, so that the cycles and the order of
+    their vertices are the same as those of the networkx implementation.
+
+    Args:
+        face: List of vertex indices representing connectivity
+
+    Returns:
+        cycles: All cycles in the face graph
+    """
+    # Adjacency in the insertion order of networkx.Graph.add_edge, repeated edges are only stored once
+    adjacency = {}
+    for u, v in zip(face, face[1:] + face[:1]):
+        adjacency.setdefault(u, {})
+        adjacency.setdefault(v, {})
+        adjacency[u][v] = None
+        adjacency[v][u] = None
+
+    unvisited = dict.fromkeys(adjacency)
+    cycles = []
+    while unvisited:
+        root = unvisited.popitem()[0]
+        stack = [root]
+        pred = {root: root}
+        used = {root: set()}
+        while stack:
+            z = stack.pop()
+            z_used = used[z]
+            for nbr in adjacency[z]:
+                if nbr not in used:
+                    pred[nbr] = z
+                    stack.append(nbr)
+                    used[nbr] = {z}
+                elif nbr == z:
+                    cycles.append([z])
+                elif nbr not in z_used:
+                    nbr_used = used[nbr]
+                    cycle = [nbr, z]
+                    p = pred[z]
+                    while p not in nbr_used:
+                        cycle.append(p)
+                        p = pred[p]
+                    cycle.append(p)
+                    cycles.append(cycle)
+                    nbr_used.add(z)
+        for node in pred:
+            unvisited.pop(node, None)
+    return cycles
+
+
+def _segment_indices(starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """Indices of the elements of the segments [start, start + length) of a flat array, concatenated in order
+
+    Args:
+        starts: Array of shape (num_segments,) with the first index of every segment
+        lengths: Array of shape (num_segments,) with the length of every segment
+
+    Returns:
+        indices: Array of shape (sum(lengths),)
+    """
+    offsets = np.cumsum(lengths) - lengths
+    return np.repeat(starts - offsets, lengths) + np.arange(int(np.sum(lengths)))
+
+
+def _sorted_face_order(
+    flat_faces: np.ndarray, face_lengths: np.ndarray, tie_breaker: np.ndarray, max_padded_length: int = 64
+) -> np.ndarray:
+    """Order of faces by their sorted vertex indices, compared like tuples
+
+    Args:
+        flat_faces: Array with the vertex indices of all faces concatenated
+        face_lengths: Array of shape (num_faces,) with the number of vertices of every face
+        tie_breaker: Array of shape (num_faces,) ordering faces with the same vertices
+        max_padded_length: Faces are padded to a matrix up to this length, longer faces are sorted in python
+
+    Returns:
+        face_order: Array of shape (num_faces,) that sorts the faces
+    """
+    num_faces = len(face_lengths)
+    face_ids = np.repeat(np.arange(num_faces), face_lengths)
+    face_starts = np.cumsum(face_lengths) - face_lengths
+    sorted_vertices = flat_faces[np.lexsort((flat_faces, face_ids))]
+    max_length = int(np.max(face_lengths)) if num_faces else 0
+
+    if max_length > max_padded_length:
+        sorted_vertices = sorted_vertices.tolist()
+        keys = [
+            (sorted_vertices[start : start + length], tie)
+            for start, length, tie in zip(face_starts.tolist(), face_lengths.tolist(), tie_breaker.tolist())
+        ]
+        return np.array(sorted(range(num_faces), key=keys.__getitem__), dtype=np.int64)
+
+    # Padding with -1 sorts a face before the longer faces it is a prefix of, like a shorter tuple
+    padded = np.full((num_faces, max_length), -1, dtype=np.int64)
+    padded[face_ids, np.arange(len(flat_faces)) - face_starts[face_ids]] = sorted_vertices
+    # np.lexsort sorts by its last key first
+    return np.lexsort((tie_breaker,) + tuple(padded.T[::-1]))
+
+
 def quantize_process_mesh(
     vertices: torch.Tensor,
     faces: List[List[int]],
@@ -282,6 +669,9 @@ def quantize_process_mesh(
 ) -> Tuple[torch.Tensor, List[List[int]], Optional[torch.Tensor]]:
     """Quantize vertices, remove resulting duplicates and reindex faces
 
+    Processes all faces at once as a flat array of vertex indices with one length per face. Only faces that
+    contain loops are split in python.
+
     Args:
         vertices: torch tensor of shape (num_vertices, 3)
         faces: Unflattened faces
@@ -294,59 +684,118 @@ def quantize_process_mesh(
         triangles: list of triangles in 3D object
     """
     vertices = quantize_verts(vertices, quantization_bits)
-    vertices, inv = torch.unique(vertices, dim=0, return_inverse=True)
 
-    # Sort vertices by z then y then x
-    sort_inds = torch_lexsort(vertices.T)
-    vertices = vertices[sort_inds]
-
-    # Re-index faces and tris to re-ordered vertices
-    faces = [torch.argsort(sort_inds)[inv[f]] for f in faces]
-    if tris is not None:
-        tris = torch.Tensor([torch.argsort(sort_inds)[inv[t]] for t in tris])
+    # Remove duplicates and sort vertices by z then y then x in one step, inv maps every
+    # input vertex to its re-ordered vertex
+    vertices, inv = torch.unique(vertices.flip(1), dim=0, return_inverse=True)
+    vertices = vertices.flip(1)
+    inv = inv.numpy()
+
+    # Re-index faces to re-ordered vertices
+    face_lengths = np.array([len(f) for f in faces], dtype=np.int64)
+    flat_faces = np.fromiter(itertools.chain.from_iterable(faces), dtype=np.int64, count=int(np.sum(face_lengths)))
+    flat_faces = inv[flat_faces]
+    num_faces = len(face_lengths)
+    face_ids = np.repeat(np.arange(num_faces), face_lengths)
+    face_starts = np.cumsum(face_lengths) - face_lengths
+    positions = np.arange(len(flat_faces)) - face_starts[face_ids]
 
     # Merging duplicate vertices and re-indexing the faces causes some faces to
-    # contain loops (e.g. [2, 3, 5, 2, 4]). Split these faces into distinct
-    # sub-faces.
-
-    sub_faces = []
-    for f in faces:
-        cliques = face_to_cycles(f.tolist())
-        for c in cliques:
-            c_length = len(c)
+    # contain loops (e.g. [2, 3, 5, 2, 4]). These faces repeat an index.
+    sorted_faces = flat_faces[np.lexsort((flat_faces, face_ids))]
+    repeated = (face_ids[1:] == face_ids[:-1]) & (sorted_faces[1:] == sorted_faces[:-1])
+    has_loops = np.zeros(num_faces, dtype=bool)
+    has_loops[face_ids[1:][repeated]] = True
+
+    # The only cycle of a face without loops is the face itself, which the cycle basis walks in reverse.
+    # Cyclically permute it so that the first index is the smallest, going backwards from there.
+    simple = ~has_loops & (face_lengths > 2)
+    is_min = flat_faces == sorted_faces[face_starts][face_ids]
+    min_positions = np.zeros(num_faces, dtype=np.int64)
+    min_positions[face_ids[is_min]] = positions[is_min]
+    rotated = face_starts[face_ids] + (min_positions[face_ids] - positions) % face_lengths[face_ids]
+    simple_faces = flat_faces[rotated[simple[face_ids]]]
+
+    # Split faces with loops into distinct sub-faces, these are rare
+    loop_faces, loop_lengths, loop_sources = [], [], []
+    for face_id in np.flatnonzero(has_loops).tolist():
+        start = face_starts[face_id]
+        for c in _cycle_basis(flat_faces[start : start + face_lengths[face_id]].tolist()):
             # Only append faces with more than two verts
-            if c_length > 2:
+            if len(c) > 2:
                 d = argmin(c)
-                # Cyclically permute faces so that the first index is the smallest
-                sub_faces.append([c[(d + i) % c_length] for i in range(c_length)])
+                loop_faces.extend(c[d:] + c[:d])
+                loop_lengths.append(len(c))
+                loop_sources.append(face_id)
 
-    faces = sub_faces
-    if tris is not None:
-        tris = torch.Tensor([v for v in tris if len(set(v)) == len(v)])
+    flat_faces = np.concatenate([simple_faces, np.array(loop_faces, dtype=np.int64)])
+    face_lengths = np.concatenate([face_lengths[simple], np.array(loop_lengths, dtype=np.int64)])
+    face_sources = np.concatenate([np.flatnonzero(simple), np.array(loop_sources, dtype=np.int64)])
 
     # Sort faces by lowest vertex indices. If two faces have the same lowest
-    # index then sort by next lowest and so on.
-    faces.sort(key=lambda f: tuple(sorted(f)))
-    faces = [torch.Tensor(f).to(torch.int64) for f in faces]
-    if tris is not None:
-        tris = tris.tolist()
-        tris.sort(key=lambda f: tuple(sorted(f)))
-        tris = torch.Tensor(tris)
+    # index then sort by next lowest and so on. Equal faces keep the order of the input faces.
+    source_rank = np.empty(len(face_sources), dtype=np.int64)
+    source_rank[np.argsort(face_sources, kind="stable")] = np.arange(len(face_sources))
+    face_order = _sorted_face_order(flat_faces, face_lengths, source_rank)
+    face_starts = np.cumsum(face_lengths) - face_lengths
+    flat_faces = flat_faces[_segment_indices(face_starts[face_order], face_lengths[face_order])]
+    face_lengths = face_lengths[face_order]
 
     # After removing degenerate faces some vertices are now unreferenced
-    # Remove these
-    num_verts = vertices.shape[0]
-    vert_connected = torch.eq(torch.arange(num_verts)[:, None], torch.hstack(faces)[None]).any(dim=-1)
-    vertices = vertices[vert_connected]
-
-    # Re-index faces and tris to re-ordered vertices.
-    vert_indices = torch.arange(num_verts) - torch.cumsum((1 - vert_connected.to(torch.int32)), dim=-1)
-    faces = [vert_indices[f].tolist() for f in faces]
+    # Remove these and re-index faces to the remaining vertices
+    vert_connected = np.bincount(flat_faces, minlength=vertices.shape[0]) > 0
+    vert_indices = np.cumsum(vert_connected) - 1
+    vertices = vertices[torch.from_numpy(vert_connected)]
+    flat_faces = vert_indices[flat_faces].tolist()
+    face_ends = np.cumsum(face_lengths).tolist()
+    faces = [flat_faces[end - length : end] for end, length in zip(face_ends, face_lengths.tolist())]
+
     if tris is not None:
-        tris = torch.Tensor([vert_indices[t].tolist() for t in tris])
+        tris = inv[np.asarray(tris, dtype=np.int64)]
+        sorted_tris = np.sort(tris, axis=-1)
+        not_degenerate = np.all(sorted_tris[:, 1:] != sorted_tris[:, :-1], axis=-1)
+        tris, sorted_tris = tris[not_degenerate], sorted_tris[not_degenerate]
+        tris = tris[np.lexsort(tuple(sorted_tris.T[::-1]))]
+        # Float like the torch.Tensor triangles of the original implementation
+        tris = torch.from_numpy(vert_indices[tris]).to(torch.get_default_dtype())
     return vertices, faces, tris
 
 
+def load_process_mesh(mesh_file: str, quantization_bits: int = 8) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Reads an .obj file and turns it into the quantized vertices and flattened faces used for training
+
+    Args:
+        mesh_file: Path to the .obj file
+        quantization_bits: number of quantization bits
+
+    Returns:
+        vertices: int32 tensor of shape (num_vertices, 3) with quantized vertices sorted by z then y then x
+        faces: int32 tensor of shape (num_face_indices,) with flattened faces and stopping tokens
+    """
+    with open(mesh_file, "rb") as obj_file:
+        return process_mesh_bytes(obj_file.read(), quantization_bits)
+
+
+def process_mesh_bytes(obj_data: bytes, quantization_bits: int = 8) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Same as load_process_mesh for the contents of an .obj file, such as a member of a zip archive
+
+    Args:
+        obj_data: Contents of the .obj file
+        quantization_bits: number of quantization bits
+
+    Returns:
+        vertices: int32 tensor of shape (num_vertices, 3) with quantized vertices sorted by z then y then x
+        faces: int32 tensor of shape (num_face_indices,) with flattened faces and stopping tokens
+    """
+    vertices, faces = read_obj_bytes(obj_data)
+    vertices = torch.from_numpy(vertices)[:, [2, 0, 1]]
+    vertices = center_vertices(vertices)
+    vertices = normalize_vertices_scale(vertices)
+    vertices, faces, _ = quantize_process_mesh(vertices, faces, quantization_bits=quantization_bits)
+    faces = flatten_faces(faces)
+    return vertices.to(torch.int32), faces.to(torch.int32)
+
+
 def plot_meshes(
     mesh_list: List[Dict[str, np.ndarray]],
     ax_lims: float = 0.3,
@@ -0,0 +1,215 @@
+"""Memory-mapped store of frozen image backbone features
+
+ImageToVertexModel never trains its ResNet backbone, so the layer3 feature maps of a rendering are the same in every
+epoch. Building a store runs the backbone once per rendering and writes the feature maps into one float16 array:
+
+    features.npy    (num_images, channels, height, width) float16 backbone features of every rendering
+    meta.json       backbone hash, source renderings and feature shape
+
+The store records a hash of the backbone weights and buffers, and open_feature_store rebuilds it when they change or
+when renderings are missing from it. A store of a ShapeNet rendering directory can be built from the repository root
+with:
+
+    python -m polygen.utils.feature_store --data-dir <shapenet_dir> --store-dir <store_dir> [--checkpoint <ckpt>]
+"""
+import argparse
+import hashlib
+import json
+import os
+from typing import Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+FEATURE_STORE_VERSION = 1
+
+
+def backbone_hash(backbone: nn.Module) -> str:
+    """Hashes the weights and buffers of a backbone, such as the running statistics of its batch norms
+
+    Args:
+        backbone: Module the features are extracted with
+
+    Returns:
+        key: Hex digest that changes whenever the features of the backbone may change
+    """
+    weights_hash = hashlib.blake2b(digest_size=20)
+    weights_hash.update(f"version={FEATURE_STORE_VERSION}\n".encode())
+    for name, tensor in backbone.state_dict().items():
+        tensor = tensor.detach().cpu().contiguous()
+        weights_hash.update(f"{name} {tensor.dtype} {list(tensor.shape)}\n".encode())
+        weights_hash.update(tensor.reshape(-1).view(torch.uint8).numpy().tobytes())
+    return weights_hash.hexdigest()
+
+
+@torch.no_grad()
+def extract_features(backbone: nn.Module, images: torch.Tensor) -> torch.Tensor:
+    """Runs a backbone on images in [0, 1], centered like ImageToVertexModel._prepare_context"""
+    return backbone(images - 0.5)
+
+
+def build_feature_store(
+    image_files: Sequence[str],
+    store_dir: str,
+    backbone: nn.Module,
+    load_image: Callable[[str], torch.Tensor],
+    batch_size: int = 64,
+    device: Optional[torch.device] = None,
+) -> None:
+    """Runs a frozen backbone once over every rendering and writes the features to a store
+
+    Args:
+        image_files: Paths to the renderings
+        store_dir: Directory the store is written to, created if it does not exist
+        backbone: Module the features are extracted with, run in eval mode
+        load_image: Function loading a rendering as an image tensor of shape [num_channels, img_height, img_width]
+        batch_size: Number of renderings the backbone runs on at once
+        device: Device the backbone runs on, defaults to the device of its parameters
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    meta_path = os.path.join(store_dir, "meta.json")
+    # A store without meta.json is incomplete, so that a failed rebuild is never read
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    if device is None:
+        device = next(backbone.parameters()).device
+    was_training = backbone.training
+    backbone.eval()
+    features = None
+    for start in range(0, len(image_files), batch_size):
+        images = torch.stack([load_image(image_file) for image_file in image_files[start : start + batch_size]])
+        batch_features = extract_features(backbone, images.to(device)).to(torch.float16).cpu().numpy()
+        if features is None:
+            features = np.lib.format.open_memmap(
+                os.path.join(store_dir, "features.npy"),
+                mode="w+",
+                dtype=np.float16,
+                shape=(len(image_files), *batch_features.shape[1:]),
+            )
+        features[start : start + len(batch_features)] = batch_features
+    backbone.train(was_training)
+    if features is None:
+        raise ValueError("Cannot build a feature store without renderings")
+    features.flush()
+    meta = {
+        "version": FEATURE_STORE_VERSION,
+        "backbone_hash": backbone_hash(backbone),
+        "image_files": list(image_files),
+        "feature_shape": list(features.shape[1:]),
+    }
+    with open(meta_path, "w") as meta_file:
+        json.dump(meta, meta_file)
+
+
+class FeatureStore:
+    def __init__(self, store_dir: str) -> None:
+        """Read-only view of a feature store
+
+        The features are memory-mapped on first access, so a store can be handed to DataLoader workers without
+        copying it into each of them.
+
+        Args:
+            store_dir: Directory written by build_feature_store
+        """
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, "meta.json")) as meta_file:
+            self.meta = json.load(meta_file)
+        if self.meta["version"] != FEATURE_STORE_VERSION:
+            raise ValueError(f"Feature store version {self.meta['version']} is not supported, rebuild {store_dir}")
+        self.backbone_hash = self.meta["backbone_hash"]
+        self.image_files = self.meta["image_files"]
+        self._features = None
+
+    @property
+    def features(self) -> np.ndarray:
+        """Memory-mapped features of shape (num_images, channels, height, width)"""
+        if self._features is None:
+            self._features = np.load(os.path.join(self.store_dir, "features.npy"), mmap_mode="r")
+        return self._features
+
+    def __getstate__(self) -> Dict:
+        """Leaves the memory map out when the store is pickled for worker processes"""
+        state = self.__dict__.copy()
+        state["_features"] = None
+        return state
+
+    def __len__(self) -> int:
+        """Number of renderings in the store"""
+        return len(self.image_files)
+
+    def __getitem__(self, idx: int) -> torch.Tensor:
+        """Returns the float16 features of a rendering"""
+        # The memory map is read-only, so the row is copied into a writable tensor
+        return torch.from_numpy(np.array(self.features[idx]))
+
+    def indices(self, image_files: Sequence[str]) -> np.ndarray:
+        """Rows of the store holding the features of image_files
+
+        Raises:
+            KeyError: If a rendering is missing from the store
+        """
+        rows = {image_file: row for row, image_file in enumerate(self.image_files)}
+        return np.array([rows[image_file] for image_file in image_files], dtype=np.int64)
+
+    def matches(self, image_files: Sequence[str], backbone: nn.Module) -> bool:
+        """Whether the store holds every rendering of image_files, extracted with the weights of backbone"""
+        return self.backbone_hash == backbone_hash(backbone) and set(image_files) <= set(self.image_files)
+
+
+def open_feature_store(
+    store_dir: str,
+    image_files: Sequence[str],
+    backbone: nn.Module,
+    load_image: Callable[[str], torch.Tensor],
+    batch_size: int = 64,
+) -> FeatureStore:
+    """Opens a feature store, rebuilding it if it is missing, outdated or extracted with other backbone weights
+
+    Args:
+        store_dir: Directory of the store
+        image_files: Paths to the renderings the store has to hold
+        backbone: Module the features are extracted with
+        load_image: Function loading a rendering as an image tensor, used if the store is rebuilt
+        batch_size: Number of renderings the backbone runs on at once, used if the store is rebuilt
+
+    Returns:
+        feature_store: Store holding the features of every rendering of image_files
+    """
+    try:
+        feature_store = FeatureStore(store_dir)
+        if feature_store.matches(image_files, backbone):
+            return feature_store
+    except (FileNotFoundError, ValueError, json.JSONDecodeError):
+        pass
+    build_feature_store(sorted(image_files), store_dir, backbone, load_image, batch_size=batch_size)
+    return FeatureStore(store_dir)
+
+
+def main(argv: List[str] = None) -> None:
+    """Builds the feature store of the renderings of a ShapeNet directory with the frozen PolygenResnet"""
+    from polygen.modules.data_modules import ImageDataset
+    from polygen.modules.image_encoder import PolygenResnet
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data-dir", required=True)
+    parser.add_argument("--store-dir", required=True)
+    parser.add_argument("--image-extension", default="jpeg")
+    parser.add_argument("--checkpoint", default=None, help="ImageToVertexModel checkpoint to take the backbone from")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args(argv)
+
+    backbone = PolygenResnet()
+    if args.checkpoint is not None:
+        state_dict = torch.load(args.checkpoint, map_location="cpu")["state_dict"]
+        backbone.load_state_dict({k[len("res_net.") :]: v for k, v in state_dict.items() if k.startswith("res_net.")})
+    backbone.to(args.device)
+    dataset = ImageDataset(args.data_dir, image_extension=args.image_extension)
+    image_files = sorted(dataset.images)
+    open_feature_store(args.store_dir, image_files, backbone, dataset.load_image, batch_size=args.batch_size)
+    print(f"Feature store of {len(image_files)} renderings in {args.store_dir}")
+
+
+if __name__ == "__main__":
+    main()
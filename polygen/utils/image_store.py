@@ -0,0 +1,163 @@
+"""Memory-mapped store of decoded and resized renderings
+
+ImageDataset decodes a full-resolution rendering and resizes it every time it is loaded. Building a store decodes and
+resizes every rendering once and writes them into one uint8 array:
+
+    images.npy    (num_images, 3, height, width) uint8 RGB renderings, resized so that their smaller edge is size
+    meta.json     size and source renderings
+
+All renderings of a store need the same shape after resizing, as ShapeNet renderings have. A store of a ShapeNet
+rendering directory can be built from the repository root with:
+
+    python -m polygen.utils.image_store --data-dir <shapenet_dir> --store-dir <store_dir> [--num-workers 8]
+"""
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+from typing import BinaryIO, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+import torchvision.transforms as T
+from PIL import Image
+
+IMAGE_STORE_VERSION = 1
+
+
+def load_image_uint8(img_file: Union[str, BinaryIO], size: int = 256) -> torch.Tensor:
+    """Decodes a rendering and resizes its smaller edge to size, before converting it to a tensor
+
+    JPEGs are decoded at the smallest power-of-two reduction that is still at least size, which skips most of the
+    inverse DCT work for large renderings. The image is resized while it is still a PIL image, so the float conversion
+    only touches the resized pixels.
+
+    Args:
+        img_file: Path to the rendering, or a file object with its encoded contents
+        size: Length of the smaller edge after resizing
+
+    Returns:
+        image: uint8 tensor of shape [3, img_height, img_width]
+    """
+    with Image.open(img_file) as img:
+        img.draft("RGB", (size, size))
+        img = img.convert("RGB")
+    return T.functional.pil_to_tensor(T.functional.resize(img, size))
+
+
+def _load_image_job(job: Tuple[str, int]) -> np.ndarray:
+    """Decodes one rendering in a worker process"""
+    img_file, size = job
+    return load_image_uint8(img_file, size).numpy()
+
+
+def build_image_store(
+    image_files: Sequence[str], store_dir: str, size: int = 256, num_workers: Optional[int] = None
+) -> None:
+    """Decodes and resizes renderings across a process pool and writes them to an image store
+
+    Args:
+        image_files: Paths to the renderings
+        store_dir: Directory the store is written to, created if it does not exist
+        size: Length of the smaller edge of every rendering after resizing
+        num_workers: Number of worker processes, defaults to the number of CPUs
+    """
+    if not image_files:
+        raise ValueError("Cannot build an image store without renderings")
+    os.makedirs(store_dir, exist_ok=True)
+    meta_path = os.path.join(store_dir, "meta.json")
+    # A store without meta.json is incomplete, so that a failed rebuild is never read
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    jobs = [(img_file, size) for img_file in image_files]
+    images = None
+    with multiprocessing.Pool(num_workers) as pool:
+        # imap keeps the order of image_files
+        for i, (img_file, image) in enumerate(zip(image_files, pool.imap(_load_image_job, jobs, chunksize=16))):
+            if images is None:
+                images = np.lib.format.open_memmap(
+                    os.path.join(store_dir, "images.npy"), mode="w+", dtype=np.uint8, shape=(len(jobs), *image.shape)
+                )
+            if image.shape != images.shape[1:]:
+                raise ValueError(f"{img_file} has shape {image.shape} after resizing, not {images.shape[1:]}")
+            images[i] = image
+    images.flush()
+    meta = {
+        "version": IMAGE_STORE_VERSION,
+        "size": size,
+        "image_files": list(image_files),
+        "image_shape": list(images.shape[1:]),
+    }
+    with open(meta_path, "w") as meta_file:
+        json.dump(meta, meta_file)
+
+
+class ImageStore:
+    def __init__(self, store_dir: str) -> None:
+        """Read-only view of an image store
+
+        The images are memory-mapped on first access, so a store can be handed to DataLoader workers without copying it
+        into each of them.
+
+        Args:
+            store_dir: Directory written by build_image_store
+        """
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, "meta.json")) as meta_file:
+            self.meta = json.load(meta_file)
+        if self.meta["version"] != IMAGE_STORE_VERSION:
+            raise ValueError(f"Image store version {self.meta['version']} is not supported, rebuild {store_dir}")
+        self.size = self.meta["size"]
+        self.image_files = self.meta["image_files"]
+        self._images = None
+
+    @property
+    def images(self) -> np.ndarray:
+        """Memory-mapped images of shape (num_images, 3, height, width)"""
+        if self._images is None:
+            self._images = np.load(os.path.join(self.store_dir, "images.npy"), mmap_mode="r")
+        return self._images
+
+    def __getstate__(self) -> Dict:
+        """Leaves the memory map out when the store is pickled for worker processes"""
+        state = self.__dict__.copy()
+        state["_images"] = None
+        return state
+
+    def __len__(self) -> int:
+        """Number of renderings in the store"""
+        return len(self.image_files)
+
+    def __getitem__(self, idx: int) -> torch.Tensor:
+        """Returns the uint8 image of a rendering"""
+        # The memory map is read-only, so the image is copied into a writable tensor
+        return torch.from_numpy(np.array(self.images[idx]))
+
+    def indices(self, image_files: Sequence[str]) -> np.ndarray:
+        """Rows of the store holding image_files
+
+        Raises:
+            KeyError: If a rendering is missing from the store
+        """
+        rows = {image_file: row for row, image_file in enumerate(self.image_files)}
+        return np.array([rows[image_file] for image_file in image_files], dtype=np.int64)
+
+
+def main(argv: List[str] = None) -> None:
+    """Builds the image store of the renderings of a ShapeNet directory"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data-dir", required=True)
+    parser.add_argument("--store-dir", required=True)
+    parser.add_argument("--image-extension", default="jpeg")
+    parser.add_argument("--size", type=int, default=256)
+    parser.add_argument("--num-workers", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    image_files = sorted(glob.glob(f"{args.data_dir}/*/*/renderings/*.{args.image_extension}"))
+    build_image_store(image_files, args.store_dir, size=args.size, num_workers=args.num_workers)
+    print(f"Stored {len(image_files)} renderings in {args.store_dir}")
+
+
+if __name__ == "__main__":
+    main()
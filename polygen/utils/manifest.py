@@ -0,0 +1,318 @@
+"""Persisted manifest of a ShapeNet directory with the length of every preprocessed mesh
+
+The manifest lists the .obj files, class labels and renderings that ShapenetDataset and ImageDataset would otherwise
+glob on every construction, together with the number of vertices, number of faces and flattened face length of every
+mesh, so that meshes can be filtered by length without opening them. Build a manifest and print its length statistics
+from the repository root with:
+
+    python -m polygen.utils.manifest build --data-dir <shapenet_dir> --manifest <manifest.npz> [--num-workers 8]
+    python -m polygen.utils.manifest stats --manifest <manifest.npz> --batch-size 8 [--max-num-input-verts 800]
+"""
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import time
+import traceback
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from . import data_utils
+
+MANIFEST_VERSION = 1
+
+
+def _mesh_lengths(job: Tuple[str, int, Optional[str]]) -> Union[Tuple[int, int, int], str]:
+    """Preprocesses one .obj file in a worker process and measures it
+
+    Args:
+        job: Path to the .obj file, number of quantization bits and an optional mesh cache directory
+
+    Returns:
+        lengths: Number of vertices, number of faces and flattened face length, or the traceback if preprocessing failed
+    """
+    mesh_file, quantization_bits, mesh_cache_dir = job
+    try:
+        if mesh_cache_dir is not None:
+            from .mesh_cache import MeshCache
+
+            vertices, faces = MeshCache(mesh_cache_dir, quantization_bits).load_process_mesh(mesh_file)
+        else:
+            vertices, faces = data_utils.load_process_mesh(mesh_file, quantization_bits)
+    except Exception:
+        return traceback.format_exc()
+    # Every face ends with a stopping token, 1 between faces and 0 after the last one
+    num_faces = int((faces < 2).sum()) if len(faces) > 1 else 0
+    return len(vertices), num_faces, len(faces)
+
+
+def select_lengths(
+    num_vertices: np.ndarray,
+    face_lengths: np.ndarray,
+    max_num_vertices: Optional[int] = None,
+    max_face_length: Optional[int] = None,
+) -> np.ndarray:
+    """Indices of the meshes with at most max_num_vertices vertices and max_face_length flattened face indices"""
+    keep = np.ones(len(num_vertices), dtype=bool)
+    if max_num_vertices is not None:
+        keep &= num_vertices <= max_num_vertices
+    if max_face_length is not None:
+        keep &= face_lengths <= max_face_length
+    return np.flatnonzero(keep)
+
+
+class Manifest:
+    def __init__(
+        self,
+        mesh_files: List[str],
+        class_labels: np.ndarray,
+        num_vertices: np.ndarray,
+        num_faces: np.ndarray,
+        face_lengths: np.ndarray,
+        image_files: List[str],
+        image_mesh_ids: np.ndarray,
+        meta: Dict,
+    ) -> None:
+        """Paths, labels and lengths of the meshes of a dataset
+
+        Args:
+            mesh_files: Paths to the .obj files
+            class_labels: Array of shape (num_meshes,) with the class label of every mesh
+            num_vertices: Array of shape (num_meshes,) with the number of vertices of every preprocessed mesh
+            num_faces: Array of shape (num_meshes,) with the number of faces of every preprocessed mesh
+            face_lengths: Array of shape (num_meshes,) with the flattened face length, stopping tokens included
+            image_files: Paths to the renderings
+            image_mesh_ids: Array of shape (num_images,) with the mesh of every rendering
+            meta: Data directory, quantization bits, label mapping and files that failed preprocessing
+        """
+        self.mesh_files = mesh_files
+        self.class_labels = class_labels
+        self.num_vertices = num_vertices
+        self.num_faces = num_faces
+        self.face_lengths = face_lengths
+        self.image_files = image_files
+        self.image_mesh_ids = image_mesh_ids
+        self.meta = meta
+
+    @property
+    def quantization_bits(self) -> int:
+        return self.meta["quantization_bits"]
+
+    @property
+    def label_dict(self) -> Dict[str, int]:
+        return self.meta["label_dict"]
+
+    def __len__(self) -> int:
+        """Number of meshes in the manifest"""
+        return len(self.mesh_files)
+
+    def select(self, max_num_vertices: Optional[int] = None, max_face_length: Optional[int] = None) -> np.ndarray:
+        """Indices of the meshes within the length limits
+
+        Args:
+            max_num_vertices: Meshes with more vertices are left out, for example max_num_input_verts of the vertex model
+            max_face_length: Meshes with longer flattened faces are left out, for example max_seq_length of the face model
+
+        Returns:
+            indices: Sorted array with the indices of the selected meshes
+        """
+        return select_lengths(self.num_vertices, self.face_lengths, max_num_vertices, max_face_length)
+
+    def save(self, manifest_path: str) -> None:
+        """Writes the manifest to an .npz file"""
+        tmp_path = f"{manifest_path}.{os.getpid()}.tmp.npz"
+        np.savez(
+            tmp_path,
+            mesh_files=np.array(self.mesh_files, dtype=str),
+            class_labels=self.class_labels,
+            num_vertices=self.num_vertices,
+            num_faces=self.num_faces,
+            face_lengths=self.face_lengths,
+            image_files=np.array(self.image_files, dtype=str),
+            image_mesh_ids=self.image_mesh_ids,
+            meta=np.array(json.dumps(self.meta)),
+        )
+        os.replace(tmp_path, manifest_path)
+
+    @classmethod
+    def load(cls, manifest_path: str) -> "Manifest":
+        """Reads a manifest written by Manifest.save"""
+        with np.load(manifest_path) as arrays:
+            meta = json.loads(str(arrays["meta"]))
+            if meta["version"] != MANIFEST_VERSION:
+                raise ValueError(f"Manifest version {meta['version']} is not supported, rebuild {manifest_path}")
+            return cls(
+                mesh_files=arrays["mesh_files"].tolist(),
+                class_labels=arrays["class_labels"],
+                num_vertices=arrays["num_vertices"],
+                num_faces=arrays["num_faces"],
+                face_lengths=arrays["face_lengths"],
+                image_files=arrays["image_files"].tolist(),
+                image_mesh_ids=arrays["image_mesh_ids"],
+                meta=meta,
+            )
+
+
+def build_manifest(
+    data_dir: str,
+    quantization_bits: int = 8,
+    image_extension: str = "jpeg",
+    num_workers: Optional[int] = None,
+    mesh_cache_dir: Optional[str] = None,
+) -> Manifest:
+    """Finds the meshes and renderings of a ShapeNet directory and measures every mesh across a process pool
+
+    Args:
+        data_dir: Root folder of the shapenet dataset
+        quantization_bits: number of quantization bits
+        image_extension: Extension of the renderings
+        num_workers: Number of worker processes, defaults to the number of CPUs
+        mesh_cache_dir: Directory of a mesh cache to read preprocessed meshes from and add them to
+
+    Returns:
+        manifest: Manifest of the meshes that could be preprocessed
+    """
+    from polygen.modules.data_modules import ShapenetDataset
+
+    dataset = ShapenetDataset(data_dir, quantization_bits=quantization_bits)
+    mesh_files = sorted(dataset.all_files)
+    jobs = [(mesh_file, quantization_bits, mesh_cache_dir) for mesh_file in mesh_files]
+    stored_files, lengths, failed_files = [], [], []
+    with multiprocessing.Pool(num_workers) as pool:
+        for mesh_file, mesh_lengths in zip(mesh_files, pool.imap(_mesh_lengths, jobs, chunksize=8)):
+            if isinstance(mesh_lengths, str):
+                print(f"Skipping {mesh_file}:\n{mesh_lengths}")
+                failed_files.append(mesh_file)
+                continue
+            stored_files.append(mesh_file)
+            lengths.append(mesh_lengths)
+    lengths = np.array(lengths, dtype=np.int64).reshape(-1, 3)
+
+    # Renderings are matched to their mesh like in ImageDataset
+    mesh_ids = {mesh_file: i for i, mesh_file in enumerate(stored_files)}
+    image_files, image_mesh_ids = [], []
+    for image_file in sorted(glob_renderings(data_dir, image_extension)):
+        folder_path = "/".join(image_file.split("/")[:-2])
+        mesh_file = os.path.sep.join([folder_path, "models", "model_normalized.obj"])
+        if mesh_file in mesh_ids:
+            image_files.append(image_file)
+            image_mesh_ids.append(mesh_ids[mesh_file])
+
+    meta = {
+        "version": MANIFEST_VERSION,
+        "data_dir": data_dir,
+        "quantization_bits": quantization_bits,
+        "image_extension": image_extension,
+        "label_dict": dataset.label_dict,
+        "failed_files": failed_files,
+    }
+    return Manifest(
+        mesh_files=stored_files,
+        class_labels=np.array([dataset.class_label(mesh_file) for mesh_file in stored_files], dtype=np.int64),
+        num_vertices=lengths[:, 0],
+        num_faces=lengths[:, 1],
+        face_lengths=lengths[:, 2],
+        image_files=image_files,
+        image_mesh_ids=np.array(image_mesh_ids, dtype=np.int64),
+        meta=meta,
+    )
+
+
+def glob_renderings(data_dir: str, image_extension: str) -> List[str]:
+    """Renderings of a ShapeNet directory, as globbed by ImageDataset"""
+    return glob.glob(f"{data_dir}/*/*/renderings/*.{image_extension}")
+
+
+def padding_efficiency(lengths: np.ndarray, batch_size: int, num_shuffles: int = 10, seed: int = 0) -> float:
+    """Expected fraction of non-padding tokens in batches of randomly shuffled sequences
+
+    Args:
+        lengths: Array of shape (num_sequences,) with the length of every sequence
+        batch_size: Number of sequences per batch, every batch is padded to its longest sequence
+        num_shuffles: Number of random shuffles the efficiency is averaged over
+        seed: Seed of the shuffles
+
+    Returns:
+        efficiency: Tokens divided by tokens plus padding
+    """
+    if len(lengths) == 0:
+        return 1.0
+    rng = np.random.default_rng(seed)
+    num_batches = -(-len(lengths) // batch_size)
+    efficiencies = []
+    for _ in range(num_shuffles):
+        # Pad the last batch with empty sequences that take no space
+        padded = np.zeros(num_batches * batch_size, dtype=np.int64)
+        padded[: len(lengths)] = rng.permutation(lengths)
+        batches = padded.reshape(num_batches, batch_size)
+        batch_sizes = np.minimum(batch_size, len(lengths) - np.arange(num_batches) * batch_size)
+        efficiencies.append(batches.sum() / np.sum(batches.max(axis=-1) * batch_sizes))
+    return float(np.mean(efficiencies))
+
+
+def length_histogram(lengths: np.ndarray, num_bins: int = 10, width: int = 40) -> str:
+    """Text histogram of sequence lengths"""
+    if len(lengths) == 0:
+        return "  (empty)"
+    counts, edges = np.histogram(lengths, bins=num_bins)
+    lines = []
+    for count, low, high in zip(counts, edges[:-1], edges[1:]):
+        bar = "#" * int(round(width * count / max(counts.max(), 1)))
+        lines.append(f"  {low:>8.0f} - {high:>8.0f} {count:>8} {bar}")
+    return "\n".join(lines)
+
+
+def print_stats(manifest: Manifest, batch_size: int, max_num_vertices: int = None, max_face_length: int = None) -> None:
+    """Prints the length histograms and the padding efficiency of random batches of the selected meshes"""
+    indices = manifest.select(max_num_vertices, max_face_length)
+    print(f"{len(indices)} of {len(manifest)} meshes within the length limits, {len(manifest.image_files)} renderings")
+    # Sequence lengths the vertex and face collate functions pad to
+    sequences = {
+        "vertex tokens": manifest.num_vertices[indices] * 3 + 1,
+        "face tokens": manifest.face_lengths[indices],
+    }
+    for name, lengths in sequences.items():
+        print(f"\n{name}: mean {np.mean(lengths) if len(lengths) else 0:.1f}, max {np.max(lengths, initial=0)}")
+        print(length_histogram(lengths))
+        efficiency = padding_efficiency(lengths, batch_size)
+        print(f"  padding efficiency at batch size {batch_size}: {efficiency:.3f}")
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build")
+    build_parser.add_argument("--data-dir", required=True)
+    build_parser.add_argument("--manifest", required=True)
+    build_parser.add_argument("--quantization-bits", type=int, default=8)
+    build_parser.add_argument("--image-extension", default="jpeg")
+    build_parser.add_argument("--num-workers", type=int, default=None)
+    build_parser.add_argument("--mesh-cache-dir", default=None)
+    stats_parser = subparsers.add_parser("stats")
+    stats_parser.add_argument("--manifest", required=True)
+    stats_parser.add_argument("--batch-size", type=int, default=8)
+    stats_parser.add_argument("--max-num-input-verts", type=int, default=None)
+    stats_parser.add_argument("--max-seq-length", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        manifest = build_manifest(
+            args.data_dir,
+            quantization_bits=args.quantization_bits,
+            image_extension=args.image_extension,
+            num_workers=args.num_workers,
+            mesh_cache_dir=args.mesh_cache_dir,
+        )
+        manifest.save(args.manifest)
+        print(f"Wrote {len(manifest)} meshes to {args.manifest}, {len(manifest.meta['failed_files'])} failed")
+    else:
+        start = time.perf_counter()
+        manifest = Manifest.load(args.manifest)
+        print(f"Loaded {args.manifest} in {1000 * (time.perf_counter() - start):.1f}ms")
+        print_stats(manifest, args.batch_size, args.max_num_input_verts, args.max_seq_length)
+
+
+if __name__ == "__main__":
+    main()
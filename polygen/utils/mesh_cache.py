@@ -0,0 +1,256 @@
+"""Incremental cache of preprocessed meshes, keyed by a content hash of every .obj file
+
+Every entry holds the output of data_utils.load_process_mesh for one .obj file and is named after the hash of the
+file contents and the number of quantization bits, so renamed or copied files share their entry and changed files
+miss it. Every number of quantization bits has its own directory of entries and its own index, so that several settings
+share a cache directory and are updated independently. The cache of a ShapeNet directory is brought up to date,
+processing only new or changed files and evicting stale entries, from the repository root with:
+
+    python -m polygen.utils.mesh_cache --data-dir <shapenet_dir> --cache-dir <cache_dir> [--num-workers 8]
+
+MeshLRU keeps recently processed meshes in memory instead, for datasets that load the same mesh many times, such as the
+renderings of a model in ImageDataset.
+"""
+import argparse
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import traceback
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+from . import data_utils
+from .mesh_store import vertex_dtype
+
+MESH_CACHE_VERSION = 1
+
+
+def content_hash(mesh_file: str, quantization_bits: int) -> str:
+    """Hashes the contents of an .obj file together with the preprocessing settings
+
+    Args:
+        mesh_file: Path to the .obj file
+        quantization_bits: number of quantization bits
+
+    Returns:
+        key: Hex digest naming the cache entry of the file
+    """
+    file_hash = hashlib.blake2b(digest_size=20)
+    file_hash.update(f"version={MESH_CACHE_VERSION} quantization_bits={quantization_bits}\n".encode())
+    with open(mesh_file, "rb") as obj_file:
+        for chunk in iter(lambda: obj_file.read(1 << 20), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def _write_entry(entry_path: str, vertices: torch.Tensor, faces: torch.Tensor, quantization_bits: int) -> None:
+    """Writes one cache entry atomically, so that concurrent readers never see a partial file"""
+    os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+    tmp_path = f"{entry_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as entry_file:
+        np.savez(entry_file, vertices=vertices.numpy().astype(vertex_dtype(quantization_bits)), faces=faces.numpy())
+    os.replace(tmp_path, entry_path)
+
+
+def _process_mesh_file(job: Tuple[str, int, str]) -> Optional[str]:
+    """Preprocesses one .obj file in a worker process and writes its cache entry
+
+    Args:
+        job: Path to the .obj file, number of quantization bits and path of the cache entry
+
+    Returns:
+        error: The traceback if preprocessing failed, None otherwise
+    """
+    mesh_file, quantization_bits, entry_path = job
+    try:
+        vertices, faces = data_utils.load_process_mesh(mesh_file, quantization_bits)
+    except Exception:
+        return traceback.format_exc()
+    _write_entry(entry_path, vertices, faces, quantization_bits)
+    return None
+
+
+class MeshCache:
+    def __init__(self, cache_dir: str, quantization_bits: int = 8) -> None:
+        """Content-hashed cache of preprocessed meshes
+
+        Looking up a file hashes its contents, unless its size and modification time match the index written by the
+        last update. Files that miss the cache are preprocessed and added to it on the fly.
+
+        Args:
+            cache_dir: Directory of the cache entries, created if it does not exist
+            quantization_bits: number of quantization bits
+        """
+        self.cache_dir = cache_dir
+        self.quantization_bits = quantization_bits
+        self.index_path = os.path.join(cache_dir, f"index_{quantization_bits}.json")
+        self.entry_dir = os.path.join(cache_dir, f"bits_{quantization_bits}")
+        os.makedirs(self.entry_dir, exist_ok=True)
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as index_file:
+                self.index = json.load(index_file)
+
+    def key(self, mesh_file: str) -> str:
+        """Returns the content hash of an .obj file, reusing the indexed hash if the file did not change"""
+        stat = os.stat(mesh_file)
+        mesh_path = os.path.abspath(mesh_file)
+        indexed = self.index.get(mesh_path)
+        if indexed is not None and indexed[0] == stat.st_size and indexed[1] == stat.st_mtime_ns:
+            return indexed[2]
+        key = content_hash(mesh_file, self.quantization_bits)
+        self.index[mesh_path] = [stat.st_size, stat.st_mtime_ns, key]
+        return key
+
+    def entry_path(self, key: str) -> str:
+        """Path of the cache entry with the given key"""
+        return os.path.join(self.entry_dir, key[:2], f"{key}.npz")
+
+    def load_process_mesh(self, mesh_file: str) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Same as data_utils.load_process_mesh, reading the result from the cache when the file is in it
+
+        Args:
+            mesh_file: Path to the .obj file
+
+        Returns:
+            vertices: int32 tensor of shape (num_vertices, 3) with quantized vertices
+            faces: int32 tensor of shape (num_face_indices,) with flattened faces and stopping tokens
+        """
+        entry_path = self.entry_path(self.key(mesh_file))
+        if os.path.exists(entry_path):
+            with np.load(entry_path) as entry:
+                return torch.from_numpy(entry["vertices"].astype(np.int32)), torch.from_numpy(entry["faces"])
+        vertices, faces = data_utils.load_process_mesh(mesh_file, self.quantization_bits)
+        _write_entry(entry_path, vertices, faces, self.quantization_bits)
+        return vertices, faces
+
+    def entries(self) -> Dict[str, str]:
+        """Returns the paths of the cache entries of this number of quantization bits keyed by their content hash"""
+        entry_paths = glob.glob(os.path.join(self.entry_dir, "*", "*.npz"))
+        return {os.path.basename(entry_path)[: -len(".npz")]: entry_path for entry_path in entry_paths}
+
+    def update(self, mesh_files: List[str], num_workers: Optional[int] = None) -> Dict[str, int]:
+        """Preprocesses new and changed .obj files across a process pool and evicts entries of no listed file
+
+        Only entries of this number of quantization bits are evicted, entries of other settings are left as they are.
+
+        Args:
+            mesh_files: Paths to all .obj files the cache should hold
+            num_workers: Number of worker processes, defaults to the number of CPUs
+
+        Returns:
+            stats: Number of processed, reused, failed and evicted entries
+        """
+        keys = {mesh_file: self.key(mesh_file) for mesh_file in mesh_files}
+        # The written index only holds the listed files, unchanged files keep their indexed hash
+        mesh_paths = set(os.path.abspath(mesh_file) for mesh_file in mesh_files)
+        self.index = {mesh_path: indexed for mesh_path, indexed in self.index.items() if mesh_path in mesh_paths}
+        entries = self.entries()
+        jobs = {}
+        for mesh_file, key in keys.items():
+            if key not in entries and key not in jobs:
+                jobs[key] = (mesh_file, self.quantization_bits, self.entry_path(key))
+        num_failed = 0
+        if jobs:
+            with multiprocessing.Pool(num_workers) as pool:
+                for job, error in zip(jobs.values(), pool.imap(_process_mesh_file, jobs.values(), chunksize=8)):
+                    if error is not None:
+                        print(f"Skipping {job[0]}:\n{error}")
+                        num_failed += 1
+
+        # Entries of files that changed or were removed are stale
+        live_keys = set(keys.values())
+        stale_entries = [entry_path for key, entry_path in entries.items() if key not in live_keys]
+        for entry_path in stale_entries:
+            os.remove(entry_path)
+
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as index_file:
+            json.dump(self.index, index_file)
+        os.replace(tmp_path, self.index_path)
+        return {
+            "processed": len(jobs) - num_failed,
+            "reused": len(set(keys.values()) & set(entries)),
+            "failed": num_failed,
+            "evicted": len(stale_entries),
+        }
+
+
+class MeshLRU:
+    def __init__(self, max_meshes: int) -> None:
+        """In-memory, least recently used cache of processed meshes
+
+        Every process holds its own cache, so each DataLoader worker starts empty and fills it with the meshes of the
+        elements it loads. Cached tensors are returned as they are, callers must not change them in place.
+
+        Args:
+            max_meshes: Number of meshes kept, the least recently used mesh is evicted beyond it
+        """
+        if max_meshes < 1:
+            raise ValueError(f"max_meshes should be at least 1, got {max_meshes}")
+        self.max_meshes = max_meshes
+        self.meshes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        """Number of cached meshes"""
+        return len(self.meshes)
+
+    def get(
+        self, key: str, load: Callable[[], Tuple[torch.Tensor, torch.Tensor]]
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Returns the cached mesh of key, loading and caching it with load on a miss
+
+        Args:
+            key: Key of the mesh, such as the folder of a ShapeNet model
+            load: Function returning the processed vertices and faces of the mesh
+
+        Returns:
+            vertices: Processed vertices of the mesh
+            faces: Processed faces of the mesh
+        """
+        mesh = self.meshes.get(key)
+        if mesh is not None:
+            self.hits += 1
+            self.meshes.move_to_end(key)
+            return mesh
+        self.misses += 1
+        mesh = load()
+        self.meshes[key] = mesh
+        if len(self.meshes) > self.max_meshes:
+            self.meshes.popitem(last=False)
+        return mesh
+
+    @property
+    def hit_rate(self) -> float:
+        """Fraction of lookups served from the cache"""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> Dict[str, float]:
+        """Number of hits, misses and cached meshes, and the hit rate"""
+        return {"hits": self.hits, "misses": self.misses, "meshes": len(self), "hit_rate": self.hit_rate}
+
+
+def main(argv: List[str] = None) -> None:
+    """Brings the cache of a ShapeNet directory up to date with its .obj files"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data-dir", required=True)
+    parser.add_argument("--cache-dir", required=True)
+    parser.add_argument("--quantization-bits", type=int, default=8)
+    parser.add_argument("--num-workers", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    mesh_files = sorted(glob.glob(f"{args.data_dir}/*/*/models/model_normalized.obj"))
+    stats = MeshCache(args.cache_dir, args.quantization_bits).update(mesh_files, num_workers=args.num_workers)
+    print(", ".join(f"{count} {name}" for name, count in stats.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+"""Tar shards of preprocessed meshes for streaming from network filesystems
+
+Opening millions of small .obj and image files is slow on network filesystems. Building shards preprocesses every mesh
+once and writes the samples in random order into a few large tar files, which are then read sequentially:
+
+    shard-000000.tar    samples_per_shard samples, each stored as consecutive members sharing a key:
+                            <key>.vertices.npy  quantized vertices, uint8 up to 8 quantization bits, int16 up to 15
+                            <key>.faces.npy     int32 flattened faces with stopping tokens
+                            <key>.json          class label, source files and sample index
+                            <key>.<extension>   encoded rendering, if the shards hold renderings
+    index.json          quantization bits, class label mapping and number of samples of every shard
+
+With renderings, every rendering is a sample that repeats the mesh of its model. Shards of a ShapeNet directory can be
+built from the repository root with:
+
+    python -m polygen.utils.mesh_shards --data-dir <shapenet_dir> --shard-dir <shard_dir> [--images] [--num-workers 8]
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import tarfile
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+
+from .mesh_store import _process_mesh_file
+
+MESH_SHARDS_VERSION = 1
+
+
+def encode_array(array: np.ndarray) -> bytes:
+    """Serializes an array in the .npy format"""
+    buffer = io.BytesIO()
+    np.save(buffer, array)
+    return buffer.getvalue()
+
+
+def decode_array(data: bytes) -> np.ndarray:
+    """Deserializes an array in the .npy format"""
+    return np.load(io.BytesIO(data))
+
+
+def _add_member(shard: tarfile.TarFile, name: str, data: bytes) -> None:
+    """Adds a file member with the given contents to a tar file"""
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    shard.addfile(info, io.BytesIO(data))
+
+
+def iterate_shard(shard_file: str) -> Iterator[Dict[str, bytes]]:
+    """Reads the samples of a shard sequentially
+
+    Args:
+        shard_file: Path to the tar shard
+
+    Returns:
+        samples: Iterator over samples, each a dictionary from member extension, such as "vertices.npy", to contents
+    """
+    sample, sample_key = {}, None
+    # Stream mode reads the tar file front to back without seeking
+    with tarfile.open(shard_file, mode="r|") as shard:
+        for member in shard:
+            if not member.isfile():
+                continue
+            key, extension = member.name.split(".", 1)
+            if key != sample_key and sample:
+                yield sample
+                sample = {}
+            sample_key = key
+            sample[extension] = shard.extractfile(member).read()
+    if sample:
+        yield sample
+
+
+def load_shard_index(shard_dir: str) -> Dict:
+    """Reads the index of a shard directory, with the paths of the shards made absolute"""
+    with open(os.path.join(shard_dir, "index.json")) as index_file:
+        index = json.load(index_file)
+    if index["version"] != MESH_SHARDS_VERSION:
+        raise ValueError(f"Mesh shards version {index['version']} are not supported, rebuild {shard_dir}")
+    for shard in index["shards"]:
+        shard["file"] = os.path.join(shard_dir, shard["file"])
+    return index
+
+
+def build_shards(
+    mesh_files: List[str],
+    class_labels: List[int],
+    shard_dir: str,
+    quantization_bits: int = 8,
+    samples_per_shard: int = 1000,
+    image_files: Optional[Dict[str, List[str]]] = None,
+    num_workers: Optional[int] = None,
+    seed: int = 0,
+    label_dict: Optional[Dict[str, int]] = None,
+) -> List[str]:
+    """Preprocesses .obj files across a process pool and writes them to tar shards in random order
+
+    Args:
+        mesh_files: Paths to the .obj files
+        class_labels: Class label of every .obj file
+        shard_dir: Directory the shards are written to, created if it does not exist
+        quantization_bits: number of quantization bits
+        samples_per_shard: Number of samples of every shard but the last
+        image_files: If provided, maps every .obj file to its renderings, each of which becomes a sample
+        num_workers: Number of worker processes, defaults to the number of CPUs
+        seed: Seed of the order of the samples, which makes contiguous ranges of shards random splits
+        label_dict: Mapping from class names to class labels, saved with the shards for reference
+
+    Returns:
+        failed_files: .obj files that could not be preprocessed and were left out of the shards
+    """
+    assert len(mesh_files) == len(class_labels)
+    os.makedirs(shard_dir, exist_ok=True)
+    with multiprocessing.Pool(num_workers) as pool:
+        jobs = [(mesh_file, quantization_bits) for mesh_file in mesh_files]
+        meshes = list(pool.imap(_process_mesh_file, jobs, chunksize=8))
+
+    samples, failed_files = [], []
+    for mesh_file, class_label, mesh in zip(mesh_files, class_labels, meshes):
+        if isinstance(mesh, str):
+            print(f"Skipping {mesh_file}:\n{mesh}")
+            failed_files.append(mesh_file)
+            continue
+        renderings = image_files.get(mesh_file, []) if image_files is not None else [None]
+        samples.extend((mesh_file, class_label, mesh, img_file) for img_file in renderings)
+    order = np.random.default_rng(seed).permutation(len(samples))
+
+    shards = []
+    for shard_id, start in enumerate(range(0, len(order), samples_per_shard)):
+        shard_file = f"shard-{shard_id:06d}.tar"
+        shard_indices = order[start : start + samples_per_shard].tolist()
+        with tarfile.open(os.path.join(shard_dir, shard_file), mode="w") as shard:
+            for index in shard_indices:
+                mesh_file, class_label, (vertices, faces), img_file = samples[index]
+                key = f"{index:09d}"
+                _add_member(shard, f"{key}.vertices.npy", encode_array(vertices))
+                _add_member(shard, f"{key}.faces.npy", encode_array(faces))
+                meta = {"class_label": class_label, "index": index, "mesh_file": mesh_file, "image_file": img_file}
+                _add_member(shard, f"{key}.json", json.dumps(meta).encode())
+                if img_file is not None:
+                    with open(img_file, "rb") as image:
+                        extension = os.path.splitext(img_file)[1][1:].lower()
+                        _add_member(shard, f"{key}.{extension}", image.read())
+        shards.append({"file": shard_file, "num_samples": len(shard_indices)})
+
+    index = {
+        "version": MESH_SHARDS_VERSION,
+        "quantization_bits": quantization_bits,
+        "num_samples": len(samples),
+        "images": image_files is not None,
+        "shards": shards,
+        "failed_files": failed_files,
+        "label_dict": label_dict,
+    }
+    # index.json is written last, so shards without it are incomplete
+    with open(os.path.join(shard_dir, "index.json"), "w") as index_file:
+        json.dump(index, index_file)
+    return failed_files
+
+
+def main(argv: List[str] = None) -> None:
+    """Builds shards of a ShapeNet directory, with the files and class labels of ShapenetDataset"""
+    from polygen.modules.data_modules import ImageDataset, ShapenetDataset
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data-dir", required=True)
+    parser.add_argument("--shard-dir", required=True)
+    parser.add_argument("--quantization-bits", type=int, default=8)
+    parser.add_argument("--samples-per-shard", type=int, default=1000)
+    parser.add_argument("--images", action="store_true", help="Store a sample per rendering, with the rendering")
+    parser.add_argument("--image-extension", default="jpeg")
+    parser.add_argument("--num-workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    dataset = ShapenetDataset(args.data_dir)
+    mesh_files = sorted(dataset.all_files)
+    class_labels = [dataset.class_label(mesh_file) for mesh_file in mesh_files]
+    image_files = None
+    if args.images:
+        image_files = {}
+        for img_file in sorted(ImageDataset(args.data_dir, image_extension=args.image_extension).images):
+            image_files.setdefault(ImageDataset.mesh_file(img_file), []).append(img_file)
+    failed_files = build_shards(
+        mesh_files,
+        class_labels,
+        args.shard_dir,
+        quantization_bits=args.quantization_bits,
+        samples_per_shard=args.samples_per_shard,
+        image_files=image_files,
+        num_workers=args.num_workers,
+        seed=args.seed,
+        label_dict=dataset.label_dict,
+    )
+    print(f"Sharded {len(mesh_files) - len(failed_files)} meshes into {args.shard_dir}, {len(failed_files)} failed")
+
+
+if __name__ == "__main__":
+    main()
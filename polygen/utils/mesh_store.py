@@ -0,0 +1,208 @@
+"""Packed, memory-mapped store of preprocessed meshes
+
+Building a store runs data_utils.load_process_mesh once per .obj file and writes every mesh into a few flat arrays:
+
+    vertices.npy        (total_vertices, 3) quantized vertices, uint8 for up to 8 quantization bits, int16 for up to 15
+    faces.npy           (total_face_indices,) int32 flattened faces with stopping tokens
+    vertex_offsets.npy  (num_meshes + 1,) int64 start of every mesh in vertices
+    face_offsets.npy    (num_meshes + 1,) int64 start of every mesh in faces
+    class_labels.npy    (num_meshes,) int64 class label of every mesh
+    lengths.npy         (num_meshes, 2) int64 number of vertices and number of face indices of every mesh
+    meta.json           quantization bits, source .obj files and class label mapping
+
+A store of ShapeNet can be built from the repository root with:
+
+    python -m polygen.utils.mesh_store --data-dir <shapenet_dir> --store-dir <store_dir> [--num-workers 8]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import traceback
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import torch
+
+from . import data_utils
+
+MESH_STORE_VERSION = 1
+MESH_STORE_ARRAYS = ["vertices", "faces", "vertex_offsets", "face_offsets", "class_labels", "lengths"]
+
+
+def vertex_dtype(quantization_bits: int) -> np.dtype:
+    """NumPy equivalent of data_utils.compact_vertex_dtype, so that stores, caches and shared memory pack alike"""
+    return torch.empty(0, dtype=data_utils.compact_vertex_dtype(quantization_bits)).numpy().dtype
+
+
+def _process_mesh_file(job: Tuple[str, int]) -> Union[Tuple[np.ndarray, np.ndarray], str]:
+    """Preprocesses one .obj file in a worker process
+
+    Args:
+        job: Path to the .obj file and number of quantization bits
+
+    Returns:
+        mesh: Quantized vertices and flattened faces as numpy arrays, or the traceback if preprocessing failed
+    """
+    mesh_file, quantization_bits = job
+    try:
+        vertices, faces = data_utils.load_process_mesh(mesh_file, quantization_bits)
+    except Exception:
+        return traceback.format_exc()
+    return vertices.numpy().astype(vertex_dtype(quantization_bits)), faces.numpy()
+
+
+def build_mesh_store(
+    mesh_files: List[str],
+    class_labels: List[int],
+    store_dir: str,
+    quantization_bits: int = 8,
+    num_workers: Optional[int] = None,
+    label_dict: Optional[Dict[str, int]] = None,
+) -> List[str]:
+    """Preprocesses .obj files across a process pool and writes them to a packed mesh store
+
+    Args:
+        mesh_files: Paths to the .obj files
+        class_labels: Class label of every .obj file
+        store_dir: Directory the store is written to, created if it does not exist
+        quantization_bits: number of quantization bits
+        num_workers: Number of worker processes, defaults to the number of CPUs
+        label_dict: Mapping from class names to class labels, saved with the store for reference
+
+    Returns:
+        failed_files: .obj files that could not be preprocessed and were left out of the store
+    """
+    assert len(mesh_files) == len(class_labels)
+    os.makedirs(store_dir, exist_ok=True)
+    jobs = [(mesh_file, quantization_bits) for mesh_file in mesh_files]
+    stored_files, stored_labels, failed_files = [], [], []
+    all_vertices, all_faces = [], []
+    with multiprocessing.Pool(num_workers) as pool:
+        # imap keeps the order of mesh_files, so the store is the same for any number of workers
+        meshes = pool.imap(_process_mesh_file, jobs, chunksize=8)
+        for mesh_file, class_label, mesh in zip(mesh_files, class_labels, meshes):
+            if isinstance(mesh, str):
+                print(f"Skipping {mesh_file}:\n{mesh}")
+                failed_files.append(mesh_file)
+                continue
+            stored_files.append(mesh_file)
+            stored_labels.append(class_label)
+            all_vertices.append(mesh[0])
+            all_faces.append(mesh[1])
+
+    lengths = np.array([[len(v), len(f)] for v, f in zip(all_vertices, all_faces)], dtype=np.int64).reshape(-1, 2)
+    packed_dtype = vertex_dtype(quantization_bits)
+    arrays = {
+        "vertices": np.concatenate(all_vertices) if all_vertices else np.zeros([0, 3], packed_dtype),
+        "faces": np.concatenate(all_faces) if all_faces else np.zeros([0], np.int32),
+        "vertex_offsets": np.concatenate([[0], np.cumsum(lengths[:, 0])]).astype(np.int64),
+        "face_offsets": np.concatenate([[0], np.cumsum(lengths[:, 1])]).astype(np.int64),
+        "class_labels": np.array(stored_labels, dtype=np.int64),
+        "lengths": lengths,
+    }
+    for name in MESH_STORE_ARRAYS:
+        np.save(os.path.join(store_dir, f"{name}.npy"), arrays[name])
+    meta = {
+        "version": MESH_STORE_VERSION,
+        "num_meshes": len(stored_files),
+        "quantization_bits": quantization_bits,
+        "mesh_files": stored_files,
+        "failed_files": failed_files,
+        "label_dict": label_dict,
+    }
+    # meta.json is written last, so a store without it is incomplete
+    with open(os.path.join(store_dir, "meta.json"), "w") as meta_file:
+        json.dump(meta, meta_file)
+    return failed_files
+
+
+class MeshStore:
+    def __init__(self, store_dir: str) -> None:
+        """Read-only view of a packed mesh store
+
+        The arrays are memory-mapped on first access, so a store can be handed to DataLoader workers
+        without copying it into each of them.
+
+        Args:
+            store_dir: Directory written by build_mesh_store
+        """
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, "meta.json")) as meta_file:
+            self.meta = json.load(meta_file)
+        if self.meta["version"] != MESH_STORE_VERSION:
+            raise ValueError(f"Mesh store version {self.meta['version']} is not supported, rebuild {store_dir}")
+        self.quantization_bits = self.meta["quantization_bits"]
+        self.mesh_files = self.meta["mesh_files"]
+        self._arrays = None
+
+    @property
+    def arrays(self) -> Dict[str, np.ndarray]:
+        """Memory-mapped store arrays, copy-on-write so that in-place changes never reach the files"""
+        if self._arrays is None:
+            self._arrays = {
+                name: np.load(os.path.join(self.store_dir, f"{name}.npy"), mmap_mode="c") for name in MESH_STORE_ARRAYS
+            }
+        return self._arrays
+
+    def __getstate__(self) -> Dict:
+        """Leaves the memory maps out when the store is pickled for worker processes"""
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        return state
+
+    def __len__(self) -> int:
+        """Number of meshes in the store"""
+        return self.meta["num_meshes"]
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """Array of shape (num_meshes, 2) with the number of vertices and face indices of every mesh"""
+        return self.arrays["lengths"]
+
+    def __getitem__(self, idx: int) -> Dict[str, Union[np.ndarray, int]]:
+        """Returns views of the vertices and faces of a mesh, without copying or parsing
+
+        Args:
+            idx: Which mesh we're retrieving
+
+        Returns:
+            mesh_dict: Dictionary with quantized vertices, flattened faces and the class label
+        """
+        arrays = self.arrays
+        vertex_start, vertex_end = arrays["vertex_offsets"][idx : idx + 2]
+        face_start, face_end = arrays["face_offsets"][idx : idx + 2]
+        return {
+            "vertices": arrays["vertices"][vertex_start:vertex_end],
+            "faces": arrays["faces"][face_start:face_end],
+            "class_label": int(arrays["class_labels"][idx]),
+        }
+
+
+def main(argv: List[str] = None) -> None:
+    """Builds a mesh store of a ShapeNet directory, with the files and class labels of ShapenetDataset"""
+    from polygen.modules.data_modules import ShapenetDataset
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data-dir", required=True)
+    parser.add_argument("--store-dir", required=True)
+    parser.add_argument("--quantization-bits", type=int, default=8)
+    parser.add_argument("--num-workers", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    dataset = ShapenetDataset(args.data_dir)
+    mesh_files = sorted(dataset.all_files)
+    class_labels = [dataset.class_label(mesh_file) for mesh_file in mesh_files]
+    failed_files = build_mesh_store(
+        mesh_files,
+        class_labels,
+        args.store_dir,
+        quantization_bits=args.quantization_bits,
+        num_workers=args.num_workers,
+        label_dict=dataset.label_dict,
+    )
+    print(f"Stored {len(mesh_files) - len(failed_files)} meshes in {args.store_dir}, {len(failed_files)} failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Dataset backing that DataLoader workers share instead of copying
+
+Python lists and dicts are made of many small reference-counted objects. Every worker touches their reference counts
+when it reads them, which copies the pages holding them into each forked worker. The containers here keep their
+contents in a few large NumPy arrays and torch tensors instead. Their pages are never written after construction, and
+the tensors are moved to shared memory, so that workers share them under both the fork and the spawn start method.
+"""
+import multiprocessing
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+
+from .mesh_store import _process_mesh_file
+
+
+class StringArray:
+    def __init__(self, strings: Sequence[str]) -> None:
+        """Read-only list of strings packed into one byte array and an array of offsets
+
+        Args:
+            strings: Strings to pack, for example paths to .obj files
+        """
+        encoded = [string.encode() for string in strings]
+        self.offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(string) for string in encoded], out=self.offsets[1:])
+        self.buffer = np.frombuffer(b"".join(encoded), dtype=np.uint8).copy()
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx: int) -> str:
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f"StringArray index {idx} out of range")
+        return self.buffer[self.offsets[idx] : self.offsets[idx + 1]].tobytes().decode()
+
+    def __iter__(self) -> Iterator[str]:
+        return (self[idx] for idx in range(len(self)))
+
+    def tolist(self) -> List[str]:
+        return list(self)
+
+
+class SharedMeshes:
+    def __init__(self, meshes: Sequence[Tuple[torch.Tensor, torch.Tensor]]) -> None:
+        """Processed meshes packed into shared-memory tensors
+
+        Args:
+            meshes: Quantized vertices and flattened faces of every mesh
+        """
+        num_vertices = torch.tensor([len(vertices) for vertices, _ in meshes], dtype=torch.int64)
+        num_faces = torch.tensor([len(faces) for _, faces in meshes], dtype=torch.int64)
+        self.vertex_offsets = torch.cat([torch.zeros(1, dtype=torch.int64), torch.cumsum(num_vertices, dim=0)])
+        self.face_offsets = torch.cat([torch.zeros(1, dtype=torch.int64), torch.cumsum(num_faces, dim=0)])
+        if meshes:
+            self.vertices = torch.cat([vertices for vertices, _ in meshes])
+            self.faces = torch.cat([faces for _, faces in meshes])
+        else:
+            self.vertices = torch.zeros([0, 3], dtype=torch.int32)
+            self.faces = torch.zeros([0], dtype=torch.int32)
+        for tensor in [self.vertices, self.faces, self.vertex_offsets, self.face_offsets]:
+            tensor.share_memory_()
+
+    def __len__(self) -> int:
+        return len(self.vertex_offsets) - 1
+
+    def __getitem__(self, idx: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Returns views of the vertices and faces of a mesh, without copying them"""
+        vertex_start, vertex_end = self.vertex_offsets[idx : idx + 2].tolist()
+        face_start, face_end = self.face_offsets[idx : idx + 2].tolist()
+        return self.vertices[vertex_start:vertex_end], self.faces[face_start:face_end]
+
+    @property
+    def nbytes(self) -> int:
+        """Size of the packed tensors in bytes"""
+        tensors = [self.vertices, self.faces, self.vertex_offsets, self.face_offsets]
+        return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+def preload_meshes(
+    mesh_files: Sequence[str], quantization_bits: int = 8, num_workers: Optional[int] = None
+) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+    """Preprocesses .obj files across a process pool
+
+    Args:
+        mesh_files: Paths to the .obj files
+        quantization_bits: number of quantization bits
+        num_workers: Number of worker processes, defaults to the number of CPUs
+
+    Returns:
+        meshes: Quantized vertices, packed as in a mesh store, and int32 flattened faces of every file
+    """
+    jobs = [(mesh_file, quantization_bits) for mesh_file in mesh_files]
+    meshes = []
+    with multiprocessing.Pool(num_workers) as pool:
+        for mesh_file, mesh in zip(mesh_files, pool.imap(_process_mesh_file, jobs, chunksize=8)):
+            if isinstance(mesh, str):
+                raise RuntimeError(f"Could not preprocess {mesh_file}:\n{mesh}")
+            meshes.append((torch.from_numpy(mesh[0]), torch.from_numpy(mesh[1])))
+    return meshes
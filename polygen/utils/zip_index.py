@@ -0,0 +1,184 @@
+"""Random access to the meshes of ShapeNet zip archives without extracting them
+
+ShapeNet ships as one zip archive per category. Indexing the archives reads their central directories once and records
+where every model_normalized.obj member starts, so that a member is then read with one seek and one read of its
+compressed bytes. Meshes are named by the path of the archive joined with the member name, for example
+<zip_dir>/02691156.zip/02691156/<model_id>/models/model_normalized.obj, which keeps the category folder where
+ShapenetDataset looks for it.
+
+The index of a directory of archives is built, reusing the entries of archives that did not change, from the repository
+root with:
+
+    python -m polygen.utils.zip_index --zip-dir <shapenet_zip_dir> --index-path <index.json>
+"""
+import argparse
+import glob
+import json
+import os
+import struct
+import zipfile
+import zlib
+from typing import BinaryIO, Dict, List
+
+ZIP_INDEX_VERSION = 1
+MESH_MEMBER_SUFFIX = "models/model_normalized.obj"
+
+# Local file header: signature, versions and flags, compression, time, date, crc, sizes, name and extra field lengths
+_LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+_LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+_SUPPORTED_COMPRESSION = {zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED}
+
+
+def index_archive(zip_file: str) -> List[List]:
+    """Reads the central directory of an archive and lists its mesh members
+
+    Args:
+        zip_file: Path to the zip archive
+
+    Returns:
+        members: Name, local header offset, compressed size, size, compression method and CRC of every mesh member
+    """
+    members = []
+    with zipfile.ZipFile(zip_file) as archive:
+        for info in archive.infolist():
+            if info.is_dir() or not info.filename.endswith(MESH_MEMBER_SUFFIX):
+                continue
+            if info.compress_type not in _SUPPORTED_COMPRESSION:
+                raise ValueError(f"{info.filename} in {zip_file} uses unsupported compression {info.compress_type}")
+            members.append(
+                [info.filename, info.header_offset, info.compress_size, info.file_size, info.compress_type, info.CRC]
+            )
+    return members
+
+
+def build_zip_index(zip_files: List[str], index_path: str) -> Dict[str, int]:
+    """Indexes the mesh members of zip archives, reusing the entries of an existing index for unchanged archives
+
+    Args:
+        zip_files: Paths to the zip archives
+        index_path: Path the index is written to
+
+    Returns:
+        stats: Number of indexed and reused archives and number of meshes
+    """
+    previous = {}
+    if os.path.exists(index_path):
+        with open(index_path) as index_file:
+            index = json.load(index_file)
+        if index["version"] == ZIP_INDEX_VERSION:
+            previous = {archive["path"]: archive for archive in index["archives"]}
+
+    archives, num_indexed = [], 0
+    for zip_file in sorted(os.path.abspath(zip_file) for zip_file in zip_files):
+        stat = os.stat(zip_file)
+        archive = previous.get(zip_file)
+        if archive is None or archive["size"] != stat.st_size or archive["mtime_ns"] != stat.st_mtime_ns:
+            archive = {"path": zip_file, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+            archive["members"] = index_archive(zip_file)
+            num_indexed += 1
+        archives.append(archive)
+
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as index_file:
+        json.dump({"version": ZIP_INDEX_VERSION, "archives": archives}, index_file)
+    os.replace(tmp_path, index_path)
+    return {
+        "indexed": num_indexed,
+        "reused": len(archives) - num_indexed,
+        "meshes": sum(len(archive["members"]) for archive in archives),
+    }
+
+
+class ZipMeshArchives:
+    def __init__(self, index_path: str) -> None:
+        """Reads mesh members of indexed zip archives by offset
+
+        Every process opens each archive once and keeps the file handle, so DataLoader workers read through their own
+        handles and never share file positions.
+
+        Args:
+            index_path: Index written by build_zip_index
+        """
+        self.index_path = index_path
+        with open(index_path) as index_file:
+            index = json.load(index_file)
+        if index["version"] != ZIP_INDEX_VERSION:
+            raise ValueError(f"Zip index version {index['version']} is not supported, rebuild {index_path}")
+        self.archive_files = [archive["path"] for archive in index["archives"]]
+        # Archive and member entry of every mesh, keyed by the archive path joined with the member name
+        self.members = {}
+        for archive_id, archive in enumerate(index["archives"]):
+            for member in archive["members"]:
+                self.members[os.path.join(archive["path"], member[0])] = (archive_id, member)
+        self.mesh_files = list(self.members)
+        self._handles = {}
+        self._pid = os.getpid()
+
+    def __getstate__(self) -> Dict:
+        """Leaves the file handles out when the archives are pickled for worker processes"""
+        state = self.__dict__.copy()
+        state["_handles"] = {}
+        return state
+
+    def __len__(self) -> int:
+        """Number of indexed meshes"""
+        return len(self.members)
+
+    def handle(self, archive_id: int) -> BinaryIO:
+        """Returns the file handle of an archive opened by this process"""
+        if os.getpid() != self._pid:
+            # Forked workers inherit the handles of the parent, whose file positions they would share
+            self._handles, self._pid = {}, os.getpid()
+        handle = self._handles.get(archive_id)
+        if handle is None:
+            handle = open(self.archive_files[archive_id], "rb")
+            self._handles[archive_id] = handle
+        return handle
+
+    def close(self) -> None:
+        """Closes the file handles of this process"""
+        for handle in self._handles.values():
+            handle.close()
+        self._handles = {}
+
+    def read(self, mesh_file: str) -> bytes:
+        """Reads and decompresses a mesh member
+
+        Args:
+            mesh_file: Archive path joined with the member name, as listed in mesh_files
+
+        Returns:
+            obj_data: Contents of the .obj member
+        """
+        archive_id, (name, header_offset, compress_size, file_size, compress_type, crc) = self.members[mesh_file]
+        handle = self.handle(archive_id)
+        handle.seek(header_offset)
+        header = handle.read(_LOCAL_HEADER.size)
+        fields = _LOCAL_HEADER.unpack(header)
+        if fields[0] != _LOCAL_HEADER_SIGNATURE:
+            raise zipfile.BadZipFile(f"Bad local file header of {name} in {self.archive_files[archive_id]}")
+        # The local name and extra field may differ in length from the central directory, so they are skipped here
+        handle.seek(fields[-2] + fields[-1], os.SEEK_CUR)
+        data = handle.read(compress_size)
+        if compress_type == zipfile.ZIP_DEFLATED:
+            data = zlib.decompress(data, -zlib.MAX_WBITS)
+        if len(data) != file_size or zlib.crc32(data) != crc:
+            raise zipfile.BadZipFile(
+                f"Bad CRC of {name} in {self.archive_files[archive_id]}, the index {self.index_path} may be outdated"
+            )
+        return data
+
+
+def main(argv: List[str] = None) -> None:
+    """Indexes the mesh members of the zip archives of a directory"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--zip-dir", required=True)
+    parser.add_argument("--index-path", required=True)
+    args = parser.parse_args(argv)
+
+    stats = build_zip_index(glob.glob(os.path.join(args.zip_dir, "*.zip")), args.index_path)
+    print(", ".join(f"{count} {name}" for name, count in stats.items()))
+
+
+if __name__ == "__main__":
+    main()
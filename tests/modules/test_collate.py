@@ -0,0 +1,269 @@
+"""Tests to ensure that the vectorized collate functions give the same batches as the per-element loops"""
+import copy
+import os
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+import polygen.utils.data_utils as data_utils
+from polygen.modules.data_modules import CollateMethod, PolygenDataModule
+from polygen.utils.data_utils import dequantize_verts
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DATA_DIR = os.path.join(REPO_DIR, "image_meshes")
+
+
+def make_data_module(collate_method, **kwargs):
+    return PolygenDataModule(data_dir=DATA_DIR, collate_method=collate_method, batch_size=4, **kwargs)
+
+
+def load_batch(data_module):
+    dataset = data_module.shapenet_dataset
+    return [dataset[idx] for idx in range(len(dataset))]
+
+
+def assert_same_batch(batch, expected_batch):
+    assert batch.keys() == expected_batch.keys()
+    for key in expected_batch:
+        assert batch[key].dtype == expected_batch[key].dtype, key
+        assert torch.equal(batch[key], expected_batch[key]), key
+
+
+def reference_collate_vertex_model_batch(data_module, ds):
+    """Per-element loop version of collate_vertex_model_batch, the oracle of the vectorized version
+    Args:
+        data_module: Data module whose settings the batch is collated with
+        ds: List of dictionaries where each dictionary has information about a 3D object, this is the batch
+    Returns
+        vertex_model_batch: A single dictionary which represents the whole batch
+    """
+    vertex_model_batch = {}
+    num_vertices_list = [shape_dict["vertices"].shape[0] for shape_dict in ds]
+    max_vertices = max(num_vertices_list)
+    num_elements = len(ds) # number of elements in a batch
+    vertices_flat = torch.zeros([num_elements, max_vertices * 3 + 1], dtype=torch.int32) # this is for the whole batch
+    class_labels = torch.zeros([num_elements], dtype=torch.int32)
+    vertices_flat_mask = torch.zeros_like(vertices_flat, dtype=torch.int32)
+    for i, element in enumerate(ds):
+        vertices = element["vertices"] # this is for the current element in batch
+        if data_module.apply_random_shift_vertices:
+            vertices = data_utils.random_shift(vertices)
+        initial_vertex_size = vertices.shape[0]
+        padding_size = max_vertices - initial_vertex_size
+        vertices_permuted = torch.stack([vertices[..., 2], vertices[..., 1], vertices[..., 0]], dim=-1)
+        curr_vertices_flat = vertices_permuted.reshape([-1])
+        # +1 does the reindexing of the vertex coords
+        vertices_flat[i] = F.pad(curr_vertices_flat + 1, [0, padding_size * 3 + 1])[None]
+        class_labels[i] = torch.Tensor([element["class_label"]])
+        vertices_flat_mask[i] = torch.zeros_like(vertices_flat[i], dtype=torch.float32) # this is probably not needed
+        # padding tokens are left as zero, +1 because last element in slice is not included
+        vertices_flat_mask[i, : initial_vertex_size * 3 + 1] = 1
+    vertex_model_batch["vertices_flat"] = vertices_flat
+    vertex_model_batch["class_label"] = class_labels
+    vertex_model_batch["vertices_flat_mask"] = vertices_flat_mask
+    return vertex_model_batch
+
+
+def reference_collate_face_model_batch(data_module, ds):
+    """Per-element loop version of collate_face_model_batch, the oracle of the vectorized version
+    Args:
+        data_module: Data module whose settings the batch is collated with
+        ds: List of dictionaries with each dictionary containing info about a specific 3D object
+
+    Returns:
+        face_model_batch: A single dictionary which represents the whole face model batch
+    """
+    face_model_batch = {}
+    num_vertices_list = [shape_dict["vertices"].shape[0] for shape_dict in ds]
+    max_vertices = max(num_vertices_list)
+    num_faces_list = [shape_dict["faces"].shape[0] for shape_dict in ds]
+    max_faces = max(num_faces_list)
+    num_elements = len(ds)
+
+    shuffled_faces = torch.zeros([num_elements, max_faces], dtype=torch.int32)
+    face_vertices = torch.zeros([num_elements, max_vertices, 3])
+    face_vertices_mask = torch.zeros([num_elements, max_vertices], dtype=torch.int32)
+    faces_mask = torch.zeros_like(shuffled_faces, dtype=torch.int32)
+
+    for i, element in enumerate(ds):
+        vertices = element["vertices"]
+        num_vertices = vertices.shape[0]
+        if data_module.apply_random_shift_faces:
+            vertices = data_utils.random_shift(vertices)
+
+        if data_module.shuffle_vertices:
+            permutation = torch.randperm(num_vertices)
+            vertices = vertices[permutation]
+            vertices = vertices.unsqueeze(0)
+            face_permutation = torch.cat(
+                [
+                    torch.Tensor([0, 1]).to(torch.int32),
+                    torch.argsort(permutation).to(torch.int32) + 2,
+                ],
+                dim=0,
+            )
+            curr_faces = face_permutation[element["faces"].to(torch.int64)][None]
+        else:
+            curr_faces = element["faces"][None]
+
+        vertex_padding_size = max_vertices - num_vertices
+        initial_faces_size = curr_faces.shape[1]
+        face_padding_size = max_faces - initial_faces_size
+        shuffled_faces[i] = F.pad(curr_faces, [0, face_padding_size, 0, 0])
+        curr_verts = data_utils.dequantize_verts(vertices, data_module.quantization_bits)
+        face_vertices[i] = F.pad(curr_verts, [0, 0, 0, vertex_padding_size])
+        face_vertices_mask[i] = torch.zeros_like(face_vertices[i][..., 0], dtype=torch.float32)
+        face_vertices_mask[i, :num_vertices] = 1
+        faces_mask[i] = torch.zeros_like(shuffled_faces[i], dtype=torch.float32)
+        faces_mask[i, : initial_faces_size + 1] = 1
+    face_model_batch["faces"] = shuffled_faces
+    face_model_batch["vertices"] = face_vertices
+    face_model_batch["vertices_mask"] = face_vertices_mask
+    face_model_batch["faces_mask"] = faces_mask
+    return face_model_batch
+
+
+def reference_collate_img_model_batch(data_module, ds):
+    """Per-element loop version of collate_img_model_batch, the oracle of the vectorized version
+
+    Args:
+        data_module: Data module whose settings the batch is collated with
+        ds: List of dictionaries where each dictionary has information about a 3D object
+
+    Returns:
+        img_vertex_model_batch: A single dictionary which represents the whole batch
+    """
+    img_vertex_model_batch = {}
+    num_vertices_list = [shape_dict["vertices"].shape[0] for shape_dict in ds]
+    max_vertices = max(num_vertices_list)
+    num_elements = len(ds)
+    vertices_flat = torch.zeros([num_elements, max_vertices * 3 + 1])
+    vertices_flat_mask = torch.zeros_like(vertices_flat)
+    images = torch.zeros(
+        [
+            num_elements,
+            ds[0]["image"].shape[0],
+            ds[0]["image"].shape[1],
+            ds[0]["image"].shape[2],
+        ]
+    )
+
+    for i, element in enumerate(ds):
+        vertices = element["vertices"]
+        initial_vertex_size = vertices.shape[0]
+        padding_size = max_vertices - initial_vertex_size
+        vertices_permuted = torch.stack([vertices[..., 2], vertices[..., 1], vertices[..., 0]], dim=-1)
+        curr_vertices_flat = vertices_permuted.reshape([-1])
+        vertices_flat[i] = F.pad(curr_vertices_flat + 1, [0, padding_size * 3 + 1])[None]
+
+        vertices_flat_mask[i] = torch.zeros_like(vertices_flat[i], dtype=torch.float32)
+        vertices_flat_mask[i, : initial_vertex_size * 3 + 1] = 1
+
+        images[i] = element["image"]
+
+    img_vertex_model_batch["vertices_flat"] = vertices_flat
+    img_vertex_model_batch["vertices_flat_mask"] = vertices_flat_mask
+    img_vertex_model_batch["image"] = images
+    return img_vertex_model_batch
+
+
+def collate_both(collate, reference_collate, data_module, ds):
+    return collate(copy.deepcopy(ds)), reference_collate(data_module, copy.deepcopy(ds))
+
+
+def test_collate_vertex_model_batch_matches_reference():
+    data_module = make_data_module(CollateMethod.VERTICES, apply_random_shift_vertices=False)
+    ds = load_batch(data_module)
+    assert_same_batch(
+        *collate_both(data_module.collate_vertex_model_batch, reference_collate_vertex_model_batch, data_module, ds)
+    )
+
+
+def test_collate_face_model_batch_matches_reference():
+    data_module = make_data_module(CollateMethod.FACES, apply_random_shift_faces=False, shuffle_vertices=False)
+    ds = load_batch(data_module)
+    assert_same_batch(
+        *collate_both(data_module.collate_face_model_batch, reference_collate_face_model_batch, data_module, ds)
+    )
+
+
+def test_collate_face_model_batch_shuffles_vertices_consistently():
+    # The batched permutation draws different random numbers than the per-element loop, so compare the meshes the
+    # faces describe instead of the vertex order
+    ds = load_batch(make_data_module(CollateMethod.FACES))
+    batches = {}
+    for shuffle_vertices in [False, True]:
+        data_module = make_data_module(
+            CollateMethod.FACES, apply_random_shift_faces=False, shuffle_vertices=shuffle_vertices
+        )
+        batches[shuffle_vertices] = data_module.collate_face_model_batch(copy.deepcopy(ds))
+    batch, expected_batch = batches[True], batches[False]
+    for key in ["vertices_mask", "faces_mask"]:
+        assert torch.equal(batch[key], expected_batch[key])
+    for i in range(len(ds)):
+        is_vertex = batch["faces"][i] >= 2
+        assert torch.equal(is_vertex, expected_batch["faces"][i] >= 2)
+        face_vertices = batch["vertices"][i][batch["faces"][i][is_vertex].long() - 2]
+        expected_face_vertices = expected_batch["vertices"][i][expected_batch["faces"][i][is_vertex].long() - 2]
+        assert torch.equal(face_vertices, expected_face_vertices)
+        num_vertices = int(batch["vertices_mask"][i].sum())
+        # Every mesh is shuffled within its own vertices
+        assert sorted(batch["vertices"][i, :num_vertices].tolist()) == sorted(
+            expected_batch["vertices"][i, :num_vertices].tolist()
+        )
+
+
+def test_collate_img_model_batch_matches_reference():
+    data_module = make_data_module(CollateMethod.VERTICES)
+    ds = load_batch(data_module)
+    for element in ds:
+        element["image"] = torch.rand(size=[3, 8, 8])
+    assert_same_batch(
+        *collate_both(data_module.collate_img_model_batch, reference_collate_img_model_batch, data_module, ds)
+    )
+
+
+@pytest.mark.parametrize("quantization_bits", [8, 6])
+def test_random_shift_moves_meshes_within_quantization_range(quantization_bits):
+    data_module = make_data_module(CollateMethod.VERTICES, quantization_bits=quantization_bits, shift_seed=5)
+    ds = load_batch(data_module)
+    vertices = torch.cat([element["vertices"] for element in ds])
+    num_vertices = torch.tensor([element["vertices"].shape[0] for element in ds])
+    shifted_vertices = data_module.random_shift(vertices, num_vertices, ds)
+    assert shifted_vertices.dtype == vertices.dtype
+    assert shifted_vertices.min() >= 0 and shifted_vertices.max() <= 2 ** quantization_bits - 1
+    # Every mesh moves as a whole
+    for shift in torch.split(shifted_vertices - vertices, num_vertices.tolist()):
+        assert torch.all(shift == shift[0])
+
+    # The shift of a mesh only depends on its index, not on the batch it is in
+    reversed_shifted_vertices = data_module.random_shift(vertices.flip(0), num_vertices.flip(0), ds[::-1])
+    assert torch.equal(reversed_shifted_vertices.flip(0), shifted_vertices)
+    batch = data_module.collate_vertex_model_batch(ds)
+    assert torch.equal(data_module.collate_vertex_model_batch(ds)["vertices_flat"], batch["vertices_flat"])
+
+
+@pytest.mark.parametrize("collate_method", [CollateMethod.VERTICES, CollateMethod.FACES])
+def test_compact_batches_hold_the_same_values(collate_method):
+    batches = {}
+    for compact_dtypes in [False, True]:
+        data_module = make_data_module(
+            collate_method,
+            apply_random_shift_vertices=False,
+            apply_random_shift_faces=False,
+            shuffle_vertices=False,
+            compact_dtypes=compact_dtypes,
+        )
+        batches[compact_dtypes] = data_module.collate_fn(load_batch(data_module))
+    batch, expected_batch = batches[True], batches[False]
+    assert batch.keys() == expected_batch.keys()
+    for key in batch:
+        assert batch[key].element_size() <= expected_batch[key].element_size()
+        if key == "vertices":
+            # Face model batches hold quantized instead of dequantized vertices, padded with 0 instead of 0.0
+            assert batch[key].dtype == torch.uint8
+            vertices = dequantize_verts(batch[key].to(torch.int32)) * expected_batch["vertices_mask"][..., None]
+            assert torch.equal(vertices, expected_batch[key])
+        else:
+            assert torch.equal(batch[key].to(expected_batch[key].dtype), expected_batch[key])
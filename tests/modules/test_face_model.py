@@ -2,9 +2,11 @@
 
 import pdb
 
+import pytest
 import torch
 
 from polygen.modules.face_model import FaceModel
+from polygen.utils.data_utils import dequantize_verts, quantize_verts
 
 torch.manual_seed(42)
 
@@ -61,3 +63,86 @@ def test_face_model_sampling():
         "class_label": class_labels,
     }
     samples = face_model.sample(context=context)
+
+
+def test_face_model_incremental_embedding():
+    transformer_config = {
+        "hidden_size": 128,
+        "fc_size": 256,
+        "num_heads": 4,
+        "layer_norm": True,
+        "num_layers": 2,
+    }
+    face_model = FaceModel(
+        encoder_config=transformer_config,
+        decoder_config=transformer_config,
+        class_conditional=True,
+        num_classes=10,
+    )
+    vertex_embeddings = torch.randn(size=[4, 22, 128])
+    global_context = face_model._embed_class_label(torch.randint(low=0, high=10, size=[4]))
+    faces = torch.randint(low=0, high=22, size=[4, 30])
+    for seq_length in [0, 1, 30]:
+        full_embeddings = face_model._embed_inputs(faces[:, :seq_length], vertex_embeddings, global_context)
+        next_embedding = face_model._embed_next_input(faces[:, :seq_length], vertex_embeddings, global_context)
+        assert torch.equal(full_embeddings[-1:], next_embedding)
+    assert torch.equal(full_embeddings[1:, 2], vertex_embeddings[2, faces[2]] + face_model.pos_embedder.weight[:30])
+
+
+def test_face_model_sampling_with_stop_check_interval():
+    transformer_config = {
+        "hidden_size": 128,
+        "fc_size": 256,
+        "num_heads": 4,
+        "layer_norm": True,
+        "num_layers": 2,
+    }
+    face_model = FaceModel(
+        encoder_config=transformer_config,
+        decoder_config=transformer_config,
+        class_conditional=False,
+        max_seq_length=100,
+    )
+    context = {
+        "vertices": torch.rand(size=[4, 20, 3]) - 0.5,
+        "vertices_mask": torch.ones(size=[4, 20]),
+    }
+    samples = face_model.sample(context, max_sample_length=50, only_return_complete=False, stop_check_interval=8)
+    assert samples["faces"].shape == (4, 50)
+    for faces, num_face_indices in zip(samples["faces"], samples["num_face_indices"]):
+        # Tokens sampled after the stop token between two checks are masked out
+        assert torch.all(faces[num_face_indices:] == 0)
+    for stop_check_interval in [0, -1]:
+        with pytest.raises(ValueError):
+            face_model.sample(context, max_sample_length=50, stop_check_interval=stop_check_interval)
+
+
+def test_face_model_accepts_quantized_vertices():
+    transformer_config = {
+        "hidden_size": 128,
+        "fc_size": 256,
+        "num_heads": 4,
+        "layer_norm": True,
+        "num_layers": 2,
+    }
+    face_model = FaceModel(
+        encoder_config=transformer_config,
+        decoder_config=transformer_config,
+        class_conditional=False,
+        num_classes=10,
+    )
+    face_model.eval()
+    # Compact batches hold uint8 vertices, uint8 masks and int16 faces
+    quantized_vertices = torch.randint(low=0, high=256, size=[4, 20, 3], dtype=torch.uint8)
+    vertices_mask = torch.ones(size=[4, 20], dtype=torch.uint8)
+    faces = torch.randint(low=0, high=22, size=[4, 80], dtype=torch.int16)
+    compact_batch = {"faces": faces, "vertices": quantized_vertices, "vertices_mask": vertices_mask}
+    # Dequantized floats that quantize back to the same vertices give the same logits
+    float_batch = {
+        "faces": faces.to(torch.int32),
+        "vertices": dequantize_verts(quantized_vertices.to(torch.float64) + 0.5).to(torch.float32),
+        "vertices_mask": vertices_mask.to(torch.float32),
+    }
+    assert torch.equal(quantize_verts(float_batch["vertices"]), quantized_vertices.to(torch.int32))
+    with torch.no_grad():
+        assert torch.allclose(face_model(compact_batch), face_model(float_batch))
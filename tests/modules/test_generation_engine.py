@@ -0,0 +1,59 @@
+"""Tests to ensure that the continuous batching engine serves more requests than batch slots"""
+
+import torch
+
+from polygen.modules.face_model import FaceModel
+from polygen.modules.generation_engine import GenerationEngine, GenerationRequest
+from polygen.modules.vertex_model import VertexModel
+
+torch.manual_seed(42)
+
+transformer_config = {
+    "hidden_size": 128,
+    "fc_size": 256,
+    "num_heads": 4,
+    "layer_norm": True,
+    "num_layers": 2,
+}
+
+
+def test_vertex_generation_engine():
+    vertex_model = VertexModel(
+        decoder_config=transformer_config,
+        quantization_bits=8,
+        class_conditional=True,
+        num_classes=10,
+        max_num_input_verts=100,
+    )
+    # A small cache forces the engine to drop old cache steps while requests keep arriving
+    engine = GenerationEngine(vertex_model, max_batch_size=2, max_sample_length=10, cache_length=31)
+    max_lengths = [3, 10, 5, 7, 1]
+    requests = [GenerationRequest({"class_label": torch.tensor([i])}, length) for i, length in enumerate(max_lengths)]
+    results = engine.run(requests)
+    assert len(results) == len(max_lengths)
+    for result, max_length in zip(results, max_lengths):
+        assert result["num_tokens"] <= max_length * 3 + 1
+        assert result["vertices"].shape == (result["num_vertices"], 3)
+    assert engine.throughput()["tokens"] == sum(result["num_tokens"] for result in results)
+
+
+def test_face_generation_engine():
+    face_model = FaceModel(
+        encoder_config=transformer_config,
+        decoder_config=transformer_config,
+        class_conditional=False,
+        max_seq_length=100,
+    )
+    engine = GenerationEngine(face_model, max_batch_size=2, max_sample_length=40, max_num_vertices=20)
+    requests = []
+    for num_vertices, max_length in [(20, 40), (8, 12), (15, 30)]:
+        context = {
+            "vertices": torch.rand(size=[1, num_vertices, 3]) - 0.5,
+            "vertices_mask": torch.ones(size=[1, num_vertices]),
+        }
+        requests.append(GenerationRequest(context, max_length))
+    results = engine.run(requests)
+    for result, request in zip(results, requests):
+        assert result["num_tokens"] <= request.max_sample_length
+        assert result["faces"].shape == (result["num_face_indices"],)
+        assert torch.all(result["faces"] < request.context["vertices"].shape[1] + 2)
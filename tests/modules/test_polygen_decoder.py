@@ -0,0 +1,150 @@
+"""Tests to ensure that cached decoding in the transformer decoder matches the uncached forward pass"""
+
+import pytest
+import torch
+
+from polygen.modules.polygen_decoder import TransformerDecoder
+
+torch.manual_seed(42)
+
+
+def _make_decoder() -> TransformerDecoder:
+    decoder = TransformerDecoder(hidden_size=128, fc_size=256, num_heads=4, num_layers=2)
+    decoder.eval()
+    # Residual scales are zero initialized, which would hide the attention outputs
+    with torch.no_grad():
+        for layer in decoder.decoder.layers:
+            layer.alpha.fill_(1.0)
+            layer.beta.fill_(1.0)
+            layer.gamma.fill_(1.0)
+    return decoder
+
+
+def _decode_step_by_step(decoder, inputs, memory, cache):
+    outputs = []
+    for i in range(inputs.shape[0]):
+        outputs.append(decoder(inputs[i : i + 1], sequential_context_embeddings=memory, cache=cache))
+    return torch.cat(outputs, dim=0)
+
+
+def test_projected_cache_matches_uncached_decoding():
+    decoder = _make_decoder()
+    inputs = torch.randn(12, 3, 128)
+    memory = torch.randn(7, 3, 128)
+    with torch.no_grad():
+        uncached = decoder(inputs, sequential_context_embeddings=memory)
+        raw_cached = _decode_step_by_step(decoder, inputs, memory, decoder.initialize_cache(3))
+        projected_cached = _decode_step_by_step(decoder, inputs, memory, decoder.initialize_cache(3, projected=True))
+    assert torch.allclose(uncached, raw_cached, atol=1e-5)
+    assert torch.allclose(uncached, projected_cached, atol=1e-5)
+
+
+def test_projected_cache_multi_token_step():
+    decoder = _make_decoder()
+    inputs = torch.randn(10, 2, 128)
+    cache = decoder.initialize_cache(2, projected=True)
+    with torch.no_grad():
+        uncached = decoder(inputs)
+        prefix = decoder(inputs[:6], cache=cache)
+        suffix = _decode_step_by_step(decoder, inputs[6:], None, cache)
+    assert torch.allclose(uncached, torch.cat([prefix, suffix], dim=0), atol=1e-5)
+    assert cache[0]["projected_k"].shape == (2, 4, 10, 32)
+
+
+def test_preallocated_cache_matches_uncached_decoding():
+    decoder = _make_decoder()
+    inputs = torch.randn(8, 3, 128)
+    cache = decoder.initialize_cache(3, projected=True, max_length=8)
+    with torch.no_grad():
+        uncached = decoder(inputs)
+        cached = _decode_step_by_step(decoder, inputs, None, cache)
+    assert torch.allclose(uncached, cached, atol=1e-5)
+    assert cache[0]["length"] == 8
+    assert cache[0]["projected_k"].shape == (3, 4, 8, 32)
+
+
+def test_memory_cache_matches_uncached_decoding():
+    decoder = _make_decoder()
+    inputs = torch.randn(6, 3, 128)
+    memory = torch.randn(9, 3, 128)
+    cache = decoder.initialize_cache(3, projected=True, max_length=6, memory=memory)
+    with torch.no_grad():
+        uncached = decoder(inputs, sequential_context_embeddings=memory)
+        # Memory is only passed when the cache is created
+        cached = _decode_step_by_step(decoder, inputs, None, cache)
+    assert torch.allclose(uncached, cached, atol=1e-5)
+    assert cache[0]["memory_k"].shape == (3, 4, 9, 32)
+
+
+def test_select_cache_rows_matches_smaller_batch():
+    decoder = _make_decoder()
+    inputs = torch.randn(6, 4, 128)
+    memory = torch.randn(5, 4, 128)
+    keep = torch.tensor([0, 2])
+    cache = decoder.initialize_cache(4, projected=True, max_length=6, memory=memory)
+    with torch.no_grad():
+        uncached = decoder(inputs[:, keep], sequential_context_embeddings=memory[:, keep])
+        prefix = decoder(inputs[:3], cache=cache)
+        decoder.select_cache_rows(cache, keep)
+        suffix = _decode_step_by_step(decoder, inputs[3:, keep], None, cache)
+    assert torch.allclose(uncached, torch.cat([prefix[:, keep], suffix], dim=0), atol=1e-5)
+    assert cache[0]["projected_k"].shape == (2, 4, 6, 32)
+
+
+def test_reset_and_trim_cache_rows_match_fresh_decoding():
+    decoder = _make_decoder()
+    old_inputs = torch.randn(5, 2, 128)
+    new_inputs = torch.randn(4, 1, 128)
+    memory = torch.randn(6, 2, 128)
+    cache = decoder.initialize_cache(2, projected=True, max_length=8)
+    decoder.reset_cache_rows(cache, torch.arange(2), memory=memory)
+    with torch.no_grad():
+        expected = decoder(new_inputs, sequential_context_embeddings=memory[:, 1:])
+        _decode_step_by_step(decoder, old_inputs, None, cache)
+        # Row 1 starts a new sequence behind the other row, and the cache runs full while it decodes
+        decoder.reset_cache_rows(cache, torch.tensor([1]), memory=memory[:, 1:])
+        outputs = []
+        for i in range(new_inputs.shape[0]):
+            if cache[0]["length"] == 8:
+                decoder.reset_cache_rows(cache, torch.tensor([0]))  # Row 0 no longer attends to its old steps
+                decoder.trim_cache(cache, 8 - i)
+            inputs = torch.cat([torch.randn(1, 1, 128), new_inputs[i : i + 1]], dim=1)
+            outputs.append(decoder(inputs, cache=cache)[:, 1:])
+    assert torch.allclose(expected, torch.cat(outputs, dim=0), atol=1e-5)
+
+
+def test_memory_cache_padding_mask_matches_uncached_decoding():
+    decoder = _make_decoder()
+    inputs = torch.randn(5, 2, 128)
+    memory = torch.randn(7, 2, 128)
+    memory_key_padding_mask = torch.zeros([2, 7], dtype=torch.bool)
+    memory_key_padding_mask[1, 4:] = True
+    cache = decoder.initialize_cache(
+        2, projected=True, max_length=5, memory=memory, memory_key_padding_mask=memory_key_padding_mask
+    )
+    with torch.no_grad():
+        uncached = decoder.decoder(
+            inputs,
+            memory=memory,
+            tgt_mask=decoder.generate_square_subsequent_mask(5),
+            memory_key_padding_mask=memory_key_padding_mask,
+        )
+        cached = _decode_step_by_step(decoder, inputs, None, cache)
+    assert torch.allclose(uncached, cached, atol=1e-5)
+
+
+def test_cached_attention_rejects_masks():
+    decoder = _make_decoder()
+    inputs = torch.randn(1, 2, 128)
+    memory = torch.randn(3, 2, 128)
+    layer = decoder.decoder.layers[0]
+    masks = {
+        "tgt_mask": torch.zeros([1, 1]),
+        "tgt_key_padding_mask": torch.zeros([2, 1], dtype=torch.bool),
+        "memory_mask": torch.zeros([1, 3]),
+        "memory_key_padding_mask": torch.zeros([2, 3], dtype=torch.bool),
+    }
+    for name, mask in masks.items():
+        cache = decoder.initialize_cache(2, projected=True, max_length=2, memory=memory)[0]
+        with pytest.raises(ValueError):
+            layer(inputs, **{name: mask}, cache=cache)
@@ -0,0 +1,55 @@
+"""Tests to ensure that the fused logit filtering and Gumbel-max sampling match the categorical sampling path"""
+
+import torch
+
+from polygen.modules.utils import filter_logits, gumbel_max_sample, top_p_logits
+
+torch.manual_seed(42)
+
+
+def test_filter_logits_top_k_is_per_row():
+    logits = torch.randn(4, 3, 50)
+    logits[0] += 10.0  # A global threshold would keep all logits of this row and none of the others
+    kept = filter_logits(logits, top_k=5) > -1e8
+    assert torch.all(torch.sum(kept, dim=-1) == 5)
+    assert torch.equal(kept, logits >= torch.topk(logits, 5).values[..., -1:])
+
+
+def test_filter_logits_top_p_matches_top_p_logits():
+    logits = torch.randn(6, 2, 257) * 3.0
+    for top_p in [0.1, 0.5, 0.9]:
+        kept = filter_logits(logits, top_p=top_p) > -1e8
+        expected = top_p_logits(logits, top_p) > -1e8
+        assert torch.equal(kept, expected)
+
+
+def test_filter_logits_top_p_within_top_k():
+    logits = torch.randn(8, 100)
+    top_k_logits = filter_logits(logits, top_k=10)
+    assert torch.equal(filter_logits(logits, top_k=10, top_p=0.7), filter_logits(top_k_logits, top_p=0.7))
+
+
+def test_gumbel_max_sample_matches_categorical():
+    logits = torch.tensor([[2.0, 1.0, 0.0, -1.0, -1e9], [0.0, 0.0, 3.0, 0.5, 0.0]])
+    num_draws = 20000
+    samples = gumbel_max_sample(logits[:, None].expand(-1, num_draws, -1))  # [2, num_draws]
+    frequencies = torch.stack([torch.bincount(row, minlength=5) for row in samples]).to(torch.float32) / num_draws
+    reference = torch.distributions.categorical.Categorical(logits=logits[:, None].expand(-1, num_draws, -1)).sample()
+    reference_frequencies = torch.stack([torch.bincount(row, minlength=5) for row in reference]).to(torch.float32) / num_draws
+    probs = torch.softmax(logits, dim=-1)
+    assert torch.allclose(frequencies, probs, atol=0.015)
+    assert torch.allclose(frequencies, reference_frequencies, atol=0.02)
+    assert torch.all(samples[0] != 4)
+
+
+def test_filter_logits_per_row_parameters_match_scalar_parameters():
+    logits = torch.randn(4, 2, 60)
+    top_k = torch.tensor([0, 5, 20, 0])
+    top_p = torch.tensor([1.0, 1.0, 0.8, 0.5])
+    filtered = filter_logits(logits, top_k, top_p)
+    for row in range(4):
+        expected = filter_logits(logits[row : row + 1], int(top_k[row]), float(top_p[row]))
+        assert torch.equal(filtered[row : row + 1], expected)
+    filtered = filter_logits(logits, top_k)
+    for row in range(4):
+        assert torch.equal(filtered[row : row + 1], filter_logits(logits[row : row + 1], int(top_k[row])))
@@ -2,6 +2,7 @@
 
 import pdb
 
+import pytest
 import torch
 
 from polygen.modules.vertex_model import VertexModel, ImageToVertexModel
@@ -51,6 +52,9 @@ def test_vertex_model_sample():
 
     context = {"class_label": torch.randint(low=0, high=10, size=[4])}
     samples = vertex_model.sample(num_samples=4, context=context)
+    for stop_check_interval in [0, -1]:
+        with pytest.raises(ValueError):
+            vertex_model.sample(num_samples=4, context=context, stop_check_interval=stop_check_interval)
 
 
 def test_img_vertex_model_forward():
@@ -91,3 +95,80 @@ def test_img_vertex_model_sample():
     )
     vertex_model_batch = {"image": torch.rand(size=[4, 3, 224, 224])}
     samples = img_vertex_model.sample(context=vertex_model_batch, num_samples=4)
+
+
+def test_vertex_model_incremental_embedding():
+    decoder_config = {
+        "hidden_size": 128,
+        "fc_size": 256,
+        "num_heads": 4,
+        "layer_norm": True,
+        "num_layers": 2,
+    }
+    vertex_model = VertexModel(
+        decoder_config=decoder_config,
+        quantization_bits=8,
+        class_conditional=True,
+        num_classes=10,
+        max_num_input_verts=100,
+        use_discrete_embeddings=True,
+    )
+    vertices = torch.randint(low=0, high=257, size=[4, 20])
+    global_context = vertex_model._embed_class_label(torch.randint(low=0, high=10, size=[4]))
+    for seq_length in [0, 1, 5, 20]:
+        full_embeddings = vertex_model._embed_inputs(vertices[:, :seq_length], global_context)
+        next_embedding = vertex_model._embed_next_input(vertices[:, :seq_length], global_context)
+        assert torch.equal(full_embeddings[-1:], next_embedding)
+
+
+def test_vertex_model_sample_per_row_parameters():
+    decoder_config = {
+        "hidden_size": 128,
+        "fc_size": 256,
+        "num_heads": 4,
+        "layer_norm": True,
+        "num_layers": 2,
+    }
+    vertex_model = VertexModel(
+        decoder_config=decoder_config,
+        quantization_bits=8,
+        class_conditional=True,
+        num_classes=10,
+        max_num_input_verts=100,
+        use_discrete_embeddings=True,
+    )
+    context = {"class_label": torch.randint(low=0, high=10, size=[4])}
+    samples = vertex_model.sample(
+        num_samples=4,
+        context=context,
+        max_sample_length=20,
+        temperature=torch.tensor([1.0, 0.5, 1.0, 2.0]),
+        top_k=torch.tensor([0, 10, 0, 50]),
+        top_p=torch.tensor([1.0, 1.0, 0.9, 0.5]),
+    )
+    assert samples["vertices"].shape == (4, 20, 3)
+
+
+def test_img_vertex_model_cached_features():
+    decoder_config = {
+        "hidden_size": 256,
+        "fc_size": 256,
+        "num_heads": 4,
+        "layer_norm": True,
+        "num_layers": 2,
+    }
+    img_vertex_model = ImageToVertexModel(
+        decoder_config=decoder_config,
+        quantization_bits=8,
+        use_discrete_embeddings=True,
+        max_num_input_verts=100,
+    )
+    # The frozen resnet stays in eval mode, so features cached once match the features of every training step
+    img_vertex_model.train()
+    assert not img_vertex_model.res_net.training
+    image = torch.rand(size=[4, 3, 224, 224])
+    with torch.no_grad():
+        image_features = img_vertex_model.res_net(image - 0.5)
+        _, expected_embeddings = img_vertex_model._prepare_context({"image": image})
+        _, embeddings = img_vertex_model._prepare_context({"image_features": image_features.to(torch.float16)})
+    assert torch.allclose(embeddings, expected_embeddings, atol=1e-2)
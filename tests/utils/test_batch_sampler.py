@@ -0,0 +1,77 @@
+"""Tests to ensure that the token budget batch sampler covers the dataset within budget and splits it across ranks"""
+import os
+
+import numpy as np
+import torch
+
+from polygen.modules.data_modules import CollateMethod, PolygenDataModule
+from polygen.utils.batch_sampler import TokenBudgetBatchSampler
+from polygen.utils.manifest import build_manifest, padding_efficiency
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+LENGTHS = np.random.default_rng(0).lognormal(mean=5, sigma=0.8, size=1000).astype(np.int64) + 1
+
+
+def test_batches_cover_dataset_within_budget():
+    sampler = TokenBudgetBatchSampler(LENGTHS, max_tokens=4000, bucket_size=256)
+    batches = list(sampler)
+    assert sorted(idx for batch in batches for idx in batch) == list(range(len(LENGTHS)))
+    for batch in batches:
+        assert len(batch) * LENGTHS[batch].max() <= 4000 or len(batch) == 1
+    # Sorting by length pads less than random batches of the same average size
+    batch_size = round(len(LENGTHS) / len(batches))
+    assert sampler.padding_ratio < 1 - padding_efficiency(LENGTHS, batch_size)
+    # Every epoch is planned from its own seed
+    assert list(sampler) != batches
+    sampler.set_epoch(0)
+    assert list(sampler) == batches
+
+
+def test_len_matches_batches_of_the_epoch_being_iterated():
+    sampler = TokenBudgetBatchSampler(LENGTHS, max_tokens=4000, bucket_size=256)
+    num_batches = set()
+    for _ in range(5):
+        padding_ratio, batches = None, []
+        for batch in sampler:
+            # Like a progress bar, ask for the length and padding while the epoch is iterated
+            if padding_ratio is None:
+                num_batches_during_epoch, padding_ratio = len(sampler), sampler.padding_ratio
+            batches.append(batch)
+        assert num_batches_during_epoch == len(batches) == len(sampler)
+        assert padding_ratio == sampler.padding_ratio
+        num_batches.add(len(batches))
+    # The number of batches changes between epochs, which the check above has to see
+    assert len(num_batches) > 1
+
+
+def test_batches_split_across_ranks():
+    rank_batches = [
+        list(TokenBudgetBatchSampler(LENGTHS, max_tokens=3000, max_batch_size=16, num_replicas=3, rank=rank))
+        for rank in range(3)
+    ]
+    assert len(set(len(batches) for batches in rank_batches)) == 1
+    indices = [idx for batches in rank_batches for batch in batches for idx in batch]
+    assert set(indices) == set(range(len(LENGTHS)))
+    assert all(len(batch) <= 16 for batches in rank_batches for batch in batches)
+
+
+def test_data_module_batches_by_tokens(tmp_path):
+    data_dir = os.path.join(REPO_DIR, "image_meshes")
+    manifest_path = str(tmp_path / "manifest.npz")
+    build_manifest(data_dir, num_workers=1).save(manifest_path)
+    data_module = PolygenDataModule(
+        data_dir=data_dir,
+        collate_method=CollateMethod.VERTICES,
+        batch_size=4,
+        training_split=1.0,
+        val_split=0.0,
+        manifest_path=manifest_path,
+        max_tokens_per_batch=400,
+    )
+    data_module.setup()
+    num_meshes = 0
+    for batch in data_module.train_dataloader():
+        assert batch["vertices_flat"].numel() <= 400 or len(batch["vertices_flat"]) == 1
+        num_meshes += len(batch["vertices_flat"])
+        assert torch.all(batch["vertices_flat_mask"].sum(dim=-1) % 3 == 1)
+    assert num_meshes == len(data_module.shapenet_dataset)
@@ -0,0 +1,223 @@
+"""Tests to ensure that the vectorized .obj parsing and mesh processing give the same outputs as the original implementations"""
+import glob
+import io
+import os
+import random
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pytest
+import torch
+
+nx = pytest.importorskip("networkx", minversion="3.0")
+
+from polygen.utils.data_utils import (
+    _cycle_basis,
+    argmin,
+    center_vertices,
+    normalize_vertices_scale,
+    quantize_process_mesh,
+    quantize_verts,
+    read_obj,
+    read_obj_bytes,
+    read_obj_fast,
+    read_obj_file,
+    torch_lexsort,
+)
+
+random.seed(10)
+torch.manual_seed(10)
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+MESH_FILES = sorted(
+    glob.glob(os.path.join(REPO_DIR, "meshes", "*.obj"))
+    + glob.glob(os.path.join(REPO_DIR, "image_meshes", "*", "*", "models", "model_normalized.obj"))
+)
+
+
+def face_to_cycles(faces: List[int]) -> List[int]:
+    """Find cycles in faces list
+
+    Args:
+        faces: List of vertex indices representing connectivity
+
+    Returns:
+        cycle_basis: All cycles in faces graph
+    """
+    g = nx.Graph()
+
+    for v in range(len(faces) - 1):
+        g.add_edge(faces[v], faces[v + 1])
+    g.add_edge(faces[-1], faces[0])
+    return list(nx.cycle_basis(g))
+
+
+def quantize_process_mesh_reference(
+    vertices: torch.Tensor,
+    faces: List[List[int]],
+    tris: Optional[List[int]] = None,
+    quantization_bits: int = 8,
+) -> Tuple[torch.Tensor, List[List[int]], Optional[torch.Tensor]]:
+    """Quantize vertices, remove resulting duplicates and reindex faces, one face at a time with networkx.
+
+    This is the original implementation of quantize_process_mesh, the oracle of the vectorized version.
+
+    Args:
+        vertices: torch tensor of shape (num_vertices, 3)
+        faces: Unflattened faces
+        tris: List of triangles
+        quantization_bits: number of quantization bits
+
+    Returns:
+        vertices: processed vertices
+        faces: processed faces
+        triangles: list of triangles in 3D object
+    """
+    vertices = quantize_verts(vertices, quantization_bits)
+    vertices, inv = torch.unique(vertices, dim=0, return_inverse=True)
+
+    # Sort vertices by z then y then x
+    sort_inds = torch_lexsort(vertices.T)
+    vertices = vertices[sort_inds]
+
+    # Re-index faces and tris to re-ordered vertices
+    faces = [torch.argsort(sort_inds)[inv[f]] for f in faces]
+    if tris is not None:
+        tris = torch.Tensor([torch.argsort(sort_inds)[inv[t]] for t in tris])
+
+    # Merging duplicate vertices and re-indexing the faces causes some faces to
+    # contain loops (e.g. [2, 3, 5, 2, 4]). Split these faces into distinct
+    # sub-faces.
+
+    sub_faces = []
+    for f in faces:
+        cliques = face_to_cycles(f.tolist())
+        for c in cliques:
+            c_length = len(c)
+            # Only append faces with more than two verts
+            if c_length > 2:
+                d = argmin(c)
+                # Cyclically permute faces so that the first index is the smallest
+                sub_faces.append([c[(d + i) % c_length] for i in range(c_length)])
+
+    faces = sub_faces
+    if tris is not None:
+        tris = torch.Tensor([v for v in tris if len(set(v)) == len(v)])
+
+    # Sort faces by lowest vertex indices. If two faces have the same lowest
+    # index then sort by next lowest and so on.
+    faces.sort(key=lambda f: tuple(sorted(f)))
+    faces = [torch.Tensor(f).to(torch.int64) for f in faces]
+    if tris is not None:
+        tris = tris.tolist()
+        tris.sort(key=lambda f: tuple(sorted(f)))
+        tris = torch.Tensor(tris)
+
+    # After removing degenerate faces some vertices are now unreferenced
+    # Remove these
+    num_verts = vertices.shape[0]
+    vert_connected = torch.eq(torch.arange(num_verts)[:, None], torch.hstack(faces)[None]).any(dim=-1)
+    vertices = vertices[vert_connected]
+
+    # Re-index faces and tris to re-ordered vertices.
+    vert_indices = torch.arange(num_verts) - torch.cumsum((1 - vert_connected.to(torch.int32)), dim=-1)
+    faces = [vert_indices[f].tolist() for f in faces]
+    if tris is not None:
+        tris = torch.Tensor([vert_indices[t].tolist() for t in tris])
+    return vertices, faces, tris
+
+
+def load_mesh(mesh_file: str):
+    vertices, faces = read_obj(mesh_file)
+    vertices = torch.from_numpy(vertices)[:, [2, 0, 1]]
+    vertices = normalize_vertices_scale(center_vertices(vertices))
+    return vertices, faces
+
+
+def assert_same_outputs(vertices, faces, quantization_bits):
+    expected_vertices, expected_faces, _ = quantize_process_mesh_reference(
+        vertices, faces, quantization_bits=quantization_bits
+    )
+    # The triangles of the reference cannot be converted to a tensor, so they are compared with its faces instead
+    tris = faces if all(len(f) == 3 for f in faces) else None
+    processed_vertices, processed_faces, processed_tris = quantize_process_mesh(
+        vertices, faces, tris=tris, quantization_bits=quantization_bits
+    )
+    assert processed_vertices.dtype == expected_vertices.dtype
+    assert torch.equal(processed_vertices, expected_vertices)
+    assert processed_faces == expected_faces
+    if tris is not None:
+        # Non-degenerate triangles are the faces, which keep their orientation instead of being reversed
+        assert processed_tris.dtype == torch.float32
+        assert [sorted(t) for t in processed_tris.to(torch.int64).tolist()] == [sorted(f) for f in expected_faces]
+
+
+@pytest.mark.parametrize("mesh_file", MESH_FILES, ids=lambda f: os.path.relpath(f, REPO_DIR))
+@pytest.mark.parametrize("quantization_bits", [8, 4, 2])
+def test_quantize_process_mesh_matches_reference(mesh_file, quantization_bits):
+    # Fewer quantization bits merge more vertices, which creates faces with loops and degenerate faces
+    vertices, faces = load_mesh(mesh_file)
+    assert_same_outputs(vertices, faces, quantization_bits)
+
+
+def test_quantize_process_mesh_matches_reference_on_faces_with_loops():
+    for _ in range(20):
+        num_vertices = random.randint(3, 30)
+        vertices = torch.rand(size=[num_vertices, 3]) - 0.5
+        faces = [random.choices(range(num_vertices), k=random.randint(1, 12)) for _ in range(random.randint(1, 40))]
+        faces += faces[: len(faces) // 4]  # Identical faces keep their relative order
+        assert_same_outputs(vertices, faces, quantization_bits=random.choice([2, 3, 8]))
+
+
+def test_quantize_process_mesh_matches_reference_on_triangles():
+    for _ in range(20):
+        num_vertices = random.randint(3, 30)
+        # The corners of the first triangle never merge, so that some triangle is left after merging vertices
+        corners = torch.tensor([[-0.5, -0.5, -0.5], [0.5, -0.5, 0.5], [-0.5, 0.5, 0.5]])
+        vertices = torch.cat([corners, torch.rand(size=[num_vertices, 3]) - 0.5])
+        faces = [[0, 1, 2]] + [random.sample(range(num_vertices + 3), k=3) for _ in range(random.randint(1, 40))]
+        assert_same_outputs(vertices, faces, quantization_bits=random.choice([2, 3, 8]))
+
+
+def test_quantize_process_mesh_sorts_long_faces():
+    vertices = torch.rand(size=[200, 3]) - 0.5
+    faces = [list(range(0, 100)), list(range(100, 200)), [0, 1, 2], list(range(100, 180))]
+    assert_same_outputs(vertices, faces, quantization_bits=8)
+
+
+def test_cycle_basis_matches_networkx():
+    for _ in range(1000):
+        face = random.choices(range(8), k=random.randint(1, 10))
+        assert _cycle_basis(face) == face_to_cycles(face)
+
+
+def assert_same_obj(obj_vertices, obj_faces, expected_vertices, expected_faces):
+    assert obj_vertices.dtype == expected_vertices.dtype
+    assert obj_vertices.shape == expected_vertices.shape
+    assert np.array_equal(obj_vertices, expected_vertices, equal_nan=True)
+    assert obj_faces == expected_faces
+
+
+@pytest.mark.parametrize("mesh_file", MESH_FILES, ids=lambda f: os.path.relpath(f, REPO_DIR))
+def test_read_obj_fast_matches_read_obj(mesh_file):
+    assert_same_obj(*read_obj_fast(mesh_file), *read_obj(mesh_file))
+
+
+@pytest.mark.parametrize(
+    "obj_data",
+    [
+        "v 1 2 3\nv 4 5 6\nv 7 8 9\nvt 0 1\nvn 0 0 1\nf 1/2/3 2/3/1 3/1/2\nf 1/2/3 3/1/2 2/2/2\n",
+        "v 1 2 3\r\nv 4 5 6\r\n v\t7 8 9\r\nf 1//2 2//3 3//1\r\n# comment\r\nf\r\n",
+        "v 1 2 3\nv 4 5 6\nv 7 8 9\nf 1/2 2/3 3/1\ng group\ns off\nf 1/2 3/1 2/2\n",
+        "v 1.5e2 -0 +3\nv nan inf 1\nv 1 2 3\nf 1 2 3 1\nf 01 2 3\n",
+        "v 1 2 3\nv 4 5 6\nv 7 8 9\nv 0 0 0\nf -1 -2 -3\n",
+        "v 1 2 3\nf 1 1 1\nv 4 5 6\nv 7 8 9\nf 1 2 3\n",
+        "v 1 2 3 1\nv 4 5 6\nv 7 8 9\nf 2 3 2\n",
+        "v 1 2 3\nv 4 5 6\nv 7 8 9\nf 3 2 1\nf 1 2\n\n",
+        "# no records\n",
+        "",
+    ],
+)
+def test_read_obj_bytes_matches_read_obj_file(obj_data):
+    # Covers the v/vt/vn index forms, and files that fall back to read_obj_file
+    assert_same_obj(*read_obj_bytes(obj_data.encode()), *read_obj_file(io.StringIO(obj_data)))
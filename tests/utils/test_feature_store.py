@@ -0,0 +1,81 @@
+"""Tests to ensure that the feature store serves the backbone features of every rendering and is rebuilt when stale"""
+import os
+import shutil
+
+import pytest
+import torch
+import torch.nn as nn
+from PIL import Image
+
+from polygen.modules.data_modules import CollateMethod, ImageDataset, PolygenDataModule, ShapenetDataset
+from polygen.utils.feature_store import FeatureStore, backbone_hash, extract_features, open_feature_store
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    """Copy of image_meshes with two random renderings of every mesh"""
+    data_dir = str(tmp_path / "data")
+    shutil.copytree(os.path.join(REPO_DIR, "image_meshes"), data_dir)
+    generator = torch.Generator().manual_seed(0)
+    for mesh_file in ShapenetDataset(data_dir).all_files:
+        renderings_dir = os.path.join(os.path.dirname(os.path.dirname(mesh_file)), "renderings")
+        os.makedirs(renderings_dir)
+        for i in range(2):
+            pixels = torch.randint(0, 256, size=[16, 16, 3], dtype=torch.uint8, generator=generator)
+            Image.fromarray(pixels.numpy()).save(os.path.join(renderings_dir, f"{i}.png"))
+    return data_dir
+
+
+def make_backbone():
+    """Small stand-in for the frozen resnet, with batch norm statistics that eval mode has to use"""
+    torch.manual_seed(0)
+    return nn.Sequential(nn.Conv2d(3, 8, kernel_size=16, stride=16), nn.BatchNorm2d(8), nn.ReLU())
+
+
+def test_dataset_serves_cached_features(data_dir, tmp_path):
+    backbone = make_backbone()
+    store_dir = str(tmp_path / "features")
+    dataset = ImageDataset(data_dir, image_extension="png", feature_store_dir=store_dir, feature_backbone=backbone)
+    image_dataset = ImageDataset(data_dir, image_extension="png")
+    assert sorted(dataset.feature_store.image_files) == sorted(image_dataset.images)
+    backbone.eval()
+    for idx in range(len(dataset)):
+        element = dataset[idx]
+        assert "image" not in element and element["image_features"].dtype == torch.float16
+        expected_features = extract_features(backbone, image_dataset.load_image(dataset.images[idx])[None])[0]
+        assert torch.allclose(element["image_features"].float(), expected_features, atol=1e-2, rtol=1e-2)
+
+    # A store opened without a backbone is trusted as it is
+    data_module = PolygenDataModule(
+        data_dir,
+        collate_method=CollateMethod.IMAGES,
+        batch_size=4,
+        use_image_dataset=True,
+        img_extension="png",
+        feature_store_dir=store_dir,
+    )
+    batch = data_module.collate_fn([data_module.shapenet_dataset[idx] for idx in range(4)])
+    assert "image" not in batch and batch["image_features"].shape == (4, 8, 16, 16)
+
+
+def test_feature_store_is_rebuilt_when_stale(data_dir, tmp_path):
+    backbone = make_backbone()
+    store_dir = str(tmp_path / "features")
+    image_files = sorted(ImageDataset(data_dir, image_extension="png").images)
+    load_image = ImageDataset(data_dir).load_image
+    feature_store = open_feature_store(store_dir, image_files[:4], backbone, load_image)
+    assert feature_store.image_files == image_files[:4]
+    assert open_feature_store(store_dir, image_files[:2], backbone, load_image).image_files == image_files[:4]
+
+    # Missing renderings and changed weights rebuild the store
+    feature_store = open_feature_store(store_dir, image_files, backbone, load_image)
+    assert feature_store.image_files == image_files
+    features = feature_store[0]
+    with torch.no_grad():
+        backbone[1].running_mean += 1.0
+    feature_store = open_feature_store(store_dir, image_files, backbone, load_image)
+    assert feature_store.backbone_hash == backbone_hash(backbone)
+    assert not torch.equal(feature_store[0], features)
+    assert FeatureStore(store_dir).backbone_hash == backbone_hash(backbone)
@@ -0,0 +1,80 @@
+"""Tests to ensure that the image store and the fast decoding path serve the same images as decoding full renderings"""
+import os
+import shutil
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+from polygen.modules.data_modules import CollateMethod, ImageDataset, PolygenDataModule, ShapenetDataset
+from polygen.utils.image_store import ImageStore, build_image_store, load_image_uint8, main
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def write_rendering(image_file, size, seed):
+    """Writes a smooth rendering, a color gradient like the shading of a rendered model"""
+    rng = np.random.default_rng(seed)
+    x, y = np.meshgrid(np.linspace(0, 1, size), np.linspace(0, 1, size))
+    pixels = np.stack([x, y, x * y], axis=-1) * rng.uniform(0.5, 1.0, size=3) * 255
+    Image.fromarray(pixels.astype(np.uint8)).save(image_file)
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    """Copy of image_meshes with two 512 x 512 .jpeg renderings of every mesh"""
+    data_dir = str(tmp_path / "data")
+    shutil.copytree(os.path.join(REPO_DIR, "image_meshes"), data_dir)
+    for i, mesh_file in enumerate(ShapenetDataset(data_dir).all_files):
+        renderings_dir = os.path.join(os.path.dirname(os.path.dirname(mesh_file)), "renderings")
+        os.makedirs(renderings_dir)
+        for j in range(2):
+            write_rendering(os.path.join(renderings_dir, f"{j}.jpeg"), 512, seed=2 * i + j)
+    return data_dir
+
+
+@pytest.mark.parametrize("extension", ["jpeg", "png"])
+def test_fast_decoding_matches_full_decoding(extension, tmp_path):
+    image_file = str(tmp_path / f"rendering.{extension}")
+    write_rendering(image_file, 512, seed=0)
+    image = load_image_uint8(image_file)
+    assert image.dtype == torch.uint8 and image.shape == (3, 256, 256)
+    expected_image = ImageDataset(str(tmp_path), fast_decode=False).load_image(image_file)
+    fast_image = ImageDataset(str(tmp_path)).load_image(image_file)
+    assert fast_image.shape == expected_image.shape
+    assert (fast_image - expected_image).abs().mean() < 0.01
+
+
+def test_dataset_serves_images_from_store(data_dir, tmp_path):
+    store_dir = str(tmp_path / "images")
+    main(["--data-dir", data_dir, "--store-dir", store_dir, "--num-workers", "2"])
+    image_store = ImageStore(store_dir)
+    assert len(image_store) == 8 and image_store.images.shape == (8, 3, 256, 256)
+    dataset = ImageDataset(data_dir)
+    stored_dataset = ImageDataset(data_dir, image_store_dir=store_dir)
+    compact_dataset = ImageDataset(data_dir, image_store_dir=store_dir, compact_dtypes=True)
+    for idx in range(len(dataset)):
+        image = stored_dataset[idx]["image"]
+        assert image.dtype == torch.float32
+        assert torch.equal(image, dataset[idx]["image"])
+        assert torch.equal(compact_dataset[idx]["image"], load_image_uint8(dataset.images[idx]))
+
+    # Compact image batches stay uint8
+    data_module = PolygenDataModule(
+        data_dir,
+        collate_method=CollateMethod.IMAGES,
+        batch_size=4,
+        use_image_dataset=True,
+        image_store_dir=store_dir,
+        compact_dtypes=True,
+    )
+    batch = data_module.collate_fn([data_module.shapenet_dataset[idx] for idx in range(4)])
+    assert batch["image"].dtype == torch.uint8 and batch["image"].shape == (4, 3, 256, 256)
+
+
+def test_image_store_needs_one_shape(data_dir, tmp_path):
+    image_files = sorted(ImageDataset(data_dir).images)
+    Image.new("RGB", (512, 1024)).save(image_files[-1])
+    with pytest.raises(ValueError):
+        build_image_store(image_files, str(tmp_path / "images"), num_workers=1)
@@ -0,0 +1,122 @@
+"""Tests to ensure that the preprocessing cache only reprocesses changed files and serves the same meshes"""
+import os
+import shutil
+
+import pytest
+import torch
+from PIL import Image
+
+import polygen.utils.mesh_cache as mesh_cache
+from polygen.modules.data_modules import ImageDataset, ShapenetDataset
+from polygen.utils.mesh_cache import MeshCache, MeshLRU, main
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def test_mesh_cache_updates_incrementally(tmp_path):
+    data_dir = str(tmp_path / "data")
+    cache_dir = str(tmp_path / "cache")
+    shutil.copytree(os.path.join(REPO_DIR, "image_meshes"), data_dir)
+    mesh_files = sorted(ShapenetDataset(data_dir).all_files)
+    cache = MeshCache(cache_dir)
+    assert cache.update(mesh_files, num_workers=2) == {"processed": 4, "reused": 0, "failed": 0, "evicted": 0}
+    assert cache.update(mesh_files, num_workers=2) == {"processed": 0, "reused": 4, "failed": 0, "evicted": 0}
+
+    # Changing a file replaces its entry, removing a file evicts its entry
+    with open(mesh_files[0], "a") as obj_file:
+        obj_file.write("# changed\n")
+    os.remove(mesh_files[1])
+    main(["--data-dir", data_dir, "--cache-dir", cache_dir, "--num-workers", "1"])
+    cache = MeshCache(cache_dir)
+    assert len(cache.entries()) == 3
+    assert cache.update(mesh_files[:1] + mesh_files[2:]) == {"processed": 0, "reused": 3, "failed": 0, "evicted": 0}
+
+
+def test_mesh_cache_update_does_not_rehash_unchanged_files(tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / "cache")
+    mesh_files = sorted(ShapenetDataset(os.path.join(REPO_DIR, "image_meshes")).all_files)
+    MeshCache(cache_dir).update(mesh_files, num_workers=1)
+    hashed_files = []
+    content_hash = mesh_cache.content_hash
+
+    def counting_content_hash(mesh_file, quantization_bits):
+        hashed_files.append(mesh_file)
+        return content_hash(mesh_file, quantization_bits)
+
+    monkeypatch.setattr(mesh_cache, "content_hash", counting_content_hash)
+    stats = MeshCache(cache_dir).update(mesh_files, num_workers=1)
+    assert stats == {"processed": 0, "reused": 4, "failed": 0, "evicted": 0}
+    assert hashed_files == []
+    # Files left out of an update are dropped from the index
+    MeshCache(cache_dir).update(mesh_files[:2], num_workers=1)
+    assert sorted(MeshCache(cache_dir).index) == sorted(os.path.abspath(f) for f in mesh_files[:2])
+    assert hashed_files == []
+
+
+def test_mesh_cache_updates_quantization_bits_independently(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    mesh_files = sorted(ShapenetDataset(os.path.join(REPO_DIR, "image_meshes")).all_files)
+    cache_6, cache_8 = MeshCache(cache_dir, quantization_bits=6), MeshCache(cache_dir, quantization_bits=8)
+    assert cache_6.update(mesh_files, num_workers=1)["processed"] == 4
+    assert cache_8.update(mesh_files[:2], num_workers=1)["processed"] == 2
+    # Updating with fewer files only evicts entries of the same quantization bits
+    assert cache_8.update(mesh_files[:1], num_workers=1)["evicted"] == 1
+    assert len(cache_6.entries()) == 4
+    assert MeshCache(cache_dir, quantization_bits=6).update(mesh_files) == {
+        "processed": 0,
+        "reused": 4,
+        "failed": 0,
+        "evicted": 0,
+    }
+
+
+def test_shapenet_dataset_reads_from_mesh_cache(tmp_path):
+    data_dir = os.path.join(REPO_DIR, "image_meshes")
+    dataset = ShapenetDataset(data_dir)
+    # Files missing from the cache are added on the fly
+    cached_dataset = ShapenetDataset(data_dir, mesh_cache_dir=str(tmp_path / "cache"))
+    for _ in range(2):
+        for idx in range(len(dataset)):
+            expected, mesh = dataset[idx], cached_dataset[idx]
+            assert mesh["class_label"] == expected["class_label"]
+            for key in ["vertices", "faces"]:
+                assert mesh[key].dtype == expected[key].dtype
+                assert torch.equal(mesh[key], expected[key])
+    assert len(cached_dataset.mesh_cache.entries()) == len(dataset)
+
+
+def test_mesh_lru_evicts_least_recently_used():
+    lru = MeshLRU(max_meshes=2)
+    loads = []
+
+    def load(key):
+        loads.append(key)
+        return torch.zeros([1, 3]), torch.zeros([1])
+
+    for key in ["a", "b", "a", "c", "a", "b"]:
+        lru.get(key, lambda: load(key))
+    # "b" was evicted by "c", as "a" was used more recently
+    assert loads == ["a", "b", "c", "b"]
+    assert lru.stats() == {"hits": 2, "misses": 4, "meshes": 2, "hit_rate": 2 / 6}
+    with pytest.raises(ValueError):
+        MeshLRU(max_meshes=0)
+
+
+@pytest.mark.parametrize("mesh_cache", [False, True])
+def test_image_dataset_processes_meshes_once_per_model(mesh_cache, tmp_path):
+    data_dir = str(tmp_path / "data")
+    shutil.copytree(os.path.join(REPO_DIR, "image_meshes"), data_dir)
+    for mesh_file in ShapenetDataset(data_dir).all_files:
+        renderings_dir = os.path.join(os.path.dirname(os.path.dirname(mesh_file)), "renderings")
+        os.makedirs(renderings_dir)
+        for i in range(3):
+            Image.new("RGB", (16, 16)).save(os.path.join(renderings_dir, f"{i}.jpeg"))
+    mesh_cache_dir = str(tmp_path / "cache") if mesh_cache else None
+    dataset = ImageDataset(data_dir)
+    cached_dataset = ImageDataset(data_dir, mesh_cache_dir=mesh_cache_dir, max_cached_meshes=4)
+    for idx in range(len(dataset)):
+        expected, element = dataset[idx], cached_dataset[idx]
+        for key in ["vertices", "faces"]:
+            assert element[key].dtype == expected[key].dtype
+            assert torch.equal(element[key], expected[key])
+    assert cached_dataset.mesh_lru.stats() == {"hits": 8, "misses": 4, "meshes": 4, "hit_rate": 8 / 12}
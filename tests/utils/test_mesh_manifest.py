@@ -0,0 +1,74 @@
+"""Tests to ensure that a manifest lists the same meshes as globbing and measures them correctly"""
+import os
+import shutil
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from polygen.modules.data_modules import ImageDataset, ShapenetDataset
+from polygen.utils.manifest import Manifest, build_manifest, main, padding_efficiency
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    """Copy of image_meshes with two renderings of every mesh"""
+    data_dir = str(tmp_path / "data")
+    shutil.copytree(os.path.join(REPO_DIR, "image_meshes"), data_dir)
+    for mesh_file in ShapenetDataset(data_dir).all_files:
+        renderings_dir = os.path.join(os.path.dirname(os.path.dirname(mesh_file)), "renderings")
+        os.makedirs(renderings_dir)
+        for i in range(2):
+            Image.new("RGB", (16, 16)).save(os.path.join(renderings_dir, f"{i}.jpeg"))
+    return data_dir
+
+
+def test_manifest_matches_dataset(data_dir, tmp_path):
+    manifest_path = str(tmp_path / "manifest.npz")
+    main(["build", "--data-dir", data_dir, "--manifest", manifest_path, "--num-workers", "2"])
+    manifest = Manifest.load(manifest_path)
+    dataset = ShapenetDataset(data_dir)
+    assert manifest.mesh_files == sorted(dataset.all_files)
+    for i, mesh_file in enumerate(manifest.mesh_files):
+        mesh = dataset[dataset.all_files.index(mesh_file)]
+        assert manifest.class_labels[i] == mesh["class_label"]
+        assert manifest.num_vertices[i] == len(mesh["vertices"])
+        assert manifest.face_lengths[i] == len(mesh["faces"])
+        assert manifest.num_faces[i] == (mesh["faces"] < 2).sum()
+    assert len(manifest.image_files) == 2 * len(manifest)
+
+    # Datasets built from the manifest serve the same meshes in the manifest order
+    manifest_dataset = ShapenetDataset(data_dir, manifest_path=manifest_path)
+    assert manifest_dataset.all_files == manifest.mesh_files
+    assert manifest_dataset[0]["class_label"] == dataset[dataset.all_files.index(manifest.mesh_files[0])]["class_label"]
+    image_dataset = ImageDataset(data_dir, manifest_path=manifest_path)
+    assert sorted(image_dataset.images) == sorted(ImageDataset(data_dir).images)
+    with pytest.raises(ValueError):
+        ShapenetDataset(data_dir, manifest_path=manifest_path, quantization_bits=6)
+
+
+def test_manifest_filters_by_length(data_dir, tmp_path):
+    manifest_path = str(tmp_path / "manifest.npz")
+    manifest = build_manifest(data_dir, num_workers=1)
+    manifest.save(manifest_path)
+    max_num_vertices = int(np.median(manifest.num_vertices))
+    max_face_length = int(np.median(manifest.face_lengths))
+
+    dataset = ShapenetDataset(data_dir, manifest_path=manifest_path, max_num_input_verts=max_num_vertices)
+    assert 0 < len(dataset) < len(manifest)
+    assert all(len(dataset[idx]["vertices"]) <= max_num_vertices for idx in range(len(dataset)))
+    dataset = ShapenetDataset(data_dir, manifest_path=manifest_path, max_seq_length=max_face_length)
+    assert all(len(dataset[idx]["faces"]) <= max_face_length for idx in range(len(dataset)))
+    image_dataset = ImageDataset(data_dir, manifest_path=manifest_path, max_num_input_verts=max_num_vertices)
+    assert len(image_dataset) == 2 * len(manifest.select(max_num_vertices))
+    assert np.all(image_dataset.num_vertices <= max_num_vertices)
+    with pytest.raises(ValueError):
+        ShapenetDataset(data_dir, max_num_input_verts=max_num_vertices)
+
+
+def test_padding_efficiency():
+    assert padding_efficiency(np.full(10, 7), batch_size=4) == 1.0
+    # One long sequence pads its batch
+    assert padding_efficiency(np.array([1, 1, 1, 1, 1, 1, 1, 9]), batch_size=8) == pytest.approx(16 / 72)
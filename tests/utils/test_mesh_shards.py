@@ -0,0 +1,89 @@
+"""Tests to ensure that streamed shards serve every mesh and split them evenly across ranks and workers"""
+import os
+import shutil
+
+import pytest
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader
+
+from polygen.modules.data_modules import CollateMethod, MeshShardDataset, PolygenDataModule, ShapenetDataset
+from polygen.utils.mesh_shards import load_shard_index, main
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    """Copy of image_meshes with two renderings of every mesh"""
+    data_dir = str(tmp_path / "data")
+    shutil.copytree(os.path.join(REPO_DIR, "image_meshes"), data_dir)
+    for mesh_file in ShapenetDataset(data_dir).all_files:
+        renderings_dir = os.path.join(os.path.dirname(os.path.dirname(mesh_file)), "renderings")
+        os.makedirs(renderings_dir)
+        for i in range(2):
+            Image.new("RGB", (16, 16), color=(64 * i, 0, 0)).save(os.path.join(renderings_dir, f"{i}.jpeg"))
+    return data_dir
+
+
+def test_shards_hold_every_mesh(data_dir, tmp_path):
+    shard_dir = str(tmp_path / "shards")
+    main(["--data-dir", data_dir, "--shard-dir", shard_dir, "--samples-per-shard", "3", "--num-workers", "2"])
+    index = load_shard_index(shard_dir)
+    assert [shard["num_samples"] for shard in index["shards"]] == [3, 1]
+    dataset = ShapenetDataset(data_dir)
+    mesh_files = sorted(dataset.all_files)
+    elements = list(MeshShardDataset(index["shards"], shuffle=False))
+    assert sorted(element["index"] for element in elements) == list(range(len(mesh_files)))
+    for element in elements:
+        expected = dataset[dataset.all_files.index(mesh_files[element["index"]])]
+        assert element["class_label"] == expected["class_label"]
+        for key in ["vertices", "faces"]:
+            assert element[key].dtype == expected[key].dtype
+            assert torch.equal(element[key], expected[key])
+
+
+def test_shards_split_across_ranks_and_workers(data_dir, tmp_path):
+    shard_dir = str(tmp_path / "shards")
+    main(["--data-dir", data_dir, "--shard-dir", shard_dir, "--samples-per-shard", "1", "--images"])
+    shards = load_shard_index(shard_dir)["shards"]
+    assert len(shards) == 8
+    for num_replicas in [1, 3]:
+        indices = []
+        for rank in range(num_replicas):
+            dataset = MeshShardDataset(shards, shuffle_buffer_size=4, num_replicas=num_replicas, rank=rank)
+            for num_workers in [1, 2, 5]:
+                num_samples = sum(dataset.worker_shards(0, worker_id, num_workers)[1] for worker_id in range(5))
+                assert num_samples == len(dataset)
+            dataloader = DataLoader(dataset, batch_size=2, num_workers=2, collate_fn=lambda ds: ds)
+            epochs = [[element["index"] for batch in dataloader for element in batch] for _ in range(2)]
+            # Every epoch yields the same samples of the rank in another order
+            assert len(epochs[0]) == len(dataset) == -(-len(shards) // num_replicas)
+            assert epochs[0] != epochs[1]
+            indices.extend(epochs[0])
+        assert set(indices) == set(range(len(shards)))
+
+
+def test_data_module_streams_shards(data_dir, tmp_path):
+    shard_dir = str(tmp_path / "shards")
+    main(["--data-dir", data_dir, "--shard-dir", shard_dir, "--samples-per-shard", "2", "--images"])
+    with pytest.raises(ValueError):
+        PolygenDataModule(data_dir, CollateMethod.FACES, batch_size=2, shard_dir=shard_dir, quantization_bits=6)
+    data_module = PolygenDataModule(
+        data_dir,
+        collate_method=CollateMethod.IMAGES,
+        batch_size=2,
+        use_image_dataset=True,
+        training_split=0.5,
+        val_split=0.25,
+        shard_dir=shard_dir,
+        num_workers=2,
+        compact_dtypes=True,
+    )
+    data_module.setup()
+    assert [len(split) for split in [data_module.train_set, data_module.val_set, data_module.test_set]] == [4, 2, 2]
+    num_samples = 0
+    for batch in data_module.train_dataloader():
+        assert batch["image"].dtype == torch.uint8 and batch["image"].shape[1:] == (3, 256, 256)
+        num_samples += len(batch["image"])
+    assert num_samples == 4
@@ -0,0 +1,49 @@
+"""Tests to ensure that a mesh store serves the same meshes as preprocessing the .obj files"""
+import os
+
+import numpy as np
+import torch
+
+from polygen.modules.data_modules import ShapenetDataset
+from polygen.utils.data_utils import compact_vertex_dtype
+from polygen.utils.mesh_store import MeshStore, build_mesh_store, main, vertex_dtype
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DATA_DIR = os.path.join(REPO_DIR, "image_meshes")
+
+
+def test_mesh_store_matches_shapenet_dataset(tmp_path):
+    store_dir = str(tmp_path / "store")
+    main(["--data-dir", DATA_DIR, "--store-dir", store_dir, "--num-workers", "2"])
+    dataset = ShapenetDataset(DATA_DIR)
+    stored_dataset = ShapenetDataset(DATA_DIR, mesh_store_dir=store_dir)
+    assert sorted(stored_dataset.all_files) == sorted(dataset.all_files)
+    for idx, mesh_file in enumerate(stored_dataset.all_files):
+        expected = dataset[dataset.all_files.index(mesh_file)]
+        mesh = stored_dataset[idx]
+        assert mesh["class_label"] == expected["class_label"]
+        for key in ["vertices", "faces"]:
+            assert mesh[key].dtype == expected[key].dtype
+            assert torch.equal(mesh[key], expected[key])
+
+
+def test_mesh_store_skips_failed_files(tmp_path):
+    mesh_files = [os.path.join(REPO_DIR, "meshes", "cube.obj"), str(tmp_path / "empty.obj")]
+    open(mesh_files[1], "w").close()
+    failed_files = build_mesh_store(mesh_files, [3, 4], str(tmp_path / "store"), num_workers=1)
+    assert failed_files == [mesh_files[1]]
+    store = MeshStore(str(tmp_path / "store"))
+    assert len(store) == 1
+    mesh = store[0]
+    assert mesh["vertices"].dtype == np.uint8
+    assert mesh["class_label"] == 3
+    assert np.array_equal(store.lengths[0], [len(mesh["vertices"]), len(mesh["faces"])])
+    # Memory maps are copy-on-write, in-place changes do not reach the store files
+    mesh["vertices"][:] = 0
+    assert np.any(MeshStore(str(tmp_path / "store"))[0]["vertices"] != 0)
+
+
+def test_store_packs_vertices_like_compact_batches():
+    for quantization_bits in [6, 8, 10, 15, 16]:
+        packed = torch.from_numpy(np.zeros([1, 3], dtype=vertex_dtype(quantization_bits)))
+        assert packed.dtype == compact_vertex_dtype(quantization_bits)
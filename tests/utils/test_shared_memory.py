@@ -0,0 +1,57 @@
+"""Tests to ensure that the shared-memory dataset backing serves the same meshes as loading them from .obj files"""
+import os
+
+import pytest
+import torch
+
+from polygen.modules.data_modules import CollateMethod, PolygenDataModule, ShapenetDataset
+from polygen.utils.shared_memory import StringArray
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DATA_DIR = os.path.join(REPO_DIR, "image_meshes")
+
+
+def test_string_array():
+    strings = ["a/b.obj", "", "ünïcode/ß.obj", "c"]
+    string_array = StringArray(strings)
+    assert len(string_array) == len(strings)
+    assert string_array.tolist() == strings
+    assert string_array[-2] == strings[-2]
+    with pytest.raises(IndexError):
+        string_array[len(strings)]
+
+
+@pytest.mark.parametrize("compact_dtypes", [False, True])
+def test_shared_memory_dataset_matches_dataset(compact_dtypes, tmp_path):
+    dataset = ShapenetDataset(DATA_DIR, compact_dtypes=compact_dtypes)
+    for mesh_cache_dir in [None, str(tmp_path / "cache")]:
+        shared_dataset = ShapenetDataset(
+            DATA_DIR, compact_dtypes=compact_dtypes, mesh_cache_dir=mesh_cache_dir, shared_memory=True
+        )
+        assert isinstance(shared_dataset.all_files, StringArray)
+        assert shared_dataset.shared_meshes.vertices.is_shared()
+        for idx in range(len(dataset)):
+            expected, mesh = dataset[idx], shared_dataset[idx]
+            assert mesh["class_label"] == expected["class_label"]
+            for key in ["vertices", "faces"]:
+                assert mesh[key].dtype == expected[key].dtype
+                assert torch.equal(mesh[key], expected[key])
+
+
+def test_shared_memory_data_module_with_workers():
+    data_module = PolygenDataModule(
+        data_dir=DATA_DIR,
+        collate_method=CollateMethod.FACES,
+        batch_size=2,
+        training_split=1.0,
+        val_split=0.0,
+        num_workers=2,
+        shared_memory=True,
+        persistent_workers=True,
+        prefetch_factor=4,
+    )
+    data_module.setup()
+    train_dataloader = data_module.train_dataloader()
+    assert train_dataloader.persistent_workers and train_dataloader.prefetch_factor == 4
+    for _ in range(2):
+        assert sum(len(batch["faces"]) for batch in train_dataloader) == len(data_module.shapenet_dataset)
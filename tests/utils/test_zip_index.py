@@ -0,0 +1,60 @@
+"""Tests to ensure that meshes read from zip archives by offset match the extracted .obj files"""
+import os
+import pickle
+import zipfile
+
+import pytest
+import torch
+
+from polygen.modules.data_modules import ShapenetDataset
+from polygen.utils.zip_index import ZipMeshArchives, build_zip_index, main
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DATA_DIR = os.path.join(REPO_DIR, "image_meshes")
+
+
+@pytest.fixture
+def zip_dir(tmp_path):
+    """One zip archive per category of image_meshes, alternating stored and deflated members"""
+    zip_dir = tmp_path / "zips"
+    zip_dir.mkdir()
+    for i, mesh_file in enumerate(sorted(ShapenetDataset(DATA_DIR).all_files)):
+        member = os.path.relpath(mesh_file, DATA_DIR)
+        compression = zipfile.ZIP_DEFLATED if i % 2 else zipfile.ZIP_STORED
+        with zipfile.ZipFile(zip_dir / f"{member.split('/')[0]}.zip", "a", compression=compression) as archive:
+            archive.writestr(os.path.join(os.path.dirname(member), "model_normalized.mtl"), "newmtl material\n")
+            archive.write(mesh_file, member)
+    return str(zip_dir)
+
+
+def test_zip_dataset_matches_extracted_dataset(zip_dir, tmp_path):
+    index_path = str(tmp_path / "index.json")
+    main(["--zip-dir", zip_dir, "--index-path", index_path])
+    dataset = ShapenetDataset(DATA_DIR)
+    zip_dataset = ShapenetDataset(DATA_DIR, zip_index_path=index_path)
+    assert len(zip_dataset) == len(dataset)
+    # Class labels do not depend on whether the meshes are read from the archives or an extracted copy
+    assert zip_dataset.label_dict == dataset.label_dict
+    for idx in range(len(zip_dataset)):
+        mesh_file = zip_dataset.all_files[idx]
+        category = mesh_file.split("/")[-4]
+        extracted_file = os.path.join(DATA_DIR, os.path.relpath(mesh_file, os.path.join(zip_dir, f"{category}.zip")))
+        expected, mesh = dataset[dataset.all_files.index(extracted_file)], zip_dataset[idx]
+        assert mesh["class_label"] == expected["class_label"]
+        for key in ["vertices", "faces"]:
+            assert torch.equal(mesh[key], expected[key])
+    # One handle per archive, dropped when the dataset is pickled for worker processes
+    assert len(zip_dataset.zip_archives._handles) == len(os.listdir(zip_dir))
+    assert pickle.loads(pickle.dumps(zip_dataset)).zip_archives._handles == {}
+
+
+def test_zip_index_reindexes_changed_archives(zip_dir, tmp_path):
+    index_path = str(tmp_path / "index.json")
+    zip_files = sorted(os.path.join(zip_dir, zip_file) for zip_file in os.listdir(zip_dir))
+    assert build_zip_index(zip_files, index_path) == {"indexed": 4, "reused": 0, "meshes": 4}
+    assert build_zip_index(zip_files, index_path) == {"indexed": 0, "reused": 4, "meshes": 4}
+    with zipfile.ZipFile(zip_files[0], "a") as archive:
+        archive.writestr("extra/models/model_normalized.obj", "v 0 0 0\nv 1 0 0\nv 0 1 0\nf 1 2 3\n")
+    assert build_zip_index(zip_files, index_path) == {"indexed": 1, "reused": 3, "meshes": 5}
+    obj_data = ZipMeshArchives(index_path).read(os.path.join(zip_files[0], "extra/models/model_normalized.obj"))
+    assert obj_data.startswith(b"v 0 0 0")